@@ -8,11 +8,15 @@ requests_cache.install_cache('temp/demo_cache')
 
 from massql import msql_parser
 from massql import msql_engine
+from massql import msql_engine_cache
 
 from celery.signals import worker_ready
 
 celery_instance = Celery('tasks', backend='redis://msql-redis', broker='pyamqp://guest@msql-rabbitmq//', worker_redirect_stdouts=False)
 
+# draw_output and draw_plot ask for the same query on the same file, this way it is only run once
+result_cache = msql_engine_cache.ResultCache('temp/query_cache')
+
 
 @celery_instance.task(time_limit=60)
 def task_computeheartbeat():
@@ -23,7 +27,7 @@ def task_computeheartbeat():
 def task_executequery(query, filename):
     
     parse_results = msql_parser.parse_msql(query)
-    results_df = msql_engine.process_query(query, filename, parallel=False)
+    results_df = msql_engine.process_query(query, filename, parallel=False, result_cache=result_cache)
 
     all_results = results_df.to_dict(orient="records")
 
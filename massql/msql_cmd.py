@@ -4,45 +4,92 @@ import argparse
 import os
 import sys
 import json
-import pandas as pd
 
 # Making sure the root is in the path, kind of a hack
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
 sys.path.insert(0, os.path.join(os.path.dirname(__file__)))
 
-from massql import msql_parser
-from massql import msql_engine
-from massql import msql_extract
-
 def main():
+    # massql serve keeps a warm process around, this has its own arguments
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        from massql import msql_server
+        msql_server.main(sys.argv[2:])
+        return
+
+    # massql index builds and queries the fragment index of many files
+    if len(sys.argv) > 1 and sys.argv[1] == "index":
+        from massql import msql_fragment_index
+        msql_fragment_index.main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(description="MSQL CMD")
     parser.add_argument('filename', help='Input filename')
     parser.add_argument('query', help='Input Query')
     parser.add_argument('--output_file', default=None, help='output results filename')
-    parser.add_argument('--parallel_query', default="NO", help='YES to make it parallel with ray locally, NO is default')
+    parser.add_argument('--parallel_query', default="NO", help='YES to make it parallel with ray locally, or with local processes when ray is not installed, NO is default')
     parser.add_argument('--cache', default="YES", help='YES to cache with feather, YES is the default')
     parser.add_argument('--original_path', default=None, help='Original absolute path for the filename, useful in proteosafe')
     parser.add_argument('--extract_mzML', default=None, help='Extracting spectra found as mzML file')
     parser.add_argument('--extract_json', default=None, help='Extracting spectra found as json file, each spectrum is a line')
     parser.add_argument('--maxfilesize', default=None, help='Maximum file size in MB')
+    parser.add_argument('--explain', default="NO", help='YES to print the operators of the query without running it, NO is default')
+    parser.add_argument('--profile', default="NO", help='YES to print the time, rows and scans of every operator after running, NO is default')
+    parser.add_argument('--profile_json', default=None, help='Saving the profile as json to this filename, turns on profiling')
+    parser.add_argument('--result_cache', default=None, help='Folder to cache query results in, the same query on the same file is then not run again')
+    parser.add_argument('--result_cache_size', default="1024", help='Maximum size of the result cache in MB, 1024 is default')
+    parser.add_argument('--backend', default="pandas", help='pandas, duckdb or polars, duckdb runs the queries as SQL and polars with lazy frames, they need their packages, pandas is the default')
+    parser.add_argument('--server', default=None, help='Unix socket of a running massql serve, the query is run there instead of starting up the engine here')
     
     args = parser.parse_args()
 
+    if args.server is not None:
+        from massql import msql_server
+        job_results = msql_server.submit_jobs(args.server, [msql_server.job_from_args(args)])
+
+        for job_result in job_results:
+            if job_result["status"] != "ok":
+                print("MassQL Server Error", job_result["error"])
+                exit(1)
+            if "pruned" in job_result:
+                print("MassQL Pruned {}, {}".format(job_result["filename"], job_result["pruned"]))
+            print("MassQL Found {} results".format(job_result["results"]))
+        return
+
+    # The engine brings in pandas, this is only imported once we know there is a query to run so --help stays quick
+    from massql import msql_parser
+    from massql import msql_engine
+    from massql import msql_engine_cache
+    from massql import msql_engine_summary
+
     print(args)
 
     PARALLEL = args.parallel_query == "YES"
 
     if PARALLEL:
-        msql_engine.init_ray()
+        try:
+            msql_engine.init_ray()
+        except ImportError:
+            # Without ray, the engine uses local processes
+            pass
 
     # Massaging the query on input, we have a system to enable multiple queries to be entered, where results are merged
     # The delimeter is specified as |||
     all_queries = args.query.split("|||")
 
     # Let's parse first
+    parsed_queries = []
     for query in all_queries:
         parsed_query = msql_parser.parse_msql(query)
         print(json.dumps(parsed_query, indent=4))
+        parsed_queries.append(parsed_query)
+
+    # Existence queries only tell us that the file matches, there are no spectra to extract
+    EXISTS_ONLY = all(parsed_query["querytype"]["function"] == "functionexists" for parsed_query in parsed_queries)
+
+    if args.explain == "YES":
+        for query in all_queries:
+            print(msql_engine.explain_query(query))
+        exit(0)
 
     # Checking the input file for size
     if args.maxfilesize is not None:
@@ -51,24 +98,58 @@ def main():
                 print("File is too big, exiting")
                 exit(0)
 
-    # Executing
-    all_results_list = []
-    for i, query in enumerate(all_queries):
-        results_df = msql_engine.process_query(query, 
-                                                args.filename, 
-                                                cache=(args.cache == "YES"), 
-                                                parallel=PARALLEL)
+    # The summary next to the file can show that none of the queries match it, then it is not loaded
+    prune_reason = msql_engine_summary.prune_file(parsed_queries, args.filename)
+    if prune_reason is not None:
+        print("MassQL Pruned {}, {}".format(args.filename, prune_reason))
 
-        results_df["query_index"] = i
-        all_results_list.append(results_df)
+    # Executing, the queries share the loaded data and their common filters
+    PROFILE = args.profile == "YES" or args.profile_json is not None
 
-    # Merging
-    results_df = pd.concat(all_results_list)
+    result_cache = None
+    if args.result_cache is not None:
+        result_cache = msql_engine_cache.ResultCache(args.result_cache, max_bytes=int(args.result_cache_size) * 1024 * 1024)
+
+    results_df = msql_engine.process_queries(all_queries, 
+                                            args.filename, 
+                                            cache=(args.cache == "YES"), 
+                                            parallel=PARALLEL,
+                                            profile=PROFILE,
+                                            result_cache=result_cache,
+                                            backend=args.backend)
+
+    if result_cache is not None:
+        print("Result Cache", json.dumps(result_cache.stats()))
+
+    if PROFILE:
+        results_df, query_profile = results_df
+        print(query_profile)
+
+        if args.profile_json is not None:
+            with open(args.profile_json, "w") as profile_file:
+                profile_file.write(query_profile.to_json())
 
     print("#############################")
     print("MassQL Found {} results".format(len(results_df)))
     print("#############################")
 
+    _save_results(results_df, args.filename, output_file=args.output_file, original_path=args.original_path, 
+                  extract_json=args.extract_json, exists_only=EXISTS_ONLY)
+
+def _save_results(results_df, filename, output_file=None, original_path=None, extract_json=None, exists_only=False):
+    """
+    Writes out the results of a file and extracts the spectra, this is shared with massql serve
+
+    Args:
+        results_df ([type]): [description]
+        filename ([type]): input filename
+        output_file ([type], optional): [description]. Defaults to None.
+        original_path ([type], optional): [description]. Defaults to None.
+        extract_json ([type], optional): [description]. Defaults to None.
+        exists_only (bool, optional): [description]. Defaults to False. Existence queries have no spectra to extract
+    """
+    from massql import msql_extract
+
     # Setting mzupper and mzlower
     try:
         if "comment" in results_df:
@@ -77,11 +158,11 @@ def main():
     except:
         pass
     
-    if args.output_file and len(results_df) > 0:
-        results_df["filename"] = os.path.basename(args.filename)
+    if output_file and len(results_df) > 0:
+        results_df["filename"] = os.path.basename(filename)
 
-        if args.original_path is not None:
-            useful_filename = args.original_path
+        if original_path is not None:
+            useful_filename = original_path
             # TODO: Clean up for ProteoSAFe
             useful_filename = useful_filename.split("demangled_spectra/")[-1]
 
@@ -116,19 +197,18 @@ def main():
         columns = list(results_df.columns)
         columns.sort()
 
-        if ".tsv" in args.output_file:
-            results_df.to_csv(args.output_file, index=False, sep="\t", columns=columns)
+        if ".tsv" in output_file:
+            results_df.to_csv(output_file, index=False, sep="\t", columns=columns)
         else:
-            results_df.to_csv(args.output_file, index=False, columns=columns)
+            results_df.to_csv(output_file, index=False, columns=columns)
 
         # Extracting
-        if args.extract_json is not None and len(results_df) > 0:
+        if extract_json is not None and len(results_df) > 0 and not exists_only:
             print("Extracting {} spectra".format(len(results_df)))
             try:
-                msql_extract._extract_spectra(results_df, os.path.dirname(args.filename), output_json_filename=args.extract_json)
+                msql_extract._extract_spectra(results_df, os.path.dirname(filename), output_json_filename=extract_json)
             except:
                 print("Extraction Failed")
-                
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,7 @@
 import os
+import json
 import pandas as pd
 import numpy as np
-import copy
 import logging
 from tqdm import tqdm
 
@@ -10,6 +10,11 @@ from py_expression_eval import Parser
 from massql import msql_parser
 from massql import msql_fileloading
 from massql import msql_engine_filters
+from massql import msql_engine_template
+from massql import msql_engine_index
+from massql import msql_engine_results
+from massql import msql_engine_profile
+from massql import msql_engine_summary
 from massql.msql_engine_filters import _get_mz_tolerance, _get_minintensity
 
 math_parser = Parser()
@@ -21,10 +26,20 @@ def DEBUG_MSG(msg):
 
     print(msg, file=sys.stderr, flush=True)
 
-def init_ray():
+def init_ray(num_cpus=None, object_store_memory=None):
+    """
+    Starts ray, sized from the arguments or the MASSQL_RAY_NUM_CPUS and MASSQL_RAY_OBJECT_STORE_MEMORY environment variables,
+    otherwise ray sizes itself from the machine
+
+    Args:
+        num_cpus ([type], optional): [description]. Defaults to None.
+        object_store_memory ([type], optional): [description]. Defaults to None. In bytes
+    """
     import ray
+    from massql import msql_engine_ray
+
     if not ray.is_initialized():
-        ray.init(ignore_reinit_error=True, object_store_memory=8000000000, num_cpus=8)
+        ray.init(ignore_reinit_error=True, **msql_engine_ray.get_ray_resources(num_cpus=num_cpus, object_store_memory=object_store_memory))
 
 
 def _get_ppm_tolerance(qualifiers):
@@ -47,7 +62,7 @@ def _get_da_tolerance(qualifiers):
     return None
 
 
-def process_query(input_query, input_filename, path_to_grammar=None, cache=True, parallel=False, ms1_df=None, ms2_df=None):
+def process_query(input_query, input_filename, path_to_grammar=None, cache=True, parallel=False, ms1_df=None, ms2_df=None, profile=False, result_cache=None, backend="pandas"):
     """
     Process an actual query
 
@@ -56,17 +71,307 @@ def process_query(input_query, input_filename, path_to_grammar=None, cache=True,
         input_filename ([type]): [description]
         path_to_grammar ([type], optional): [description]. Defaults to None.
         cache (bool, optional): [description]. Defaults to True.
+        parallel (bool, optional): [description]. Defaults to False. Uses ray when it is initialized, otherwise local processes. 
+            True uses every core, a number sets how many processes
+        ms1_df ([type], optional): [description]. Defaults to None. Pass in if you have these data in memory
+        ms2_df ([type], optional): [description]. Defaults to None. Pass in if you have these data in memory
+        profile (bool, optional): [description]. Defaults to False. Records the time, rows and scans of every operator
+        result_cache ([type], optional): [description]. Defaults to None. msql_engine_cache.ResultCache to reuse results of the same query on the same file
+        backend (str, optional): [description]. Defaults to "pandas". "duckdb" runs the query as SQL with DuckDB, "polars" with lazy Polars frames, queries they cannot run use pandas
+
+    Returns:
+        query results data frame: [description], with profile a tuple of the results and the msql_engine_profile.QueryProfile
+    """
+    _check_backend(backend)
+
+    query_profile = msql_engine_profile.QueryProfile(detail=input_query) if profile else None
+
+    with msql_engine_profile.operator(query_profile, "parse"):
+        parsed_dict = msql_parser.parse_msql(input_query, path_to_grammar=path_to_grammar)
+
+    results_df = _process_parsed_query(parsed_dict, input_filename, cache=cache, parallel=parallel, ms1_df=ms1_df, ms2_df=ms2_df,
+                                        result_cache=result_cache, backend=backend, profile=query_profile)
+
+    if profile:
+        query_profile.finish()
+        return results_df, query_profile
+
+    return results_df
+
+def _process_parsed_query(parsed_dict, input_filename, cache=True, parallel=False, ms1_df=None, ms2_df=None, result_cache=None, backend="pandas", profile=None):
+    """
+    Process a query that is already parsed, executing changes the parsed query so it cannot be used again
+
+    Returns:
+        [type]: results data frame
+    """
+    # Results of data passed in memory are not cached, we cannot tell what file they are from
+    cache_key, results_df = None, None
+    if result_cache is not None and ms1_df is None:
+        cache_key, results_df = _get_cached_results(result_cache, parsed_dict, input_filename, backend=backend, profile=profile)
+
+    # Files whose summary shows the query cannot match them are not loaded
+    if results_df is None and ms1_df is None and _get_prune_reason(parsed_dict, input_filename, profile=profile) is not None:
+        results_df = pd.DataFrame()
+
+    if results_df is None:
+        results_df = _execute_backend(parsed_dict, input_filename, backend=backend, cache=cache, parallel=parallel, ms1_df=ms1_df, ms2_df=ms2_df, profile=profile)
+
+        if cache_key is not None:
+            result_cache.put(cache_key, results_df)
+
+    return results_df
+
+def process_query_files(input_query, input_filenames, path_to_grammar=None, cache=True, parallel=False, workers=None, max_memory=None, backend="pandas"):
+    """
+    Process a query against many files. The query is parsed once, and the files are run on a pool of processes. 
+    Files are only started while the memory they are estimated to need fits, so a few large files do not run out of memory.
+
+    Args:
+        input_query ([type]): [description]
+        input_filenames ([type]): list of filenames, or a glob pattern
+        path_to_grammar ([type], optional): [description]. Defaults to None.
+        cache (bool, optional): [description]. Defaults to True.
+        parallel (bool, optional): [description]. Defaults to False. Runs the X values of a file on processes, only for files run in this process,
+            in the pool every worker already has a file
+        workers ([type], optional): [description]. Defaults to None, which uses every available core. 1 runs the files in this process
+        max_memory ([type], optional): [description]. Defaults to None, which is half of the available memory. Bytes the files in flight can use
+        backend (str, optional): [description]. Defaults to "pandas".
+
+    Returns:
+        [type]: generator of the filename, the results data frame with the filename of every result, and the error, 
+            None when the file ran, for every file as it finishes. A file that fails does not stop the others
+    """
+    from massql import msql_engine_files
+
+    _check_backend(backend)
+
+    parsed_dict = msql_parser.parse_msql(input_query, path_to_grammar=path_to_grammar)
+    input_filenames = msql_engine_files.find_files(input_filenames)
+
+    return msql_engine_files.execute_files(parsed_dict, input_filenames, num_workers=workers, max_memory=max_memory, cache=cache, parallel=parallel, backend=backend)
+
+def process_queries(input_queries, input_filename, path_to_grammar=None, cache=True, parallel=False, ms1_df=None, ms2_df=None, profile=False, result_cache=None, backend="pandas"):
+    """
+    Process several queries against the same file. The data is loaded once and the queries run one after another,
+    the scan filters, the leading peak conditions and the subqueries that they have in common are only executed once.
+
+    Args:
+        input_queries ([type]): list of queries
+        input_filename ([type]): [description]
+        path_to_grammar ([type], optional): [description]. Defaults to None.
+        cache (bool, optional): [description]. Defaults to True.
         parallel (bool, optional): [description]. Defaults to False.
         ms1_df ([type], optional): [description]. Defaults to None. Pass in if you have these data in memory
         ms2_df ([type], optional): [description]. Defaults to None. Pass in if you have these data in memory
+        profile (bool, optional): [description]. Defaults to False. Records the time, rows and scans of every operator
+        result_cache ([type], optional): [description]. Defaults to None. msql_engine_cache.ResultCache, the file is only loaded if a query is not cached
+        backend (str, optional): [description]. Defaults to "pandas". "duckdb" runs the queries as SQL with DuckDB, "polars" with lazy Polars frames, queries they cannot run use pandas
 
     Returns:
-        query results data frame: [description]
+        query results data frame: [description], with query_index as the position of the query in input_queries. 
+            With profile a tuple of the results and the msql_engine_profile.QueryProfile
+    """
+    _check_backend(backend)
+
+    query_profile = msql_engine_profile.QueryProfile(name="queries") if profile else None
+
+    with msql_engine_profile.operator(query_profile, "parse"):
+        parsed_dict_list = [msql_parser.parse_msql(input_query, path_to_grammar=path_to_grammar) for input_query in input_queries]
+
+    cache_keys = [None] * len(parsed_dict_list)
+    cached_results = [None] * len(parsed_dict_list)
+    if result_cache is not None and ms1_df is None:
+        for query_index, parsed_dict in enumerate(parsed_dict_list):
+            cache_keys[query_index], cached_results[query_index] = _get_cached_results(result_cache, parsed_dict, input_filename, backend=backend, profile=query_profile)
+
+    # Files whose summary shows a query cannot match them are not loaded for it
+    if ms1_df is None:
+        for query_index, parsed_dict in enumerate(parsed_dict_list):
+            if cached_results[query_index] is None and _get_prune_reason(parsed_dict, input_filename, profile=query_profile) is not None:
+                cached_results[query_index] = pd.DataFrame()
+
+    # The other backends read the feather cache themselves, the data is only loaded here for the queries that run with pandas
+    uncached_queries = [parsed_dict for parsed_dict, cached_df in zip(parsed_dict_list, cached_results) if cached_df is None]
+    backend_module = _get_backend_module(backend)
+    if backend_module is not None:
+        uncached_queries = [parsed_dict for parsed_dict in uncached_queries if backend_module.unsupported_reason(parsed_dict) is not None]
+
+    if ms1_df is None and len(uncached_queries) > 0:
+        with msql_engine_profile.operator(query_profile, "load", detail=input_filename) as profile_node:
+            ms1_df, ms2_df = msql_fileloading.load_data(input_filename, cache=cache)
+            profile_node.set_output(ms1_df=ms1_df, ms2_df=ms2_df)
+
+    subquery_results = {}
+    shared_plan = {}
+
+    results_list = []
+    for query_index, parsed_dict in enumerate(parsed_dict_list):
+        results_df = cached_results[query_index]
+
+        if results_df is None:
+            with msql_engine_profile.operator(query_profile, "query", detail=input_queries[query_index], key=query_index):
+                results_df = _execute_backend(parsed_dict, input_filename, backend=backend, cache=cache, parallel=parallel,
+                                                ms1_df=ms1_df, ms2_df=ms2_df,
+                                                subquery_results=subquery_results, shared_plan=shared_plan, profile=query_profile)
+
+            if cache_keys[query_index] is not None:
+                result_cache.put(cache_keys[query_index], results_df)
+
+        results_df["query_index"] = query_index
+        results_list.append(results_df)
+
+    results_df = pd.concat(results_list)
+
+    if profile:
+        query_profile.finish()
+        return results_df, query_profile
+
+    return results_df
+
+BACKENDS = ["pandas", "duckdb", "polars"]
+
+def _check_backend(backend):
+    if not backend in BACKENDS:
+        raise Exception("BACKEND NOT SUPPORTED")
+
+def _get_backend_module(backend):
+    # The other backends are imported when they are used, so their packages are optional
+    if backend == "duckdb":
+        from massql import msql_engine_duckdb
+        return msql_engine_duckdb
+    if backend == "polars":
+        from massql import msql_engine_polars
+        return msql_engine_polars
+
+    return None
+
+def _execute_backend(parsed_dict, input_filename, backend="pandas", cache=True, parallel=False, ms1_df=None, ms2_df=None, subquery_results=None, shared_plan=None, profile=None):
+    """
+    Runs a parsed query with the backend, queries the backend cannot run go to the pandas engine
+
+    Returns:
+        [type]: results data frame
+    """
+    backend_module = _get_backend_module(backend)
+    if backend_module is not None:
+        unsupported_reason = backend_module.unsupported_reason(parsed_dict)
+        if unsupported_reason is None:
+            with msql_engine_profile.operator(profile, backend, ms1_df=ms1_df, ms2_df=ms2_df) as profile_node:
+                results_df = backend_module.execute_query(parsed_dict, input_filename, cache=cache, ms1_df=ms1_df, ms2_df=ms2_df)
+                profile_node.set_output(results_df=results_df)
+
+            return results_df
+
+        print("MassQL {} does not support {}, running with pandas".format(backend, unsupported_reason))
+
+    return _evalute_variable_query(parsed_dict, input_filename, cache=cache, parallel=parallel, ms1_df=ms1_df, ms2_df=ms2_df,
+                                    subquery_results=subquery_results, shared_plan=shared_plan, profile=profile)
+
+def _get_cached_results(result_cache, parsed_dict, input_filename, backend="pandas", profile=None):
+    """
+    Looks up the results of a query, this has to happen before the query is executed as executing changes the parsed query
+
+    Args:
+        result_cache ([type]): msql_engine_cache.ResultCache
+        parsed_dict ([type]): [description]
+        input_filename ([type]): [description]
+        backend (str, optional): [description]. Defaults to "pandas".
+        profile ([type], optional): [description]. Defaults to None.
+
+    Returns:
+        [type]: cache key and the cached results, None when they are not cached
+    """
+    with msql_engine_profile.operator(profile, "result cache", detail=input_filename) as profile_node:
+        cache_key = result_cache.query_key(parsed_dict, input_filename, backend=backend)
+        results_df = result_cache.get(cache_key)
+
+        profile_node.add("hits" if results_df is not None else "misses", 1)
+        profile_node.set_output(results_df=results_df)
+
+    return cache_key, results_df
+
+def _get_prune_reason(parsed_dict, input_filename, profile=None):
+    """
+    Checks the summary of the file, msql_engine_summary, for a reason the query cannot match it
+
+    Args:
+        parsed_dict ([type]): [description]
+        input_filename ([type]): [description]
+        profile ([type], optional): [description]. Defaults to None.
+
+    Returns:
+        [type]: the reason, None when the query might match or the file has no summary
+    """
+    with msql_engine_profile.operator(profile, "summary", detail=input_filename) as profile_node:
+        prune_reason = msql_engine_summary.prune_file([parsed_dict], input_filename)
+
+        profile_node.add("pruned" if prune_reason is not None else "kept", 1)
+
+    return prune_reason
+
+def explain_query(input_query, path_to_grammar=None):
+    """
+    Lays out the operators a query will run, without loading or searching any data
+
+    Args:
+        input_query ([type]): [description]
+        path_to_grammar ([type], optional): [description]. Defaults to None.
+
+    Returns:
+        [type]: msql_engine_profile.QueryProfile without timings
     """
 
     parsed_dict = msql_parser.parse_msql(input_query, path_to_grammar=path_to_grammar)
 
-    return _evalute_variable_query(parsed_dict, input_filename, cache=cache, parallel=parallel, ms1_df=ms1_df, ms2_df=ms2_df)
+    query_profile = msql_engine_profile.QueryProfile(detail=input_query)
+    with query_profile.plan("load"):
+        pass
+    _explain_variable_query(parsed_dict, query_profile)
+
+    return query_profile
+
+def _explain_variable_query(parsed_dict, profile):
+    for condition in parsed_dict["conditions"]:
+        if "value" in condition and len(condition["value"]) > 0 and isinstance(condition["value"][0], dict):
+            with profile.plan("subquery", detail=condition["value"][0].get("query", None), key=_canonical_key(condition["value"][0])):
+                _explain_variable_query(condition["value"][0], profile)
+
+    x_conditions = [condition for condition in parsed_dict["conditions"] if condition["type"] == "xcondition"]
+    query_dict = dict(parsed_dict)
+    query_dict["conditions"] = [condition for condition in parsed_dict["conditions"] if condition["type"] != "xcondition"]
+    query_template = msql_engine_template.QueryTemplate(query_dict)
+
+    if query_template.has_variable:
+        with profile.plan("presearch"):
+            _explain_conditions(query_template.non_variable_query(), profile)
+        with profile.plan("expand X", detail=" ".join(msql_engine_profile.describe_condition(condition) for condition in x_conditions) or None):
+            pass
+        with profile.plan("concrete queries"):
+            _explain_conditions(query_dict, profile)
+            with profile.plan("collate", detail=parsed_dict["querytype"]["function"]):
+                pass
+    else:
+        with profile.plan("execute"):
+            _explain_conditions(query_dict, profile)
+            with profile.plan("collate", detail=parsed_dict["querytype"]["function"]):
+                pass
+
+    result_limit = _get_result_limit(parsed_dict)
+    with profile.plan("collect results", detail="limit={}".format(result_limit) if result_limit is not None else None):
+        pass
+
+def _explain_conditions(parsed_dict, profile):
+    all_conditions = _sort_reference_conditions(parsed_dict["conditions"])
+
+    with profile.plan("scan filters", detail=_describe_scan_conditions(all_conditions)):
+        pass
+
+    for conditiontype in ["where", "filter"]:
+        for condition_index, condition in enumerate(all_conditions):
+            if condition["conditiontype"] == conditiontype and not condition["type"] in SCAN_CONDITION_TYPES:
+                with profile.plan(conditiontype + " " + condition["type"], detail=msql_engine_profile.describe_condition(condition), key=condition_index):
+                    pass
 
 def _determine_mz_max(mz, ppm_tol, da_tol):
     da_tol = da_tol if da_tol < 10000 else 0
@@ -78,19 +383,67 @@ def _determine_mz_max(mz, ppm_tol, da_tol):
 
     return mz + half_delta
 
-def _evalute_variable_query(parsed_dict, input_filename, cache=True, parallel=False, ms1_df=None, ms2_df=None):
-    # Lets check if there is a variable in here, the only one allowed is X
+def _evaluate_subqueries(parsed_dict, input_filename, ms1_df, ms2_df, cache=True, subquery_results=None, shared_plan=None, profile=None):
+    """
+    Replaces the nested QUERY values of conditions with the flattened precursor m/z of the subquery results.
+    Subqueries run against the data that is already loaded, and identical subqueries are only executed once.
+
+    Args:
+        parsed_dict ([type]): [description]. Conditions are edited in place
+        input_filename ([type]): [description]
+        ms1_df ([type]): [description]
+        ms2_df ([type]): [description]
+        cache (bool, optional): [description]. Defaults to True.
+        subquery_results ([type], optional): [description]. Defaults to None. Memoized subquery results, keyed by the subquery
+        shared_plan ([type], optional): [description]. Defaults to None. Intermediate results shared with the outer query
+        profile ([type], optional): [description]. Defaults to None. msql_engine_profile.QueryProfile
+    """
+    if subquery_results is None:
+        subquery_results = {}
+
     for condition in parsed_dict["conditions"]:
-        try:
-            if "querytype" in condition["value"][0]:
-                subquery_val_df = _evalute_variable_query(
-                    condition["value"][0], input_filename, cache=cache
-                )
-                condition["value"] = list(
-                    subquery_val_df["precmz"]
-                )  # Flattening results
-        except:
-            pass
+        if not "value" in condition or len(condition["value"]) == 0:
+            continue
+
+        subquery_dict = condition["value"][0]
+        if not isinstance(subquery_dict, dict) or not "querytype" in subquery_dict:
+            continue
+
+        subquery_key = _canonical_key(subquery_dict)
+
+        with msql_engine_profile.operator(profile, "subquery", detail=subquery_dict.get("query", None), key=subquery_key) as profile_node:
+            if not subquery_key in subquery_results:
+                # Shallow copies so columns added by the subquery do not leak into the outer query
+                subquery_val_df = _evalute_variable_query(subquery_dict, input_filename, cache=cache, 
+                                                        ms1_df=ms1_df.copy(deep=False), ms2_df=ms2_df.copy(deep=False), 
+                                                        subquery_results=subquery_results, shared_plan=shared_plan, profile=profile)
+
+                if "precmz" in subquery_val_df:
+                    subquery_results[subquery_key] = np.sort(subquery_val_df["precmz"].to_numpy(dtype=float))
+                elif len(subquery_val_df) == 0:
+                    subquery_results[subquery_key] = np.array([], dtype=float)
+                else:
+                    raise Exception("SUBQUERY MUST RETURN PRECMZ")
+            else:
+                profile_node.add("shared", 1)
+
+            profile_node.add("values", len(subquery_results[subquery_key]))
+
+        condition["value"] = subquery_results[subquery_key]  # Flattening results
+
+def _evalute_variable_query(parsed_dict, input_filename, cache=True, parallel=False, ms1_df=None, ms2_df=None, subquery_results=None, shared_plan=None, profile=None):
+    # Loading data if not passed in 
+    if ms1_df is None:
+        with msql_engine_profile.operator(profile, "load", detail=input_filename) as profile_node:
+            ms1_df, ms2_df = msql_fileloading.load_data(input_filename, cache=cache)
+            profile_node.set_output(ms1_df=ms1_df, ms2_df=ms2_df)
+
+    # Intermediate results and sorted indices, the concrete queries of a variable query all share them
+    if shared_plan is None:
+        shared_plan = {}
+
+    # Executing the subqueries first, the only variable allowed afterwards is X
+    _evaluate_subqueries(parsed_dict, input_filename, ms1_df, ms2_df, cache=cache, subquery_results=subquery_results, shared_plan=shared_plan, profile=profile)
 
     # Variable Expression Parameters
     variable_properties = {}
@@ -156,190 +509,61 @@ def _evalute_variable_query(parsed_dict, input_filename, cache=True, parallel=Fa
             except TypeError:
                 # This is when the target is actually a float
                 pass
-
-    # Loading data if not passed in 
-    if ms1_df is None:
-        ms1_df, ms2_df = msql_fileloading.load_data(input_filename, cache=cache)
+            except IndexError:
+                # This is when the target is a numpy float, e.g. flattened subquery results
+                pass
 
     # Here we are going to translate the variable query into a concrete query based upon the data
     all_concrete_queries = []
     if variable_properties["has_variable"]:
         # Here we could do a pre-query without any of the other conditions
-        presearch_parse = copy.deepcopy(parsed_dict)
-        non_variable_conditions = []
-        for condition in presearch_parse["conditions"]:
-            if "value" in condition:
-                for value in condition["value"]:
-                    try:
-                        # Checking if X is in any string
-                        if "X" in value:
-                            continue
-                    except TypeError:
-                        # This is when the target is actually a float
-                        pass
-                    non_variable_conditions.append(condition)
-            elif "min" in condition:
-                min_val = condition["min"]
-                max_val = condition["max"]
-                try:
-                    if "X" in min_val:
-                        continue
-                except TypeError:
-                    # This is when the target is actually a float
-                    pass
-
-                try:
-                    if "X" in max_val:
-                        continue
-                except TypeError:
-                    # This is when the target is actually a float
-                    pass
-
-                non_variable_conditions.append(condition)
-
-        presearch_parse["conditions"] = non_variable_conditions
-
-        ms1_df, ms2_df = _executeconditions_query(presearch_parse, input_filename, cache=cache)
-        variable_x_ms1_df = ms1_df
-
-        # Here we are trying to pre-filter conditions based upon the qualifiers to make the variable search space smaller
-        for condition in parsed_dict["conditions"]:
-            if not condition["conditiontype"] == "where":
-                continue
+        query_template = msql_engine_template.QueryTemplate(parsed_dict)
+        presearch_parse = query_template.non_variable_query()
 
-            if "value" in condition:
-                if not "X" in condition["value"]:
-                    continue
-        
-            # Filtering MS1 peaks only to consider contention for X
-            if condition["type"] == "ms1mzcondition":
-                min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
-                variable_x_ms1_df = ms1_df[
-                    (ms1_df["i"] > min_int) & 
-                    (ms1_df["i_norm"] > min_intpercent) & 
-                    (ms1_df["i_tic_norm"] > min_tic_percent_intensity)]
-
-            # TODO: Do this for other types of variables
-
-        # Here we will start with the smallest mass and then go up
-        masses_considered_df_list = []
-        if variable_properties["query_ms1"]:
-            masses_considered_df_list.append(variable_x_ms1_df["mz"])
-        if variable_properties["query_ms2"]:
-            masses_considered_df_list.append(ms2_df["mz"])
-        if variable_properties["query_ms2prec"]:
-            masses_considered_df_list.append(ms2_df["precmz"])
-
-        masses_considered_df = pd.DataFrame()
-        masses_considered_df["mz"] = pd.concat(masses_considered_df_list)
-        # NOTE: This might cause bugs, we might consider every mass within every single scan, or at least we could make the tolernace as even smaller than half the max
-        masses_considered_df["mz_max"] = masses_considered_df["mz"].apply(lambda x: _determine_mz_max(x, variable_properties["ppm_tolerance"], variable_properties["da_tolerance"]))
-        
-        masses_considered_df = masses_considered_df.sort_values("mz")
-        masses_list = masses_considered_df.to_dict(orient="records")
-
-        running_max_mz = 0
-        for masses_obj in tqdm(masses_list):
-            mz_val = masses_obj["mz"]
-
-            if running_max_mz > mz_val:
-                continue
-
-            # Cheking the validity of the mz_val
-            if mz_val < variable_properties["min"] or mz_val > variable_properties["max"]:
-                continue
-            mz_val_defect = mz_val - int(mz_val)
-            if mz_val_defect < variable_properties["mindefect"] or mz_val_defect > variable_properties["maxdefect"]:
-                continue
-
-            #######################
-            # Writing new query
-            #######################
-            substituted_parse = copy.deepcopy(parsed_dict)
-            
-            for condition in substituted_parse["conditions"]:
-                # This is for standard conditions
-                if "value" in condition:
-                    for i, value in enumerate(condition["value"]):
-                        # Rewriting the condition value
-                        try:
-                            if "X" in value:
-                                new_value = math_parser.parse(value).evaluate({
-                                    "X" : mz_val
-                                })
-                                condition["value"][i] = new_value
-                        except TypeError:
-                            # This is when the target is actually a float
-                            pass
-
-                        # Rewriting the qualifier values
-                        try:
-                            if "qualifiers" in condition:
-                                for qualifier in condition["qualifiers"]:
-                                    if "qualifier" in qualifier:
-                                        if "value" in condition["qualifiers"][qualifier]:
-                                            old_value = condition["qualifiers"][qualifier]["value"]
-                                            condition["qualifiers"][qualifier]["value"] = old_value.replace("X", str(mz_val))
-                        except AttributeError:
-                            pass
-                
-                # TODO: For other types of conditions that might include variables
-                if "min" in condition:
-                    # Rewriting the condition min
-                    value = condition["min"]
-                    try:
-                        if "X" in value:
-                            new_value = math_parser.parse(value).evaluate({
-                                "X" : mz_val
-                            })
-                            condition["min"] = new_value
-                    except TypeError:
-                        # This is when the target is actually a float
-                        pass
-
-                if "max" in condition:
-                    # Rewriting the condition min
-                    value = condition["max"]
-                    try:
-                        if "X" in value:
-                            new_value = math_parser.parse(value).evaluate({
-                                "X" : mz_val
-                            })
-                            condition["max"] = new_value
-                    except TypeError:
-                        # This is when the target is actually a float
-                        pass
-            
-            # Let's consider this mz
-            running_max_mz = masses_obj["mz_max"]
+        with msql_engine_profile.operator(profile, "presearch", ms1_df=ms1_df, ms2_df=ms2_df) as profile_node:
+            ms1_df, ms2_df = _executeconditions_query(presearch_parse, input_filename, ms1_input_df=ms1_df, ms2_input_df=ms2_df, cache=cache, shared_plan=shared_plan, profile=profile)
+            profile_node.set_output(ms1_df=ms1_df, ms2_df=ms2_df)
 
-            # Checking the x conditions
-            substituted_parse["comment"] = str(mz_val)
-
-            all_concrete_queries.append(substituted_parse)
+        with msql_engine_profile.operator(profile, "expand X", ms1_df=ms1_df, ms2_df=ms2_df) as profile_node:
+            all_concrete_queries = _expand_variable_query(parsed_dict, query_template, variable_properties, ms1_df, ms2_df)
+            profile_node.add("candidates", len(all_concrete_queries))
     else:
         all_concrete_queries.append(parsed_dict)
 
     print("TOTAL QUERIES", len(all_concrete_queries))
 
-    # Perfoming all the concrete queries
-    collated_list = [] # This list holds the collated set of results from each query, final result is a concat of all of them
+    # Perfoming all the concrete queries, results are collected column by column and deduplicated on (scan, X) as they come in
+    # With a limit, we stop going through the concrete queries once we have enough results
+    results_accumulator = msql_engine_results.ResultAccumulator()
+    result_limit = _get_result_limit(parsed_dict)
 
     # Ray Parallel Version
     execute_serial = True
     if parallel:
-        import ray
-        import msql_engine_ray
+        try:
+            import ray
+            from massql import msql_engine_ray
+        except ImportError:
+            ray = None
+
+        if ray is not None and ray.is_initialized():
+            # The data goes into the object store once, results are streamed back as chunks finish
+            with msql_engine_profile.operator(profile, "concrete queries (ray)", ms1_df=ms1_df, ms2_df=ms2_df):
+                collated_results = msql_engine_ray.execute_concrete_queries(parsed_dict, all_concrete_queries, ms1_df, ms2_df)
+                _accumulate_results(results_accumulator, collated_results, result_limit=result_limit)
+
+            execute_serial = False
+
+    # Local multi-core version, the data is shared with the worker processes
+    if parallel and execute_serial:
+        from massql import msql_engine_parallel
 
-        if ray.is_initialized():
-            # TODO: Divide up the parallel thing
-            chunk_size = 100
-            concrete_query_lists = [all_concrete_queries[i:i + chunk_size] for i in range(0, len(all_concrete_queries), chunk_size)]
-            futures = [msql_engine_ray._executeconditions_query_ray.remote(concrete_query_list, input_filename, ms1_input_df=ms1_df, ms2_input_df=ms2_df, cache=cache) for concrete_query_list in concrete_query_lists]
-            all_ray_results = ray.get(futures)
+        if msql_engine_parallel.shared_memory is not None and len(all_concrete_queries) >= msql_engine_parallel.PARALLEL_MIN_QUERIES:
+            num_workers = None if parallel is True else parallel
 
-            # Flattening this list of lists
-            collated_list = [item for sublist in all_ray_results for item in sublist]
+            with msql_engine_profile.operator(profile, "concrete queries (processes)", ms1_df=ms1_df, ms2_df=ms2_df):
+                collated_results = msql_engine_parallel.execute_concrete_queries(parsed_dict, all_concrete_queries, ms1_df, ms2_df, num_workers=num_workers)
+                _accumulate_results(results_accumulator, collated_results, result_limit=result_limit)
 
             execute_serial = False
     
@@ -347,57 +571,194 @@ def _evalute_variable_query(parsed_dict, input_filename, cache=True, parallel=Fa
     if execute_serial:
         # Serial Version
         for concrete_query in tqdm(all_concrete_queries):
-            results_ms1_df, results_ms2_df = _executeconditions_query(concrete_query, input_filename, ms1_input_df=ms1_df, ms2_input_df=ms2_df, cache=cache)
-            
-            collated_df = _executecollate_query(parsed_dict, results_ms1_df, results_ms2_df)
-            collated_list.append(collated_df)
+            with msql_engine_profile.operator(profile, "concrete queries" if variable_properties["has_variable"] else "execute", ms1_df=ms1_df, ms2_df=ms2_df):
+                results_ms1_df, results_ms2_df = _executeconditions_query(concrete_query, input_filename, ms1_input_df=ms1_df, ms2_input_df=ms2_df, cache=cache, shared_plan=shared_plan, profile=profile)
+
+                with msql_engine_profile.operator(profile, "collate", detail=parsed_dict["querytype"]["function"], ms1_df=results_ms1_df, ms2_df=results_ms2_df) as profile_node:
+                    collated_df = _executecollate_query(parsed_dict, results_ms1_df, results_ms2_df)
+                    profile_node.set_output(results_df=collated_df)
+
+            results_accumulator.append(collated_df)
 
-    # Concatenating all the results
-    collated_df = pd.concat(collated_list)
-    collated_df = collated_df.reset_index(drop=True)
+            if result_limit is not None and len(results_accumulator) >= result_limit:
+                break
 
-    # Lets try to remove duplicates
+    with msql_engine_profile.operator(profile, "collect results", detail="limit={}".format(result_limit) if result_limit is not None else None) as profile_node:
+        results_df = results_accumulator.to_dataframe()
+        if result_limit is not None:
+            results_df = results_df.head(result_limit)
+        profile_node.set_output(results_df=results_df)
+
+    return results_df
+
+def _get_result_limit(parsed_dict):
+    """
+    Number of result rows the query asks for, exists only needs to know if there is one
+
+    Args:
+        parsed_dict ([type]): [description]
+
+    Returns:
+        [type]: the limit or None when we want everything
+    """
+    if parsed_dict["querytype"]["function"] == "functionexists":
+        return 1
+
+    return parsed_dict.get("limit", None)
+
+def _accumulate_results(results_accumulator, collated_results, result_limit=None):
+    # Closing the generator once we have enough, this stops the parallel workers from going through the rest
     try:
-        if "comment" in collated_df:
-            collated_df["truncated_comment"] = collated_df["comment"].astype(float).astype(int)
-            collated_df = collated_df.drop_duplicates(subset=["scan", "truncated_comment"])
-            collated_df = collated_df.drop("truncated_comment", axis=1)
-    except:
-        pass
-        
-    return collated_df
+        for collated_df in collated_results:
+            results_accumulator.append(collated_df)
 
+            if result_limit is not None and len(results_accumulator) >= result_limit:
+                break
+    finally:
+        collated_results.close()
 
-def _executeconditions_query(parsed_dict, input_filename, ms1_input_df=None, ms2_input_df=None, cache=True):
-    # This function attempts to find the data that the query specifies in the conditions
-    
-    #import json
-    #print("parsed_dict", json.dumps(parsed_dict, indent=4))
+def _expand_variable_query(parsed_dict, query_template, variable_properties, ms1_df, ms2_df):
+    """
+    Writes a concrete query for every value of X that is found in the pre-searched data
 
-    # Let's apply this to real data
-    if ms1_input_df is None and ms2_input_df is None:
-        ms1_df, ms2_df = msql_fileloading.load_data(input_filename, cache=cache)
-    else:
-        ms1_df = ms1_input_df
-        ms2_df = ms2_input_df
+    Args:
+        parsed_dict ([type]): [description]
+        query_template ([type]): msql_engine_template.QueryTemplate
+        variable_properties ([type]): [description]
+        ms1_df ([type]): pre-searched data
+        ms2_df ([type]): pre-searched data
 
-    # In order to handle intensities, we will make sure to sort all conditions with 
-    # with the conditions that are the reference intensity first, then subsequent conditions
-    # that have an intensity match will reference the saved reference intensities
-    reference_conditions_register = {} # This will hold all the reference intensity values
-    
-    # This helps sort the qualifiers
-    reference_conditions = []
-    nonreference_conditions = []
+    Returns:
+        [type]: list of concrete queries
+    """
+    all_concrete_queries = []
+    variable_x_ms1_df = ms1_df
+
+    # Here we are trying to pre-filter conditions based upon the qualifiers to make the variable search space smaller
     for condition in parsed_dict["conditions"]:
-        if "qualifiers" in condition:
-            if "qualifierintensityreference" in condition["qualifiers"]:
-                reference_conditions.append(condition)
+        if not condition["conditiontype"] == "where":
+            continue
+
+        if "value" in condition:
+            if not "X" in condition["value"]:
                 continue
-        nonreference_conditions.append(condition)
-    all_conditions = reference_conditions + nonreference_conditions
 
-    # These are for the WHERE clause, first lets filter by RT and polarity and scan
+        # Filtering MS1 peaks only to consider contention for X
+        if condition["type"] == "ms1mzcondition":
+            min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
+            variable_x_ms1_df = ms1_df[
+                (ms1_df["i"] > min_int) & 
+                (ms1_df["i_norm"] > min_intpercent) & 
+                (ms1_df["i_tic_norm"] > min_tic_percent_intensity)]
+
+        # TODO: Do this for other types of variables
+
+    # Here we will start with the smallest mass and then go up
+    masses_considered_df_list = []
+    if variable_properties["query_ms1"]:
+        masses_considered_df_list.append(variable_x_ms1_df["mz"])
+    if variable_properties["query_ms2"]:
+        masses_considered_df_list.append(ms2_df["mz"])
+    if variable_properties["query_ms2prec"]:
+        masses_considered_df_list.append(ms2_df["precmz"])
+
+    masses_considered_df = pd.DataFrame()
+    masses_considered_df["mz"] = pd.concat(masses_considered_df_list)
+    # NOTE: This might cause bugs, we might consider every mass within every single scan, or at least we could make the tolernace as even smaller than half the max
+    masses_considered_df["mz_max"] = masses_considered_df["mz"].apply(lambda x: _determine_mz_max(x, variable_properties["ppm_tolerance"], variable_properties["da_tolerance"]))
+
+    masses_considered_df = masses_considered_df.sort_values("mz")
+    masses_list = masses_considered_df.to_dict(orient="records")
+
+    running_max_mz = 0
+    for masses_obj in tqdm(masses_list):
+        mz_val = masses_obj["mz"]
+
+        if running_max_mz > mz_val:
+            continue
+
+        # Cheking the validity of the mz_val
+        if mz_val < variable_properties["min"] or mz_val > variable_properties["max"]:
+            continue
+        mz_val_defect = mz_val - int(mz_val)
+        if mz_val_defect < variable_properties["mindefect"] or mz_val_defect > variable_properties["maxdefect"]:
+            continue
+
+        # Writing new query
+        substituted_parse = query_template.bind(mz_val)
+
+        # Let's consider this mz
+        running_max_mz = masses_obj["mz_max"]
+
+        all_concrete_queries.append(substituted_parse)
+
+    return all_concrete_queries
+
+SCAN_CONDITION_TYPES = ["rtmincondition", 
+                        "rtmaxcondition", 
+                        "polaritycondition", 
+                        "scanmincondition", 
+                        "scanmaxcondition",
+                        "chargecondition",
+                        "mobilitycondition"]
+
+def _canonical_key(obj):
+    # numpy arrays show up as flattened subquery results
+    return json.dumps(obj, sort_keys=True, default=lambda value: value.tolist())
+
+def _get_frames_key(shared_plan, ms1_df, ms2_df):
+    """
+    Registers the data frames in the shared plan, results are keyed on their position there. The frames are kept in the plan,
+    so they are the same objects for as long as the plan lives
+
+    Returns:
+        [type]: key of the data frames
+    """
+    registered_frames = shared_plan.setdefault("frames", [])
+
+    # Most lookups are for the frames registered last, e.g. every value of X runs on the same pre-search data
+    for frames_index in range(len(registered_frames) - 1, -1, -1):
+        if registered_frames[frames_index][0] is ms1_df and registered_frames[frames_index][1] is ms2_df:
+            return ("frames", frames_index)
+
+    registered_frames.append((ms1_df, ms2_df))
+
+    return ("frames", len(registered_frames) - 1)
+
+def _get_shared_index(shared_plan, scans_key, level, ms_df):
+    if shared_plan is None or len(ms_df) == 0:
+        return None
+
+    index_key = ("index", scans_key, level)
+    if not index_key in shared_plan:
+        shared_plan[index_key] = msql_engine_index.PeakIndex(ms_df)
+
+    return shared_plan[index_key]
+
+def _executescanconditions_query(all_conditions, ms1_df, ms2_df, shared_plan=None):
+    """
+    Applies the WHERE conditions that filter whole scans, e.g. RT, polarity, scan and charge
+
+    Args:
+        all_conditions ([type]): [description]
+        ms1_df ([type]): [description]
+        ms2_df ([type]): [description]
+        shared_plan ([type], optional): [description]. Defaults to None. When given, the results are shared between queries
+
+    Returns:
+        ms1_df ([type]): [description]
+        ms2_df ([type]): [description]
+        scans_key ([type]): key of the scan filtered data in the shared plan, None without a shared plan
+    """
+    if shared_plan is not None:
+        scan_conditions = [condition for condition in all_conditions if condition["conditiontype"] == "where" and condition["type"] in SCAN_CONDITION_TYPES]
+        scans_key = ("scans", _get_frames_key(shared_plan, ms1_df, ms2_df), _canonical_key(scan_conditions))
+
+        if not scans_key in shared_plan:
+            shared_plan[scans_key] = _executescanconditions_query(scan_conditions, ms1_df, ms2_df)[:2]
+
+        return [shared_df.copy(deep=False) for shared_df in shared_plan[scans_key]] + [scans_key]
+
     for condition in all_conditions:
         if not condition["conditiontype"] == "where":
             continue
@@ -405,15 +766,15 @@ def _executeconditions_query(parsed_dict, input_filename, ms1_input_df=None, ms2
         # RT Filters
         if condition["type"] == "rtmincondition":
             rt = condition["value"][0]
-            ms2_df = ms2_df[ms2_df["rt"] > rt]
-            ms1_df = ms1_df[ms1_df["rt"] > rt]
+            ms2_df = msql_engine_index.range_rows(ms2_df, "rt", min_value=rt)
+            ms1_df = msql_engine_index.range_rows(ms1_df, "rt", min_value=rt)
 
             continue
 
         if condition["type"] == "rtmaxcondition":
             rt = condition["value"][0]
-            ms2_df = ms2_df[ms2_df["rt"] < rt]
-            ms1_df = ms1_df[ms1_df["rt"] < rt]
+            ms2_df = msql_engine_index.range_rows(ms2_df, "rt", max_value=rt)
+            ms1_df = msql_engine_index.range_rows(ms1_df, "rt", max_value=rt)
 
             continue
     
@@ -432,15 +793,15 @@ def _executeconditions_query(parsed_dict, input_filename, ms1_input_df=None, ms2
         # Scan Filters
         if condition["type"] == "scanmincondition":
             scan = int(condition["value"][0])
-            ms2_df = ms2_df[ms2_df["scan"] >= scan]
-            ms1_df = ms1_df[ms1_df["scan"] >= scan]
+            ms2_df = msql_engine_index.range_rows(ms2_df, "scan", min_value=scan, inclusive=True)
+            ms1_df = msql_engine_index.range_rows(ms1_df, "scan", min_value=scan, inclusive=True)
 
             continue
             
         if condition["type"] == "scanmaxcondition":
             scan = int(condition["value"][0])
-            ms2_df = ms2_df[ms2_df["scan"] <= scan]
-            ms1_df = ms1_df[ms1_df["scan"] <= scan]
+            ms2_df = msql_engine_index.range_rows(ms2_df, "scan", max_value=scan, inclusive=True)
+            ms1_df = msql_engine_index.range_rows(ms1_df, "scan", max_value=scan, inclusive=True)
 
             continue
 
@@ -464,83 +825,243 @@ def _executeconditions_query(parsed_dict, input_filename, ms1_input_df=None, ms2
             if "mobility" in ms1_df.columns:
                 ms1_df = ms1_df[(ms1_df["mobility"] >= min_mobility) & (ms1_df["mobility"] <= max_mobility)]
 
-    # These are for the WHERE clause for peaks
-    for condition in all_conditions:
-        if not condition["conditiontype"] == "where":
-            continue
+    return ms1_df, ms2_df, None
 
-        # Filtering MS2 Product Ions
-        if condition["type"] == "ms2productcondition":
-            ms1_df, ms2_df = msql_engine_filters.ms2prod_condition(condition, ms1_df, ms2_df, reference_conditions_register)
-            continue
+def _executepeakcondition_query(condition, ms1_df, ms2_df, reference_conditions_register, ms1_index=None, ms2_index=None):
+    """
+    Applies a single WHERE condition on peaks
 
-        # Filtering MS2 Precursor m/z
-        if condition["type"] == "ms2precursorcondition":
-            ms1_df, ms2_df = msql_engine_filters.ms2prec_condition(condition, ms1_df, ms2_df, reference_conditions_register)
-            continue
+    Args:
+        condition ([type]): [description]
+        ms1_df ([type]): [description]
+        ms2_df ([type]): [description]
+        reference_conditions_register ([type]): Edits this in place
+        ms1_index ([type], optional): [description]. Defaults to None.
+        ms2_index ([type], optional): [description]. Defaults to None.
 
-        # Filtering MS2 Neutral Loss
-        if condition["type"] == "ms2neutrallosscondition":
-            ms1_df, ms2_df = msql_engine_filters.ms2nl_condition(condition, ms1_df, ms2_df, reference_conditions_register)
-            continue
+    Returns:
+        ms1_df ([type]): [description]
+        ms2_df ([type]): [description]
+    """
+    # Nothing to match against, e.g. a subquery without results
+    if "value" in condition and len(condition["value"]) == 0:
+        if not msql_engine_filters._get_exclusion_flag(condition.get("qualifiers", None)):
+            ms1_df, ms2_df = pd.DataFrame(), pd.DataFrame()
+        return ms1_df, ms2_df
 
-        # finding MS1 peaks
-        if condition["type"] == "ms1mzcondition":
-            ms1_df, ms2_df = msql_engine_filters.ms1_condition(condition, ms1_df, ms2_df, reference_conditions_register)
-            continue
+    # Filtering MS2 Product Ions
+    if condition["type"] == "ms2productcondition":
+        return msql_engine_filters.ms2prod_condition(condition, ms1_df, ms2_df, reference_conditions_register, ms2_index=ms2_index)
 
-        skip_conditions = [ "rtmincondition", 
-                            "rtmaxcondition", 
-                            "polaritycondition", 
-                            "scanmincondition", 
-                            "scanmaxcondition",
-                            "chargecondition",
-                            "mobilitycondition"]
-        
-        if condition["type"] in skip_conditions:
-            continue
+    # Filtering MS2 Precursor m/z
+    if condition["type"] == "ms2precursorcondition":
+        return msql_engine_filters.ms2prec_condition(condition, ms1_df, ms2_df, reference_conditions_register, ms2_index=ms2_index)
 
-        raise Exception("CONDITION NOT HANDLED")
+    # Filtering MS2 Neutral Loss
+    if condition["type"] == "ms2neutrallosscondition":
+        return msql_engine_filters.ms2nl_condition(condition, ms1_df, ms2_df, reference_conditions_register, ms2_index=ms2_index)
 
-    # These are for the FILTER clause
+    # finding MS1 peaks
+    if condition["type"] == "ms1mzcondition":
+        return msql_engine_filters.ms1_condition(condition, ms1_df, ms2_df, reference_conditions_register, ms1_index=ms1_index)
+
+    raise Exception("CONDITION NOT HANDLED")
+
+def _sort_reference_conditions(conditions):
+    # This helps sort the qualifiers, the conditions that are the intensity reference come first
+    reference_conditions = []
+    nonreference_conditions = []
+    for condition in conditions:
+        if "qualifiers" in condition:
+            if "qualifierintensityreference" in condition["qualifiers"]:
+                reference_conditions.append(condition)
+                continue
+        nonreference_conditions.append(condition)
+
+    return reference_conditions + nonreference_conditions
+
+def _describe_scan_conditions(all_conditions):
+    scan_condition_list = []
     for condition in all_conditions:
-        if not condition["conditiontype"] == "filter":
-            continue
+        if condition["conditiontype"] == "where" and condition["type"] in SCAN_CONDITION_TYPES:
+            scan_condition_list.append("{} {}".format(condition["type"].replace("condition", ""), msql_engine_profile.describe_condition(condition)))
+
+    if len(scan_condition_list) == 0:
+        return None
 
-        # filtering MS1 peaks
+    return ", ".join(scan_condition_list)
+
+def _executefiltercondition_query(condition, ms1_df, ms2_df):
+    """
+    Applies a single FILTER condition, this keeps the scans but removes the peaks
+
+    Args:
+        condition ([type]): [description]
+        ms1_df ([type]): [description]
+        ms2_df ([type]): [description]
+
+    Returns:
+        ms1_df ([type]): [description]
+        ms2_df ([type]): [description]
+    """
+    if "value" in condition and len(condition["value"]) == 0:
         if condition["type"] == "ms1mzcondition":
-            if len(ms1_df) == 0:
-                continue
+            ms1_df = pd.DataFrame()
+        if condition["type"] == "ms2productcondition":
+            ms2_df = pd.DataFrame()
+        return ms1_df, ms2_df
+
+    # filtering MS1 peaks
+    if condition["type"] == "ms1mzcondition":
+        if len(ms1_df) == 0:
+            return ms1_df, ms2_df
+
+        # Applying the filters
+        ms1_df = msql_engine_filters.ms1_filter(condition, ms1_df)
+        return ms1_df, ms2_df
+    
+    if condition["type"] == "ms2productcondition":
+        if len(ms2_df) == 0:
+            return ms1_df, ms2_df
 
-            # Applying the filters
-            ms1_df = msql_engine_filters.ms1_filter(condition, ms1_df)
+        # TODO: Refactor into a function
+
+        mz = float(condition["value"][0])
+        mz_tol = _get_mz_tolerance(condition.get("qualifiers", None), mz)
+        mz_min = mz - mz_tol
+        mz_max = mz + mz_tol
+
+        min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
+
+        ms2_df = ms2_df[(ms2_df["mz"] > mz_min) & 
+                        (ms2_df["mz"] < mz_max) & 
+                        (ms2_df["i"] > min_int) & 
+                        (ms2_df["i_norm"] > min_intpercent) & 
+                        (ms2_df["i_tic_norm"] > min_tic_percent_intensity)]
+
+    return ms1_df, ms2_df
+
+def _executeconditions_query(parsed_dict, input_filename, ms1_input_df=None, ms2_input_df=None, cache=True, shared_plan=None, profile=None):
+    # This function attempts to find the data that the query specifies in the conditions
+    # shared_plan is a dictionary holding intermediate results that can be reused between queries on the same data
+    # profile is a msql_engine_profile.QueryProfile, when given each condition is recorded as an operator
+    
+    #import json
+    #print("parsed_dict", json.dumps(parsed_dict, indent=4))
+
+    # Let's apply this to real data
+    if ms1_input_df is None and ms2_input_df is None:
+        ms1_df, ms2_df = msql_fileloading.load_data(input_filename, cache=cache)
+    else:
+        ms1_df = ms1_input_df
+        ms2_df = ms2_input_df
+
+    # In order to handle intensities, we will make sure to sort all conditions with 
+    # with the conditions that are the reference intensity first, then subsequent conditions
+    # that have an intensity match will reference the saved reference intensities
+    reference_conditions_register = {} # This will hold all the reference intensity values
+    
+    all_conditions = _sort_reference_conditions(parsed_dict["conditions"])
+
+    # These are for the WHERE clause, first lets filter by RT and polarity and scan
+    with msql_engine_profile.operator(profile, "scan filters", detail=_describe_scan_conditions(all_conditions) if profile is not None else None, ms1_df=ms1_df, ms2_df=ms2_df) as profile_node:
+        ms1_df, ms2_df, scans_key = _executescanconditions_query(all_conditions, ms1_df, ms2_df, shared_plan=shared_plan)
+        profile_node.set_output(ms1_df=ms1_df, ms2_df=ms2_df)
+
+    # Sorted indices over the scan filtered data, these are shared between queries
+    ms1_index = _get_shared_index(shared_plan, scans_key, 1, ms1_df)
+    ms2_index = _get_shared_index(shared_plan, scans_key, 2, ms2_df)
+
+    # Conditions applied so far, this is the key into the shared plan. Sharing stops at the first condition that involves the intensity register
+    # and for concrete variable queries, since their conditions differ for every value of X
+    shared_conditions = [] if shared_plan is not None and not "comment" in parsed_dict else None
+
+    # These are for the WHERE clause for peaks
+    for condition_index, condition in enumerate(all_conditions):
+        if not condition["conditiontype"] == "where":
+            continue
+
+        if condition["type"] in SCAN_CONDITION_TYPES:
             continue
-        
-        if condition["type"] == "ms2productcondition":
-            if len(ms2_df) == 0:
-                continue
 
-            # TODO: Refactor into a function
+        with msql_engine_profile.operator(profile, "where " + condition["type"], key=condition_index, condition=condition, ms1_df=ms1_df, ms2_df=ms2_df) as profile_node:
+            shared_result = False
+            if shared_conditions is not None:
+                if "qualifierintensityreference" in condition.get("qualifiers", {}) or "qualifierintensitymatch" in condition.get("qualifiers", {}):
+                    shared_conditions = None
+                else:
+                    shared_conditions.append(condition)
+                    shared_key = ("peaks", scans_key, _canonical_key(shared_conditions))
 
-            mz = float(condition["value"][0])
-            mz_tol = _get_mz_tolerance(condition.get("qualifiers", None), mz)
-            mz_min = mz - mz_tol
-            mz_max = mz + mz_tol
+                    if shared_key in shared_plan:
+                        ms1_df, ms2_df = [shared_df.copy(deep=False) for shared_df in shared_plan[shared_key]]
+                        shared_result = True
+                        profile_node.add("shared", 1)
 
-            min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
+            if not shared_result:
+                ms1_df, ms2_df = _executepeakcondition_query(condition, ms1_df, ms2_df, reference_conditions_register, ms1_index=ms1_index, ms2_index=ms2_index)
+
+                if shared_conditions is not None:
+                    shared_plan[shared_key] = (ms1_df, ms2_df)
+                    ms1_df, ms2_df = ms1_df.copy(deep=False), ms2_df.copy(deep=False)
+
+            profile_node.set_output(ms1_df=ms1_df, ms2_df=ms2_df)
+
+    # These are for the FILTER clause
+    for condition_index, condition in enumerate(all_conditions):
+        if not condition["conditiontype"] == "filter":
+            continue
 
-            ms2_df = ms2_df[(ms2_df["mz"] > mz_min) & 
-                            (ms2_df["mz"] < mz_max) & 
-                            (ms2_df["i"] > min_int) & 
-                            (ms2_df["i_norm"] > min_intpercent) & 
-                            (ms2_df["i_tic_norm"] > min_tic_percent_intensity)]
+        with msql_engine_profile.operator(profile, "filter " + condition["type"], key=condition_index, condition=condition, ms1_df=ms1_df, ms2_df=ms2_df) as profile_node:
+            ms1_df, ms2_df = _executefiltercondition_query(condition, ms1_df, ms2_df)
+            profile_node.set_output(ms1_df=ms1_df, ms2_df=ms2_df)
 
     if "comment" in parsed_dict:
+        # Shallow copies, the data might be shared with other queries
+        ms1_df = ms1_df.copy(deep=False)
+        ms2_df = ms2_df.copy(deep=False)
         ms1_df["comment"] = parsed_dict["comment"]
         ms2_df["comment"] = parsed_dict["comment"]
 
     return ms1_df, ms2_df
 
+def _collate_scan_intensity(ms_df, groupby_columns, intensity_function):
+    """
+    Collapses each group to its first peak, with the intensity aggregated over the group, in a single groupby
+
+    Args:
+        ms_df ([type]): [description]
+        groupby_columns ([type]): [description]
+        intensity_function ([type]): sum or max
+
+    Returns:
+        [type]: data frame with the groupby columns first, then the rest of the columns in their original order
+    """
+    aggregations = {column : (column, "first") for column in ms_df.columns if not column in groupby_columns}
+    aggregations["i"] = ("i", intensity_function)
+
+    return ms_df.groupby(groupby_columns).agg(**aggregations).reset_index()
+
+def _collate_scaninfo(ms_df, groupby_columns, kept_columns):
+    """
+    Summarizes each scan for scaninfo in a single groupby, the first value of kept_columns, the summed i and the max i_norm
+
+    Args:
+        ms_df ([type]): [description]
+        groupby_columns ([type]): [description]
+        kept_columns ([type]): [description]
+
+    Returns:
+        [type]: data frame with kept_columns, i and i_norm
+    """
+    aggregations = {column : (column, "first") for column in kept_columns if not column in groupby_columns}
+    aggregations["i"] = ("i", "sum")
+    aggregations["i_norm"] = ("i_norm", "max")
+
+    result_df = ms_df.groupby(groupby_columns).agg(**aggregations).reset_index()
+
+    return result_df[kept_columns + ["i", "i_norm"]]
+
 def _executecollate_query(parsed_dict, ms1_df, ms2_df):
     # This function takes the dataframes from executing the conditions and returns the proper formatted version
 
@@ -563,22 +1084,12 @@ def _executecollate_query(parsed_dict, ms1_df, ms2_df):
                 if len(ms1_df) == 0:
                     return ms1_df
 
-                ms1sum_df = ms1_df.groupby("scan").sum().reset_index()
-
-                ms1_df = ms1_df.groupby("scan").first().reset_index()
-                ms1_df["i"] = ms1sum_df["i"]
-
-                return ms1_df
+                return _collate_scan_intensity(ms1_df, ["scan"], "sum")
             if parsed_dict["querytype"]["datatype"] == "datams2data":
                 if len(ms2_df) == 0:
                     return ms2_df
 
-                ms2sum_df = ms2_df.groupby("scan").sum().reset_index()
-                
-                ms2_df = ms2_df.groupby("scan").first().reset_index()
-                ms2_df["i"] = ms2sum_df["i"]
-
-                return ms2_df
+                return _collate_scan_intensity(ms2_df, ["scan"], "sum")
 
         if parsed_dict["querytype"]["function"] == "functionscanmz":
             if len(ms2_df) == 0:
@@ -616,14 +1127,8 @@ def _executecollate_query(parsed_dict, ms1_df, ms2_df):
                 if "mobility" in ms1_df:
                     kept_columns.append("mobility")
 
-                result_df = ms1_df.groupby(groupby_columns).first().reset_index()
-                result_df = result_df[kept_columns]
-                result_df["mslevel"] = 1
-
-                ms1sum_df = ms1_df.groupby(groupby_columns).sum().reset_index()
-                ms1norm_df = ms1_df.groupby(groupby_columns).max().reset_index()
-                result_df["i"] = ms1sum_df["i"]
-                result_df["i_norm"] = ms1norm_df["i_norm"]
+                result_df = _collate_scaninfo(ms1_df, groupby_columns, kept_columns)
+                result_df.insert(len(kept_columns), "mslevel", 1)
             if parsed_dict["querytype"]["datatype"] == "datams2data":
                 if len(ms2_df) == 0:
                     return pd.DataFrame()
@@ -638,19 +1143,12 @@ def _executecollate_query(parsed_dict, ms1_df, ms2_df):
                 if "mobility" in ms2_df:
                     kept_columns.append("mobility")
 
-                result_df = ms2_df.groupby(groupby_columns).first().reset_index()
-                result_df = result_df[kept_columns]
-
-                ms2sum_df = ms2_df.groupby(groupby_columns).sum().reset_index()
-                ms2norm_df = ms2_df.groupby(groupby_columns).max().reset_index()
-
-                result_df["i"] = ms2sum_df["i"]
-                result_df["i_norm"] = ms2norm_df["i_norm"]
+                result_df = _collate_scaninfo(ms2_df, groupby_columns, kept_columns)
                 result_df["mslevel"] = 2
 
                 # Calculating the MS1 i_norm and then joining on the ms1scan
                 try:
-                    ms1norm_df = ms1_df.groupby(groupby_columns).max().reset_index()
+                    ms1norm_df = ms1_df.groupby(groupby_columns)["i_norm"].max().reset_index()
                     ms1norm_df["ms1scan"] = ms1norm_df["scan"]
                     ms1norm_df["i_norm_ms1"] = ms1norm_df["i_norm"]
                     ms1norm_df = ms1norm_df[["ms1scan", "i_norm_ms1"]]
@@ -661,32 +1159,37 @@ def _executecollate_query(parsed_dict, ms1_df, ms2_df):
             return result_df
 
         if parsed_dict["querytype"]["function"] == "functionscanrangesum":
-            result_list = []
-
             if parsed_dict["querytype"]["datatype"] == "datams1data":
-                ms1_df["bin"] = ms1_df["mz"].apply(lambda x: int(x / 0.1))
-                all_bins = set(ms1_df["bin"])
+                if len(ms1_df) == 0:
+                    return ms1_df
 
-                for bin in all_bins:
-                    ms1_filtered_df = ms1_df[ms1_df["bin"] == bin]
-                    ms1sum_df = ms1_filtered_df.groupby("scan").sum().reset_index()
+                # Summing each scan within 0.1 m/z bins, bins come out in ascending order
+                ms1_df = ms1_df.assign(bin=(ms1_df["mz"] / 0.1).astype(int))
+                result_df = _collate_scan_intensity(ms1_df, ["bin", "scan"], "sum")
 
-                    ms1_filtered_df = (
-                        ms1_filtered_df.groupby("scan").first().reset_index()
-                    )
-                    ms1_filtered_df["i"] = ms1sum_df["i"]
+                return result_df[["scan"] + [column for column in ms1_df.columns if column != "scan"]]
+            if parsed_dict["querytype"]["datatype"] == "datams2data":
+                if len(ms2_df) == 0:
+                    return ms2_df
 
-                    result_list.append(ms1_filtered_df)
+                # Summing each scan, the summed intensity stays on the row of its scan
+                return ms2_df.groupby("scan", as_index=False).sum()
 
-                return pd.concat(result_list)
+        if parsed_dict["querytype"]["function"] == "functionexists":
+            # One row saying we found something, with the first scan that matched
+            if parsed_dict["querytype"]["datatype"] == "datams1data":
+                ms_df = ms1_df
             if parsed_dict["querytype"]["datatype"] == "datams2data":
-                ms2_df = ms2_df.groupby("scan").sum()
+                ms_df = ms2_df
 
-                ms2sum_df = ms2_df.groupby("scan").sum()
-                ms2_df = ms2_df.groupby("scan").first().reset_index()
-                ms2_df["i"] = ms2sum_df["i"]
+            if len(ms_df) == 0:
+                return pd.DataFrame()
 
-                return ms2_df
+            result_df = pd.DataFrame()
+            result_df["scan"] = [ms_df["scan"].min()]
+            result_df["exists"] = [1]
+
+            return result_df
 
         if parsed_dict["querytype"]["function"] == "functionscanmaxint":
             # This is the biggest peak in the spectrum
@@ -695,21 +1198,11 @@ def _executecollate_query(parsed_dict, ms1_df, ms2_df):
                 if len(ms1_df) == 0:
                     return ms1_df
 
-                ms1sum_df = ms1_df.groupby("scan").max().reset_index()
-
-                ms1_df = ms1_df.groupby("scan").first().reset_index()
-                ms1_df["i"] = ms1sum_df["i"]
-
-                return ms1_df
+                return _collate_scan_intensity(ms1_df, ["scan"], "max")
             if parsed_dict["querytype"]["datatype"] == "datams2data":
                 if len(ms2_df) == 0:
                     return ms2_df
 
-                ms2sum_df = ms2_df.groupby("scan").max().reset_index()
-                
-                ms2_df = ms2_df.groupby("scan").first().reset_index()
-                ms2_df["i"] = ms2sum_df["i"]
-
-                return ms2_df
+                return _collate_scan_intensity(ms2_df, ["scan"], "max")
 
         print("APPLYING FUNCTION")    
@@ -0,0 +1,206 @@
+import os
+import json
+import hashlib
+import uuid
+
+import pandas as pd
+
+# Bump this when the engine changes what a query returns, so older cached results are not used
+CACHE_VERSION = 1
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+CACHE_EXTENSION = ".msql_result.feather"
+
+def _get_engine_version():
+    try:
+        from importlib import metadata
+        engine_version = metadata.version("massql")
+    except Exception:
+        engine_version = None
+
+    return "{}-{}".format(engine_version, CACHE_VERSION)
+
+ENGINE_VERSION = _get_engine_version()
+
+# Fingerprints are kept per path, size and modification time so we only hash a file once
+_file_fingerprints = {}
+
+def file_fingerprint(input_filename):
+    """
+    Hash of the contents of the file
+
+    Args:
+        input_filename ([type]): [description]
+
+    Returns:
+        [type]: hex digest
+    """
+    file_stat = os.stat(input_filename)
+    stat_key = (os.path.abspath(input_filename), file_stat.st_size, file_stat.st_mtime_ns)
+
+    if not stat_key in _file_fingerprints:
+        file_hash = hashlib.sha256()
+        with open(input_filename, "rb") as input_file:
+            for block in iter(lambda: input_file.read(1024 * 1024), b""):
+                file_hash.update(block)
+        _file_fingerprints[stat_key] = file_hash.hexdigest()
+
+    return _file_fingerprints[stat_key]
+
+def canonical_query(parsed_dict):
+    """
+    Normalizes the parsed query, the original text is dropped so whitespace and comments do not matter,
+    and conditions are sorted so their order does not matter
+
+    Args:
+        parsed_dict ([type]): [description]
+
+    Returns:
+        [type]: json string
+    """
+    def _normalize(obj):
+        if isinstance(obj, dict):
+            return {key : _normalize(value) for key, value in obj.items() if key != "query"}
+        if isinstance(obj, list):
+            return [_normalize(value) for value in obj]
+        return obj
+
+    normalized_dict = _normalize(parsed_dict)
+    normalized_dict["conditions"] = sorted(normalized_dict["conditions"], key=lambda condition: json.dumps(condition, sort_keys=True))
+
+    return json.dumps(normalized_dict, sort_keys=True)
+
+class ResultCache(object):
+    """
+    Query results on disk as feather files, keyed by the canonical query, the contents of the input file,
+    the backend and the engine version. The least recently used results are removed once the cache is over max_bytes.
+
+    The cache directory can be shared by several processes, the modification time of each file is its last use.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def query_key(self, parsed_dict, input_filename, backend="pandas"):
+        """
+        Args:
+            parsed_dict ([type]): parsed query, before it is executed
+            input_filename ([type]): [description]
+            backend (str, optional): [description]. Defaults to "pandas". The backends order scanmz and scannum differently, so their results are kept apart
+
+        Returns:
+            [type]: key for get and put
+        """
+        key_dict = {}
+        key_dict["query"] = canonical_query(parsed_dict)
+        key_dict["file"] = file_fingerprint(input_filename)
+        key_dict["version"] = ENGINE_VERSION
+        key_dict["backend"] = backend
+
+        return hashlib.sha256(json.dumps(key_dict, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_EXTENSION)
+
+    def get(self, key):
+        """
+        Args:
+            key ([type]): [description]
+
+        Returns:
+            [type]: results data frame, None when it is not cached
+        """
+        cache_path = self._get_path(key)
+
+        try:
+            results_df = pd.read_feather(cache_path)
+            os.utime(cache_path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return results_df
+
+    def put(self, key, results_df):
+        """
+        Saves the results, the index is not kept
+
+        Args:
+            key ([type]): [description]
+            results_df ([type]): [description]
+        """
+        cache_path = self._get_path(key)
+        temp_path = "{}.{}.tmp".format(cache_path, uuid.uuid4().hex)
+
+        import pyarrow
+        from pyarrow import feather
+
+        try:
+            feather.write_feather(pyarrow.Table.from_pandas(results_df, preserve_index=False), temp_path)
+            os.replace(temp_path, cache_path)
+        except Exception:
+            # Some results cannot be written with arrow, e.g. mixed types, we just do not cache these
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        self._evict()
+
+    def _list_entries(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(CACHE_EXTENSION):
+                continue
+            try:
+                entry_stat = entry.stat()
+            except OSError:
+                # Removed by another process
+                continue
+            entries.append((entry_stat.st_mtime_ns, entry_stat.st_size, entry.path))
+
+        return entries
+
+    def _evict(self):
+        entries = self._list_entries()
+        total_bytes = sum(entry_size for _, entry_size, _ in entries)
+
+        for _, entry_size, entry_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            total_bytes -= entry_size
+            self.evictions += 1
+
+    def clear(self):
+        for _, _, entry_path in self._list_entries():
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+
+    def stats(self):
+        """
+        Returns:
+            [type]: hits, misses and evictions of this cache object, and the entries and bytes currently on disk
+        """
+        entries = self._list_entries()
+
+        stats_dict = {}
+        stats_dict["hits"] = self.hits
+        stats_dict["misses"] = self.misses
+        stats_dict["evictions"] = self.evictions
+        stats_dict["entries"] = len(entries)
+        stats_dict["bytes"] = sum(entry_size for _, entry_size, _ in entries)
+
+        return stats_dict
@@ -0,0 +1,602 @@
+"""
+DuckDB backend, the conditions of a parsed query are compiled to SQL and run by an embedded DuckDB over the Arrow data
+of the feather cache, so filtering and collating are multi-threaded and vectorized.
+
+The WHERE conditions narrow down the scans one condition at a time like the pandas engine, every step is a SQL statement
+that writes the scans that are left into a temporary table. The peaks are only read again for the FILTER conditions and
+the collate function at the end.
+"""
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+
+from massql import msql_engine_filters
+from massql import msql_engine_results
+from massql import msql_engine_summary
+from massql import msql_fileloading
+
+# Columns every level needs to compile, used for data without any peaks of a level
+EMPTY_COLUMNS = {"i" : "DOUBLE", "i_norm" : "DOUBLE", "i_tic_norm" : "DOUBLE", "mz" : "DOUBLE", "scan" : "BIGINT",
+                    "rt" : "DOUBLE", "polarity" : "BIGINT", "precmz" : "DOUBLE", "ms1scan" : "BIGINT", "charge" : "BIGINT"}
+
+# Position of the peak in the loaded data, keeps the results in the order of the pandas engine
+ROW_COLUMN = "_row"
+
+SUPPORTED_FUNCTIONS = [None, "functionscaninfo", "functionscansum", "functionscanmaxint", "functionscannum", "functionscanmz",
+                        "functionexists", "functionscanrangesum"]
+
+def unsupported_reason(parsed_dict):
+    """
+    Checks if the query can be compiled to SQL, everything else runs with the pandas engine
+
+    Args:
+        parsed_dict ([type]): [description]
+
+    Returns:
+        [type]: what is not supported, None when the whole query is
+    """
+    if not parsed_dict["querytype"]["function"] in SUPPORTED_FUNCTIONS:
+        return "function {}".format(parsed_dict["querytype"]["function"])
+
+    for condition in parsed_dict["conditions"]:
+        if condition["type"] == "xcondition":
+            return "variables"
+
+        qualifiers = condition.get("qualifiers", {})
+        if "qualifierintensitymatch" in qualifiers or "qualifierintensityreference" in qualifiers:
+            return "intensity matching"
+
+        # Polarity is the only condition with names as values
+        if condition["type"] == "polaritycondition":
+            if not condition["value"][0] in msql_engine_summary.POLARITY_CODES:
+                return "polarity {}".format(condition["value"][0])
+            continue
+
+        for value in condition.get("value", []):
+            if isinstance(value, dict) and "querytype" in value:
+                subquery_reason = unsupported_reason(value)
+                if subquery_reason is not None:
+                    return subquery_reason
+            elif isinstance(value, str) and "X" in value:
+                return "variables"
+            elif isinstance(value, str) and value != "ANY":
+                return "value {}".format(value)
+
+        if condition["conditiontype"] == "filter" and condition["type"] == "ms2productcondition" and "ANY" in condition.get("value", []):
+            return "FILTER MS2PROD=ANY"
+
+    return None
+
+def _sql_float(value):
+    # Plain decimals are DECIMAL in DuckDB, the repr of a float goes back to exactly the same double
+    return "CAST('{!r}' AS DOUBLE)".format(float(value))
+
+def _quote(column):
+    return '"{}"'.format(column)
+
+class _Compiler(object):
+    """
+    Holds the connection and names the temporary tables, subqueries share it so their tables do not collide
+    """
+    def __init__(self, connection, columns, linked=True):
+        self.connection = connection
+        self.columns = columns      # level -> columns of the loaded data
+        self.linked = linked        # False when the MS1 scans and the ms1scan of MS2 scans cannot be equal, e.g. text and numbers
+        self._counter = itertools.count()
+
+    def link(self, column, select_sql):
+        if not self.linked:
+            return "FALSE"
+        return "{} IN ({})".format(column, select_sql)
+
+    def name(self, prefix):
+        return "{}_{}".format(prefix, next(self._counter))
+
+    def execute(self, sql):
+        return self.connection.execute(sql)
+
+    def count(self, table):
+        return self.execute("SELECT count(*) FROM {}".format(table)).fetchone()[0]
+
+    def windows_table(self, min_values, max_values, values=None):
+        # Registered as a table, so any number of values is one range join
+        windows_df = pd.DataFrame({"lo" : np.asarray(min_values, dtype=float), "hi" : np.asarray(max_values, dtype=float)})
+        if values is not None:
+            windows_df["v"] = np.asarray(values, dtype=float)
+
+        table_name = self.name("windows")
+        self.connection.register(table_name + "_df", windows_df)
+        self.execute("CREATE TEMP TABLE {} AS SELECT * FROM {}_df".format(table_name, table_name))
+        self.connection.unregister(table_name + "_df")
+
+        return table_name
+
+def _intensity_sql(qualifiers, alias="p"):
+    min_int, min_intpercent, min_tic_percent_intensity = msql_engine_filters._get_minintensity(qualifiers)
+
+    return "{alias}.i > {} AND {alias}.i_norm > {} AND {alias}.i_tic_norm > {}".format(
+        _sql_float(min_int), _sql_float(min_intpercent), _sql_float(min_tic_percent_intensity), alias=alias)
+
+def _defect_sql(column, qualifiers, alias="p"):
+    massdefect_min, massdefect_max = msql_engine_filters._get_massdefect_min(qualifiers)
+    defect = "({alias}.{column} - trunc({alias}.{column}))".format(alias=alias, column=column)
+
+    return "{defect} > {} AND {defect} < {}".format(_sql_float(massdefect_min), _sql_float(massdefect_max), defect=defect)
+
+def _has_massdefect(qualifiers):
+    massdefect_min, massdefect_max = msql_engine_filters._get_massdefect_min(qualifiers)
+    return massdefect_min > 0 or massdefect_max < 1
+
+def _base_views(compiler, all_conditions):
+    """
+    Views of the peaks that pass the scan filters, RT, polarity, scan, charge and mobility
+
+    Returns:
+        [type]: names of the MS1 and MS2 views
+    """
+    predicates = {"ms1" : [], "ms2" : []}
+
+    for condition in all_conditions:
+        if not condition["conditiontype"] == "where":
+            continue
+
+        if condition["type"] == "rtmincondition":
+            for level in predicates:
+                predicates[level].append("rt > {}".format(_sql_float(condition["value"][0])))
+
+        if condition["type"] == "rtmaxcondition":
+            for level in predicates:
+                predicates[level].append("rt < {}".format(_sql_float(condition["value"][0])))
+
+        if condition["type"] == "polaritycondition":
+            polarity_code = msql_engine_summary.POLARITY_CODES.get(condition["value"][0], None)
+            if polarity_code is not None:
+                for level in predicates:
+                    predicates[level].append("polarity = {}".format(polarity_code))
+
+        if condition["type"] == "scanmincondition":
+            for level in predicates:
+                predicates[level].append("scan >= {}".format(int(condition["value"][0])))
+
+        if condition["type"] == "scanmaxcondition":
+            for level in predicates:
+                predicates[level].append("scan <= {}".format(int(condition["value"][0])))
+
+        if condition["type"] == "chargecondition":
+            predicates["ms2"].append("charge = {}".format(int(condition["value"][0])))
+
+            # MS1 scans of the MS2 scans left at this point
+            predicates["ms1"].append(compiler.link("scan", "SELECT ms1scan FROM ms2 WHERE {}".format(" AND ".join(predicates["ms2"]))))
+
+        if condition["type"] == "mobilitycondition":
+            for level in predicates:
+                if "mobility" in compiler.columns[level]:
+                    predicates[level].append("mobility >= {} AND mobility <= {}".format(_sql_float(condition["min"]), _sql_float(condition["max"])))
+
+    view_names = []
+    for level in ["ms1", "ms2"]:
+        view_name = compiler.name(level + "_base")
+        where_sql = " AND ".join("({})".format(predicate) for predicate in predicates[level]) if len(predicates[level]) > 0 else "TRUE"
+        compiler.execute("CREATE TEMP VIEW {} AS SELECT * FROM {} WHERE {}".format(view_name, level, where_sql))
+        view_names.append(view_name)
+
+    return view_names
+
+def _matched_scans_sql(compiler, condition, level, peaks_sql, max_precmz=None):
+    """
+    SQL for the scans with a peak that matches the condition
+
+    Args:
+        compiler ([type]): [description]
+        condition ([type]): [description]
+        level ([type]): ms1 or ms2
+        peaks_sql ([type]): peaks to look in
+        max_precmz ([type], optional): [description]. Defaults to None. Highest precursor of the scan filtered data, for neutral losses with a ppm tolerance
+
+    Returns:
+        [type]: SQL selecting a scan column
+    """
+    qualifiers = condition.get("qualifiers", None)
+    numeric_values = [value for value in condition["value"] if not isinstance(value, str)]
+
+    select_list = []
+
+    if "ANY" in condition["value"]:
+        if condition["type"] == "ms2precursorcondition":
+            select_list.append("SELECT DISTINCT p.scan FROM ({}) p WHERE {}".format(peaks_sql, _defect_sql("precmz", qualifiers)))
+        else:
+            # The mass defect of neutral losses is the one of the product ion, like the pandas engine
+            select_list.append("SELECT DISTINCT p.scan FROM ({}) p WHERE {} AND {}".format(peaks_sql, _defect_sql("mz", qualifiers), _intensity_sql(qualifiers)))
+
+    if len(numeric_values) > 0:
+        numeric_condition = dict(condition, value=numeric_values)
+
+        if condition["type"] == "ms2neutrallosscondition" and qualifiers is not None and "qualifierppmtolerance" in qualifiers:
+            # The ppm tolerance is on the product ion, the window at the highest precursor holds the others
+            ppm = qualifiers["qualifierppmtolerance"]["value"]
+            nl_values = np.asarray(numeric_values, dtype=float)
+            nl_tolerances = np.array([abs(ppm * (max_precmz - nl) / 1000000) for nl in nl_values])
+            windows_table = compiler.windows_table(nl_values - nl_tolerances, nl_values + nl_tolerances, values=nl_values)
+
+            match_sql = "(p.precmz - p.mz) > w.lo AND (p.precmz - p.mz) < w.hi AND abs(p.mz - (p.precmz - w.v)) < abs({} * (p.precmz - w.v) / 1000000)".format(_sql_float(ppm))
+        else:
+            min_values, max_values = msql_engine_filters._get_tolerance_windows(numeric_condition)
+            windows_table = compiler.windows_table(min_values, max_values)
+
+            column = {"ms1mzcondition" : "p.mz", "ms2productcondition" : "p.mz", "ms2precursorcondition" : "p.precmz",
+                        "ms2neutrallosscondition" : "(p.precmz - p.mz)"}[condition["type"]]
+            match_sql = "{column} > w.lo AND {column} < w.hi".format(column=column)
+
+        if condition["type"] != "ms2precursorcondition":
+            match_sql += " AND " + _intensity_sql(qualifiers)
+
+        if condition["type"] == "ms1mzcondition" and _has_massdefect(qualifiers):
+            match_sql += " AND " + _defect_sql("mz", qualifiers)
+
+        select_list.append("SELECT DISTINCT p.scan FROM ({}) p JOIN {} w ON {}".format(peaks_sql, windows_table, match_sql))
+
+    return " UNION ".join(select_list)
+
+def _scans_sql(scans_table):
+    return "SELECT scan FROM {}".format(scans_table)
+
+def _peaks_sql(base_view, scans_table):
+    return "SELECT * FROM {} WHERE scan IN ({})".format(base_view, _scans_sql(scans_table))
+
+def _new_scans_table(compiler, prefix, select_sql):
+    table_name = compiler.name(prefix)
+    compiler.execute("CREATE TEMP TABLE {} AS {}".format(table_name, select_sql))
+    return table_name
+
+def _execute_peak_condition(compiler, condition, state, base_views, max_precmz):
+    """
+    Narrows down the scans of state with a WHERE peak condition, the same way as msql_engine_filters
+
+    Args:
+        compiler ([type]): [description]
+        condition ([type]): [description]
+        state ([type]): scans tables and flags of each level, edited in place
+        base_views ([type]): [description]
+        max_precmz ([type]): [description]
+    """
+    exclusion_flag = msql_engine_filters._get_exclusion_flag(condition.get("qualifiers", None))
+
+    # Nothing to match against, e.g. a subquery without results
+    if len(condition["value"]) == 0:
+        if not exclusion_flag:
+            _set_empty(compiler, state)
+        return
+
+    level = "ms1" if condition["type"] == "ms1mzcondition" else "ms2"
+    other_level = "ms2" if level == "ms1" else "ms1"
+    level_index = 0 if level == "ms1" else 1
+
+    if state[level]["count"] == 0:
+        return
+
+    matched_sql = _matched_scans_sql(compiler, condition, level, _peaks_sql(base_views[level_index], state[level]["scans"]), max_precmz=max_precmz)
+    if exclusion_flag:
+        matched_sql = "SELECT scan FROM {} WHERE scan NOT IN ({})".format(state[level]["scans"], matched_sql)
+
+    level_scans = _new_scans_table(compiler, level + "_scans", "SELECT DISTINCT scan FROM ({})".format(matched_sql))
+    if compiler.count(level_scans) == 0:
+        _set_empty(compiler, state)
+        return
+
+    # The scans of the other level are the ones linked to the scans left
+    if level == "ms2":
+        other_sql = "SELECT scan FROM {} WHERE {}".format(state[other_level]["scans"],
+            compiler.link("scan", "SELECT ms1scan FROM {} WHERE scan IN ({})".format(base_views[1], _scans_sql(level_scans))))
+    else:
+        other_sql = "SELECT scan FROM {} WHERE scan IN (SELECT scan FROM {} WHERE {})".format(state[other_level]["scans"],
+            base_views[1], compiler.link("ms1scan", _scans_sql(level_scans)))
+
+    state[level]["scans"] = level_scans
+    state[level]["count"] = compiler.count(level_scans)
+    state[other_level]["scans"] = _new_scans_table(compiler, other_level + "_scans", other_sql)
+    state[other_level]["count"] = compiler.count(state[other_level]["scans"])
+
+def _set_empty(compiler, state):
+    # The pandas engine gives back data frames without columns here
+    for level in ["ms1", "ms2"]:
+        state[level]["scans"] = _new_scans_table(compiler, level + "_scans", "SELECT scan FROM {} WHERE FALSE".format(state[level]["scans"]))
+        state[level]["count"] = 0
+        state[level]["no_columns"] = True
+
+def _filter_peaks_sql(condition, peaks_sql):
+    """
+    SQL of the peaks kept by a FILTER condition, the filter of every value adds its peaks, a peak can be there more than once
+
+    Returns:
+        [type]: SQL of the peaks, with a part column ordering the peaks by the value that kept them
+    """
+    qualifiers = condition.get("qualifiers", None)
+
+    # Only the first value of MS2PROD is used as a filter
+    values = condition["value"] if condition["type"] == "ms1mzcondition" else condition["value"][:1]
+
+    part_list = []
+    for part, value in enumerate(values):
+        if value == "ANY":
+            part_list.append("SELECT p.*, {} AS part FROM ({}) p WHERE {} AND {}".format(part, peaks_sql, _defect_sql("mz", qualifiers), _intensity_sql(qualifiers)))
+            continue
+
+        mz_tol = msql_engine_filters._get_mz_tolerance(qualifiers, value)
+        match_sql = "p.mz > {} AND p.mz < {} AND {}".format(_sql_float(value - mz_tol), _sql_float(value + mz_tol), _intensity_sql(qualifiers))
+
+        if condition["type"] == "ms1mzcondition" and _has_massdefect(qualifiers):
+            match_sql += " AND " + _defect_sql("mz", qualifiers)
+
+        part_list.append("SELECT p.*, {} AS part FROM ({}) p WHERE {}".format(part, peaks_sql, match_sql))
+
+    return " UNION ALL ".join(part_list)
+
+def _collate_sql(parsed_dict, level, peaks_sql, columns, order_columns, ms1_peaks_sql=None):
+    """
+    SQL of the collate function, the columns and their order are the ones of msql_engine._executecollate_query
+
+    Returns:
+        [type]: SQL, None for functions that are collated by the pandas engine
+    """
+    function = parsed_dict["querytype"]["function"]
+    order_sql = ", ".join(order_columns)
+
+    def _first(column):
+        return "first({column} ORDER BY {order_sql}) FILTER (WHERE {column} IS NOT NULL) AS {column}".format(column=_quote(column), order_sql=order_sql)
+
+    if function is None:
+        return "SELECT {} FROM ({}) ORDER BY {}".format(", ".join(_quote(column) for column in columns), peaks_sql, order_sql)
+
+    if function in ["functionscansum", "functionscanmaxint"]:
+        aggregate = "sum" if function == "functionscansum" else "max"
+        select_list = ["scan"] + ["{}(i) AS i".format(aggregate) if column == "i" else _first(column) for column in columns if column != "scan"]
+        return "SELECT {} FROM ({}) GROUP BY scan ORDER BY scan".format(", ".join(select_list), peaks_sql)
+
+    if function == "functionscannum":
+        return "SELECT DISTINCT scan FROM ({}) ORDER BY scan".format(peaks_sql)
+
+    if function == "functionscanmz":
+        return "SELECT DISTINCT precmz FROM ({}) ORDER BY precmz".format(peaks_sql)
+
+    if function == "functionexists":
+        return "SELECT min(scan) AS scan, CAST(1 AS BIGINT) AS \"exists\" FROM ({})".format(peaks_sql)
+
+    if function == "functionscaninfo":
+        if level == "ms1":
+            kept_columns = ["scan", "rt"] + (["mobility"] if "mobility" in columns else [])
+            select_list = ["scan"] + [_first(column) for column in kept_columns[1:]] + ["CAST(1 AS BIGINT) AS mslevel", "sum(i) AS i", "max(i_norm) AS i_norm"]
+            return "SELECT {} FROM ({}) GROUP BY scan ORDER BY scan".format(", ".join(select_list), peaks_sql)
+
+        kept_columns = ["scan", "precmz", "ms1scan", "rt", "charge"] + (["mobility"] if "mobility" in columns else [])
+        select_list = ["scan"] + [_first(column) for column in kept_columns[1:]] + ["sum(i) AS i", "max(i_norm) AS i_norm", "CAST(2 AS BIGINT) AS mslevel"]
+        scaninfo_sql = "SELECT {} FROM ({}) GROUP BY scan".format(", ".join(select_list), peaks_sql)
+
+        if ms1_peaks_sql is None:
+            return scaninfo_sql + " ORDER BY scan"
+
+        # The highest MS1 i_norm of the MS1 scan of every MS2 scan
+        return "SELECT s.*, m.i_norm_ms1 FROM ({}) s LEFT JOIN (SELECT scan AS ms1scan, max(i_norm) AS i_norm_ms1 FROM ({}) GROUP BY scan) m USING (ms1scan) ORDER BY s.scan".format(
+            scaninfo_sql, ms1_peaks_sql)
+
+    return None
+
+def _read_table(feather_filename):
+    import pyarrow.feather
+
+    try:
+        return pyarrow.feather.read_table(feather_filename, memory_map=True)
+    except Exception:
+        return None
+
+def _load_tables(input_filename, cache=True, ms1_df=None, ms2_df=None):
+    """
+    Arrow tables of the data, read straight from the feather cache when there is one
+
+    Returns:
+        [type]: MS1 and MS2 pyarrow tables, None for a level without data
+    """
+    import pyarrow as pa
+
+    if ms1_df is None and cache and (os.path.exists(input_filename + "_ms1.msql.feather") or os.path.exists(input_filename + "_ms2.msql.feather")):
+        tables = [_read_table(input_filename + "_ms1.msql.feather"), _read_table(input_filename + "_ms2.msql.feather")]
+    else:
+        if ms1_df is None:
+            ms1_df, ms2_df = msql_fileloading.load_data(input_filename, cache=cache)
+        tables = [pa.Table.from_pandas(ms_df, preserve_index=False) if len(ms_df.columns) > 0 else None for ms_df in [ms1_df, ms2_df]]
+
+    return [table if table is not None and "scan" in table.column_names else None for table in tables]
+
+def _is_linked(tables):
+    import pyarrow as pa
+
+    if tables[0] is None or tables[1] is None or not "ms1scan" in tables[1].column_names:
+        return True
+
+    scan_type = tables[0].schema.field("scan").type
+    ms1scan_type = tables[1].schema.field("ms1scan").type
+    if pa.types.is_integer(scan_type) and pa.types.is_integer(ms1scan_type):
+        return True
+
+    return scan_type == ms1scan_type
+
+def _register_tables(connection, tables):
+    import pyarrow as pa
+
+    columns = {}
+    for level, table in zip(["ms1", "ms2"], tables):
+        if table is None:
+            connection.execute("CREATE TEMP TABLE {} ({}, {} BIGINT)".format(level, ", ".join("{} {}".format(_quote(column), column_type) for column, column_type in EMPTY_COLUMNS.items()), ROW_COLUMN))
+            columns[level] = []
+            continue
+
+        columns[level] = [column for column in table.column_names if column != ROW_COLUMN]
+        table = table.append_column(ROW_COLUMN, pa.array(np.arange(table.num_rows, dtype=np.int64)))
+
+        connection.register(level + "_arrow", table)
+        connection.execute("CREATE TEMP VIEW {} AS SELECT * FROM {}_arrow".format(level, level))
+
+    return columns
+
+def _evaluate_subqueries(compiler, parsed_dict):
+    # Subqueries run on the same data, their precursor m/z become the values of the condition
+    for condition in parsed_dict["conditions"]:
+        if not "value" in condition or len(condition["value"]) == 0:
+            continue
+
+        subquery_dict = condition["value"][0]
+        if not isinstance(subquery_dict, dict) or not "querytype" in subquery_dict:
+            continue
+
+        subquery_val_df = _collect_results(compiler, subquery_dict)
+
+        if "precmz" in subquery_val_df:
+            condition["value"] = np.sort(subquery_val_df["precmz"].to_numpy(dtype=float))
+        elif len(subquery_val_df) == 0:
+            condition["value"] = np.array([], dtype=float)
+        else:
+            raise Exception("SUBQUERY MUST RETURN PRECMZ")
+
+def _execute_query(compiler, parsed_dict):
+    from massql import msql_engine
+
+    _evaluate_subqueries(compiler, parsed_dict)
+
+    all_conditions = msql_engine._sort_reference_conditions(parsed_dict["conditions"])
+    base_views = _base_views(compiler, all_conditions)
+
+    state = {}
+    for level, base_view in zip(["ms1", "ms2"], base_views):
+        state[level] = {"no_columns" : len(compiler.columns[level]) == 0}
+        state[level]["scans"] = _new_scans_table(compiler, level + "_scans", "SELECT DISTINCT scan FROM {}".format(base_view))
+        state[level]["count"] = compiler.count(state[level]["scans"])
+
+    max_precmz = compiler.execute("SELECT max(precmz) FROM {}".format(base_views[1])).fetchone()[0]
+
+    # WHERE
+    for condition in all_conditions:
+        if not condition["conditiontype"] == "where" or condition["type"] in msql_engine.SCAN_CONDITION_TYPES:
+            continue
+
+        _execute_peak_condition(compiler, condition, state, base_views, max_precmz)
+
+    # FILTER, these keep the scans but remove peaks
+    peaks = {}
+    for level, base_view in zip(["ms1", "ms2"], base_views):
+        peaks[level] = {"sql" : _peaks_sql(base_view, state[level]["scans"]), "order" : [ROW_COLUMN], "count" : state[level]["count"]}
+
+    for condition in all_conditions:
+        if not condition["conditiontype"] == "filter" or not condition["type"] in ["ms1mzcondition", "ms2productcondition"]:
+            continue
+
+        level = "ms1" if condition["type"] == "ms1mzcondition" else "ms2"
+
+        if len(condition["value"]) == 0:
+            peaks[level]["count"] = 0
+            state[level]["no_columns"] = True
+            continue
+
+        if peaks[level]["count"] == 0:
+            continue
+
+        part_column = compiler.name("part")
+        filtered_sql = _filter_peaks_sql(condition, peaks[level]["sql"])
+        peaks[level]["sql"] = "SELECT * EXCLUDE (part), part AS {} FROM ({})".format(part_column, filtered_sql)
+        peaks[level]["order"] = [part_column] + peaks[level]["order"]
+        peaks[level]["count"] = compiler.count("({})".format(peaks[level]["sql"]))
+
+        if peaks[level]["count"] == 0:
+            state[level]["no_columns"] = True
+
+    # Collating
+    if peaks["ms1"]["count"] == 0 and peaks["ms2"]["count"] == 0:
+        return pd.DataFrame()
+
+    # scanmz is always the precursors of the MS2 scans
+    level = "ms1" if parsed_dict["querytype"]["datatype"] == "datams1data" else "ms2"
+    if parsed_dict["querytype"]["function"] == "functionscanmz":
+        level = "ms2"
+
+    if peaks[level]["count"] == 0:
+        return pd.DataFrame()
+
+    ms1_peaks_sql = None
+    if not state["ms1"]["no_columns"]:
+        if compiler.linked:
+            ms1_peaks_sql = peaks["ms1"]["sql"]
+        elif peaks["ms1"]["count"] == 0:
+            # The pandas engine can only merge scans of different types when there are no MS1 peaks, i_norm_ms1 is then empty
+            ms1_peaks_sql = "SELECT ms1scan AS scan, CAST(NULL AS DOUBLE) AS i_norm FROM ms2 WHERE FALSE"
+    collate_sql = _collate_sql(parsed_dict, level, peaks[level]["sql"], compiler.columns[level], peaks[level]["order"], ms1_peaks_sql=ms1_peaks_sql)
+
+    if collate_sql is None:
+        # Everything else is collated by the pandas engine on the filtered peaks
+        ms_dfs = {}
+        for ms_level in ["ms1", "ms2"]:
+            if peaks[ms_level]["count"] == 0:
+                ms_dfs[ms_level] = pd.DataFrame()
+                continue
+
+            ms_dfs[ms_level] = _collate_sql(dict(parsed_dict, querytype=dict(parsed_dict["querytype"], function=None)), ms_level, peaks[ms_level]["sql"],
+                                                compiler.columns[ms_level], peaks[ms_level]["order"])
+            ms_dfs[ms_level] = compiler.execute(ms_dfs[ms_level]).df()
+
+        return msql_engine._executecollate_query(parsed_dict, ms_dfs["ms1"], ms_dfs["ms2"])
+
+    limit = msql_engine._get_result_limit(parsed_dict)
+    if limit is not None:
+        collate_sql += " LIMIT {}".format(int(limit))
+
+    return compiler.execute(collate_sql).df()
+
+def _collect_results(compiler, parsed_dict):
+    from massql import msql_engine
+
+    collated_df = _execute_query(compiler, parsed_dict)
+
+    # Same materialization as the pandas engine, so the column types match
+    results_accumulator = msql_engine_results.ResultAccumulator()
+    results_accumulator.append(collated_df)
+    results_df = results_accumulator.to_dataframe()
+
+    result_limit = msql_engine._get_result_limit(parsed_dict)
+    if result_limit is not None:
+        results_df = results_df.head(result_limit)
+
+    return results_df
+
+def execute_query(parsed_dict, input_filename, cache=True, ms1_df=None, ms2_df=None, threads=None):
+    """
+    Runs a parsed query with DuckDB, the results are the same as the pandas engine
+
+    Args:
+        parsed_dict ([type]): from msql_parser.parse_msql, check it with unsupported_reason first
+        input_filename ([type]): [description]
+        cache (bool, optional): [description]. Defaults to True. Reads the feather cache, and writes it when loading the file
+        ms1_df ([type], optional): [description]. Defaults to None. Pass in if you have these data in memory
+        ms2_df ([type], optional): [description]. Defaults to None. Pass in if you have these data in memory
+        threads ([type], optional): [description]. Defaults to None, which uses every core
+
+    Returns:
+        [type]: results data frame
+    """
+    import duckdb
+
+    reason = unsupported_reason(parsed_dict)
+    if reason is not None:
+        raise Exception("DUCKDB BACKEND DOES NOT SUPPORT {}".format(reason.upper()))
+
+    tables = _load_tables(input_filename, cache=cache, ms1_df=ms1_df, ms2_df=ms2_df)
+
+    connection = duckdb.connect()
+    try:
+        if threads is not None:
+            connection.execute("SET threads TO {}".format(int(threads)))
+
+        compiler = _Compiler(connection, _register_tables(connection, tables), linked=_is_linked(tables))
+        results_df = _collect_results(compiler, parsed_dict)
+    finally:
+        connection.close()
+
+    return results_df
@@ -0,0 +1,173 @@
+"""
+Runs one query on many files with a pool of processes. Every file is loaded and queried in a worker, and the results are
+handed back as soon as a file finishes. Files are admitted while the memory they are estimated to need fits, the first file
+always runs so a file bigger than the limit still runs, on its own.
+"""
+import collections
+import concurrent.futures
+import copy
+import glob
+import os
+
+import pandas as pd
+
+# The loaded data and the intermediate frames of a query take about this many times the size of the file, or of its feather cache
+MEMORY_PER_FILE_BYTE = 4
+
+# Without a limit, the files in flight can use this fraction of the memory that is available when the files are started
+MEMORY_FRACTION = 0.5
+
+def find_files(input_filenames):
+    """
+    Args:
+        input_filenames ([type]): list of filenames, or a glob pattern
+
+    Returns:
+        [type]: list of filenames, a glob pattern is sorted
+    """
+    if isinstance(input_filenames, str):
+        return sorted(glob.glob(input_filenames))
+
+    return list(input_filenames)
+
+def estimate_memory(input_filename, cache=True):
+    """
+    Args:
+        input_filename ([type]): [description]
+        cache (bool, optional): [description]. Defaults to True. The feather cache is read when it is there, this is sized from it
+
+    Returns:
+        [type]: bytes that querying the file is expected to use
+    """
+    cache_filenames = [input_filename + "_ms1.msql.feather", input_filename + "_ms2.msql.feather"]
+    if cache and all(os.path.isfile(cache_filename) for cache_filename in cache_filenames):
+        file_bytes = sum(os.path.getsize(cache_filename) for cache_filename in cache_filenames)
+    else:
+        file_bytes = os.path.getsize(input_filename)
+
+    return file_bytes * MEMORY_PER_FILE_BYTE
+
+def _get_available_memory():
+    # MemAvailable also counts the page cache that can be freed, the free pages from sysconf do not
+    try:
+        with open("/proc/meminfo") as meminfo_file:
+            for line in meminfo_file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def _format_error(e):
+    return "{}: {}".format(type(e).__name__, e)
+
+def _tag_results(results_df, input_filename):
+    results_df["filename"] = input_filename
+    return results_df
+
+def _execute_file(parsed_dict, input_filename, cache=True, parallel=False, backend="pandas"):
+    from massql import msql_engine
+
+    return msql_engine._process_parsed_query(parsed_dict, input_filename, cache=cache, parallel=parallel, backend=backend)
+
+def execute_files(parsed_dict, input_filenames, num_workers=None, max_memory=None, cache=True, parallel=False, backend="pandas"):
+    """
+    Runs a parsed query on every file
+
+    Args:
+        parsed_dict ([type]): [description]
+        input_filenames ([type]): list of filenames
+        num_workers ([type], optional): [description]. Defaults to None, which uses every available core. 1 runs the files in this process
+        max_memory ([type], optional): [description]. Defaults to None, which is MEMORY_FRACTION of the available memory
+        cache (bool, optional): [description]. Defaults to True.
+        parallel (bool, optional): [description]. Defaults to False. Only for files run in this process, workers run their file on one core
+        backend (str, optional): [description]. Defaults to "pandas".
+
+    Yields:
+        [type]: filename, results data frame and the error or None, for every file as it finishes
+    """
+    from massql import msql_engine
+    from massql import msql_engine_parallel
+
+    # Files the summary rules out are done here, without loading them or taking a worker
+    queued_files = collections.deque()
+    for input_filename in input_filenames:
+        try:
+            if msql_engine._get_prune_reason(parsed_dict, input_filename) is None:
+                queued_files.append((input_filename, estimate_memory(input_filename, cache=cache)))
+                continue
+            error = None
+        except Exception as e:
+            error = _format_error(e)
+
+        yield input_filename, _tag_results(pd.DataFrame(), input_filename), error
+
+    if len(queued_files) == 0:
+        return
+
+    num_workers = min(msql_engine_parallel._get_num_workers(num_workers), len(queued_files))
+
+    # One file at a time, starting processes is not worth it
+    if num_workers == 1:
+        for input_filename, _ in queued_files:
+            results_df, error = pd.DataFrame(), None
+            try:
+                # Executing changes the parsed query, every file gets its own copy as with the workers
+                results_df = _execute_file(copy.deepcopy(parsed_dict), input_filename, cache=cache, parallel=parallel, backend=backend)
+            except Exception as e:
+                error = _format_error(e)
+
+            yield input_filename, _tag_results(results_df, input_filename), error
+        return
+
+    if max_memory is None:
+        available_memory = _get_available_memory()
+        max_memory = available_memory * MEMORY_FRACTION if available_memory is not None else None
+
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+    running_files = {}
+    memory_in_flight = 0
+    try:
+        while len(queued_files) > 0 or len(running_files) > 0:
+            while len(queued_files) > 0 and len(running_files) < num_workers:
+                input_filename, file_memory = queued_files[0]
+                if len(running_files) > 0 and max_memory is not None and memory_in_flight + file_memory > max_memory:
+                    break
+
+                queued_files.popleft()
+                future = executor.submit(_execute_file, parsed_dict, input_filename, cache=cache, backend=backend)
+                running_files[future] = (input_filename, file_memory, executor)
+                memory_in_flight += file_memory
+
+            done_futures, _ = concurrent.futures.wait(running_files, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            pool_broken = False
+            for future in done_futures:
+                input_filename, file_memory, file_executor = running_files.pop(future)
+                memory_in_flight -= file_memory
+
+                results_df, error = pd.DataFrame(), None
+                try:
+                    results_df = future.result()
+                except concurrent.futures.process.BrokenProcessPool as e:
+                    # A worker died, e.g. killed when out of memory, this fails every file it was running with
+                    pool_broken = pool_broken or file_executor is executor
+                    error = _format_error(e)
+                except Exception as e:
+                    error = _format_error(e)
+
+                yield input_filename, _tag_results(results_df, input_filename), error
+
+            # The rest of the files get a new pool
+            if pool_broken:
+                executor.shutdown(wait=False)
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+    finally:
+        # When the caller stops early, the files that have not started are dropped, shutdown only cancels them itself from python 3.9
+        for future in running_files:
+            future.cancel()
+        executor.shutdown(wait=True)
@@ -1,5 +1,10 @@
+import numpy as np
 import pandas as pd
 from py_expression_eval import Parser
+
+from massql import msql_engine_index
+from massql import msql_engine_kernels
+
 math_parser = Parser()
 
 def _get_mz_tolerance(qualifiers, mz):
@@ -71,18 +76,242 @@ def _get_exclusion_flag(qualifiers):
 
     return False
 
+def _filter_range(ms_df, column, min_value, max_value, ms_index=None):
+    """
+    Finds the rows where min_value < column < max_value, using the sorted index when it was built for this data frame
+
+    Args:
+        ms_df ([type]): [description]
+        column ([type]): [description]
+        min_value ([type]): [description]
+        max_value ([type]): [description]
+        ms_index ([type], optional): [description]. Defaults to None. msql_engine_index.PeakIndex
+
+    Returns:
+        [type]: filtered data frame, rows in the original order
+    """
+    if ms_index is not None and ms_index.matches(ms_df):
+        return ms_df.iloc[ms_index.window_positions(column, min_value, max_value)]
+
+    values = msql_engine_index.column_values(ms_df, column)
+
+    return ms_df[(values > min_value) & (values < max_value)]
+
+def _rows_mask(ms_df, column, values):
+    """
+    Finds the rows where the column is one of the values. The values are looked up once per run of equal values in the column,
+    e.g. once per scan instead of once per peak
+
+    Args:
+        ms_df ([type]): [description]
+        column ([type]): [description]
+        values ([type]): [description]
+
+    Returns:
+        [type]: boolean numpy array
+    """
+    column_values = ms_df[column].to_numpy()
+    offsets = msql_engine_kernels.run_offsets(column_values)
+    run_mask = pd.Series(column_values[offsets[:-1]], dtype=column_values.dtype).isin(values).to_numpy()
+
+    return msql_engine_kernels.expand_runs(run_mask, offsets)
+
+def _unique_values(ms_df, column):
+    # The peaks of a scan are next to each other, only the first row of every run is looked at
+    column_values = ms_df[column].to_numpy()
+
+    return pd.unique(column_values[msql_engine_kernels.run_offsets(column_values)[:-1]])
+
+def _filter_scans(ms_df, ms_filtered_df, exclusion_flag=False):
+    """
+    Keeps the scans that have a peak in ms_filtered_df, with the exclusion flag the scans that do not
+
+    Args:
+        ms_df ([type]): [description]
+        ms_filtered_df ([type]): peaks of ms_df that matched
+        exclusion_flag (bool, optional): [description]. Defaults to False.
+
+    Returns:
+        [type]: all the peaks of the scans that are kept
+    """
+    scans_mask = _rows_mask(ms_df, "scan", _unique_values(ms_filtered_df, "scan"))
+    if exclusion_flag:
+        scans_mask = ~scans_mask
+
+    return ms_df[scans_mask]
+
+def _get_tolerance_windows(condition, ppm=True, intensity_match=True):
+    """
+    Tolerance windows of all the values of the condition, so they can be matched in one pass
+
+    Args:
+        condition ([type]): [description]
+        ppm (bool, optional): [description]. Defaults to True. False when a ppm tolerance is not a fixed window, e.g. neutral losses
+        intensity_match (bool, optional): [description]. Defaults to True. False when the intensity match qualifiers are not used, e.g. filters
+
+    Returns:
+        [type]: numpy arrays of the lower and upper bounds, None when the values have to be matched one at a time,
+        i.e. ANY and intensity matching, which keeps a register per value
+    """
+    qualifiers = condition.get("qualifiers", None)
+    if qualifiers is not None:
+        if intensity_match and ("qualifierintensitymatch" in qualifiers or "qualifierintensityreference" in qualifiers):
+            return None
+        if not ppm and "qualifierppmtolerance" in qualifiers:
+            return None
+
+    if any(isinstance(value, str) for value in condition["value"]):
+        return None
+
+    values = np.asarray(condition["value"], dtype=float)
+    tolerances = np.array([_get_mz_tolerance(qualifiers, value) for value in values], dtype=float)
+
+    return values - tolerances, values + tolerances
+
+def _get_required_windows(condition, max_precmz=None):
+    """
+    Windows that every match of a peak condition falls in, for checking if data can match before searching it
+
+    Args:
+        condition ([type]): [description]
+        max_precmz ([type], optional): [description]. Defaults to None. Highest precursor of the data, needed for neutral losses with a ppm tolerance
+
+    Returns:
+        [type]: numpy arrays of the lower and upper bounds, None for conditions that do not need a peak, e.g. exclusion,
+        and for values only known at run time, e.g. variables and subqueries
+    """
+    qualifiers = condition.get("qualifiers", None)
+    if _get_exclusion_flag(qualifiers):
+        return None
+
+    if len(condition["value"]) == 0 or not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in condition["value"]):
+        return None
+
+    # A ppm tolerance on a neutral loss is on its product ion, so the widest window is at the highest precursor
+    if condition["type"] == "ms2neutrallosscondition" and qualifiers is not None and "qualifierppmtolerance" in qualifiers:
+        if max_precmz is None:
+            return None
+
+        ppm = qualifiers["qualifierppmtolerance"]["value"]
+        values = np.asarray(condition["value"], dtype=float)
+        tolerances = np.abs(ppm * (max_precmz - values) / 1000000)
+
+        return values - tolerances, values + tolerances
+
+    return _get_tolerance_windows(condition)
+
+def _filter_windows(ms_df, column, min_values, max_values, ms_index=None):
+    """
+    Finds the rows where column falls in any of the windows, min_value < column < max_value
+
+    Args:
+        ms_df ([type]): [description]
+        column ([type]): [description]
+        min_values ([type]): [description]
+        max_values ([type]): [description]
+        ms_index ([type], optional): [description]. Defaults to None. msql_engine_index.PeakIndex
+
+    Returns:
+        [type]: filtered data frame, rows in the original order
+    """
+    min_values, max_values = msql_engine_index.merge_windows(min_values, max_values)
+
+    if ms_index is not None and ms_index.matches(ms_df):
+        return ms_df.iloc[ms_index.windows_positions(column, min_values, max_values)]
+
+    values = msql_engine_index.column_values(ms_df, column).to_numpy()
+
+    return ms_df[msql_engine_kernels.windows_mask(values, min_values, max_values)]
+
+def _filter_neutral_loss(ms2_df, nl, qualifiers, ms_index=None):
+    """
+    Finds the peaks that are a neutral loss of nl from the precursor. A ppm tolerance is on the product ion of the loss, precmz - nl,
+    so it is different for every precursor
+
+    Args:
+        ms2_df ([type]): [description]
+        nl ([type]): [description]
+        qualifiers ([type]): [description]
+        ms_index ([type], optional): [description]. Defaults to None. msql_engine_index.PeakIndex
+
+    Returns:
+        [type]: filtered data frame, rows in the original order
+    """
+    if qualifiers is None or not "qualifierppmtolerance" in qualifiers:
+        nl_tol = _get_mz_tolerance(qualifiers, nl)
+        return _filter_range(ms2_df, msql_engine_index.NEUTRAL_LOSS_COLUMN, nl - nl_tol, nl + nl_tol, ms_index=ms_index)
+
+    ppm = qualifiers["qualifierppmtolerance"]["value"]
+
+    # The window of the highest precursor holds all the others, then every peak is checked against its own precursor
+    if ms_index is not None:
+        max_precmz = ms_index.max_precursor()
+    else:
+        max_precmz = ms2_df["precmz"].max()
+    nl_tol = abs(ppm * (max_precmz - nl) / 1000000)
+
+    ms2_filtered_df = _filter_range(ms2_df, msql_engine_index.NEUTRAL_LOSS_COLUMN, nl - nl_tol, nl + nl_tol, ms_index=ms_index)
+
+    product_mz = ms2_filtered_df["precmz"] - nl
+    nl_error = (ms2_filtered_df["mz"] - product_mz).abs()
+
+    return ms2_filtered_df[nl_error < (ppm * product_mz / 1000000).abs()]
+
+def _get_scan_intensities(ms_filtered_df):
+    """
+    Sums the intensity of the peaks in each scan
+
+    Args:
+        ms_filtered_df ([type]): [description]
+
+    Returns:
+        scans ([type]): sorted numpy array of scans
+        intensities ([type]): numpy array of the summed intensity of each scan
+    """
+    if len(ms_filtered_df) == 0:
+        return np.array([], dtype=int), np.array([], dtype=float)
+
+    # Summed run by run, a scan can only be in more than one run after concatenating
+    scans = ms_filtered_df["scan"].to_numpy()
+    offsets = msql_engine_kernels.run_offsets(scans)
+    run_intensities = msql_engine_kernels.run_sums(ms_filtered_df["i"].to_numpy(), offsets)
+
+    grouped_intensities = pd.Series(run_intensities).groupby(scans[offsets[:-1]]).sum()
+
+    return grouped_intensities.index.to_numpy(), grouped_intensities.to_numpy(dtype=float)
+
 def _set_intensity_register(ms_filtered_df, register_dict, condition):
+    # The register holds the summed intensity per scan for each variable, as sorted scan and intensity arrays
     if "qualifiers" in condition:
         if "qualifierintensityreference" in condition["qualifiers"]:
             qualifier_variable = condition["qualifiers"]["qualifierintensitymatch"]["value"]
 
-            grouped_df = ms_filtered_df.groupby("scan").sum().reset_index()
-            for grouped_scan in grouped_df.to_dict(orient="records"):
-                # Saving into the register
-                key = "scan:{}:variable:{}".format(grouped_scan["scan"], qualifier_variable)
-                register_dict[key] = grouped_scan["i"]
+            scans, intensities = _get_scan_intensities(ms_filtered_df)
+
+            # Saving into the register, new values replace the values of the same scans
+            if qualifier_variable in register_dict:
+                register_scans, register_intensities = register_dict[qualifier_variable]
+                kept_mask = ~np.isin(register_scans, scans)
+
+                scans = np.concatenate([register_scans[kept_mask], scans])
+                intensities = np.concatenate([register_intensities[kept_mask], intensities])
+
+                order = np.argsort(scans, kind="stable")
+                scans, intensities = scans[order], intensities[order]
+
+            register_dict[qualifier_variable] = (scans, intensities)
     return
 
+def _evaluate_intensity_expression(qualifier_expression, qualifier_variable, register_intensities):
+    expression = math_parser.parse(qualifier_expression)
+
+    try:
+        evaluated_intensities = expression.evaluate({qualifier_variable : register_intensities})
+        return np.broadcast_to(np.asarray(evaluated_intensities, dtype=float), register_intensities.shape)
+    except (TypeError, ValueError):
+        # Functions in the expression that do not take arrays
+        return np.array([expression.evaluate({qualifier_variable : register_intensity}) for register_intensity in register_intensities.tolist()], dtype=float)
+
 def _filter_intensitymatch(ms_filtered_df, register_dict, condition):
     if "qualifiers" in condition:
         if "qualifierintensitymatch" in condition["qualifiers"] and \
@@ -90,32 +319,25 @@ def _filter_intensitymatch(ms_filtered_df, register_dict, condition):
             qualifier_expression = condition["qualifiers"]["qualifierintensitymatch"]["value"]
             qualifier_variable = qualifier_expression[0] #TODO: This assumes the variable is the first character in the expression, likely a bad assumption
 
-            grouped_df = ms_filtered_df.groupby("scan").sum().reset_index()
+            scans, scan_intensities = _get_scan_intensities(ms_filtered_df)
 
-            filtered_grouped_scans = []
-            for grouped_scan in grouped_df.to_dict(orient="records"):
-                # Reading from the register
-                key = "scan:{}:variable:{}".format(grouped_scan["scan"], qualifier_variable)
+            # Reading from the register, scans that are not in the register are not found
+            register_scans, register_intensities = register_dict.get(qualifier_variable, (np.array([], dtype=int), np.array([], dtype=float)))
+            if len(register_scans) == 0:
+                return ms_filtered_df.iloc[0:0]
 
-                if key in register_dict:
-                    register_value = register_dict[key]                    
-                    evaluated_new_expression = math_parser.parse(qualifier_expression).evaluate({
-                        qualifier_variable : register_value
-                    })
+            register_positions = np.minimum(np.searchsorted(register_scans, scans), len(register_scans) - 1)
+            found_mask = register_scans[register_positions] == scans
 
-                    min_match_intensity, max_match_intensity = _get_intensitymatch_range(condition["qualifiers"], evaluated_new_expression)
+            scans = scans[found_mask]
+            scan_intensities = scan_intensities[found_mask]
+            match_intensities = _evaluate_intensity_expression(qualifier_expression, qualifier_variable, register_intensities[register_positions[found_mask]])
 
-                    scan_intensity = grouped_scan["i"]
+            min_match_intensity, max_match_intensity = _get_intensitymatch_range(condition["qualifiers"], match_intensities)
 
-                    #print(key, scan_intensity, qualifier_expression, min_match_intensity, max_match_intensity, grouped_scan)
+            matched_scans = scans[(scan_intensities > min_match_intensity) & (scan_intensities < max_match_intensity)]
 
-                    if scan_intensity > min_match_intensity and \
-                        scan_intensity < max_match_intensity:
-                        filtered_grouped_scans.append(grouped_scan)
-                else:
-                    # Its not in the register, which means we don't find it
-                    continue
-            return pd.DataFrame(filtered_grouped_scans)
+            return ms_filtered_df[_rows_mask(ms_filtered_df, "scan", matched_scans)]
 
     return ms_filtered_df
 
@@ -143,7 +365,7 @@ def _get_intensitymatch_range(qualifiers, match_intensity):
 
     return min_intensity, max_intensity
 
-def ms2prod_condition(condition, ms1_df, ms2_df, reference_conditions_register):
+def ms2prod_condition(condition, ms1_df, ms2_df, reference_conditions_register, ms2_index=None):
     """
     Filters the MS1 and MS2 data based upon MS2 peak conditions
 
@@ -152,6 +374,7 @@ def ms2prod_condition(condition, ms1_df, ms2_df, reference_conditions_register):
         ms1_df ([type]): [description]
         ms2_df ([type]): [description]
         reference_conditions_register ([type]): Edits this in place
+        ms2_index ([type], optional): [description]. Defaults to None. Sorted index of ms2_df, used for the m/z windows
 
     Returns:
         ms1_df ([type]): [description]
@@ -162,71 +385,67 @@ def ms2prod_condition(condition, ms1_df, ms2_df, reference_conditions_register):
     if len(ms2_df) == 0:
         return ms1_df, ms2_df
 
-    ms2_list = []
-    for mz in condition["value"]:
-        if mz == "ANY":
-            # Checking defect options
-            massdefect_min, massdefect_max = _get_massdefect_min(condition.get("qualifiers", None))
-            ms2_filtered_df = ms2_df
-            ms2_filtered_df["mz_defect"] = ms2_filtered_df["mz"] - ms2_filtered_df["mz"].astype(int)
+    tolerance_windows = _get_tolerance_windows(condition)
+    if tolerance_windows is not None:
+        # All the values in one pass, a peak in overlapping windows is only matched once
+        min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
 
-            min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
+        ms2_filtered_df = _filter_windows(ms2_df, "mz", *tolerance_windows, ms_index=ms2_index)
+        ms2_filtered_df = ms2_filtered_df[(ms2_filtered_df["i"] > min_int) & 
+                                (ms2_filtered_df["i_norm"] > min_intpercent) & 
+                                (ms2_filtered_df["i_tic_norm"] > min_tic_percent_intensity)]
 
-            ms2_filtered_df = ms2_filtered_df[
-                (ms2_filtered_df["mz_defect"] > massdefect_min) & 
-                (ms2_filtered_df["mz_defect"] < massdefect_max) &
-                (ms2_filtered_df["i"] > min_int) & 
-                (ms2_filtered_df["i_norm"] > min_intpercent) & 
-                (ms2_filtered_df["i_tic_norm"] > min_tic_percent_intensity)
-            ]
-        else:
-            mz_tol = _get_mz_tolerance(condition.get("qualifiers", None), mz)
-            mz_min = mz - mz_tol
-            mz_max = mz + mz_tol
+        ms2_list = [ms2_filtered_df]
+    else:
+        ms2_list = []
+        for mz in condition["value"]:
+            if mz == "ANY":
+                # Checking defect options
+                massdefect_min, massdefect_max = _get_massdefect_min(condition.get("qualifiers", None))
+                ms2_filtered_df = ms2_df
+                ms2_filtered_df["mz_defect"] = ms2_filtered_df["mz"] - ms2_filtered_df["mz"].astype(int)
+
+                min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
+
+                ms2_filtered_df = ms2_filtered_df[msql_engine_kernels.peaks_mask(ms2_filtered_df, min_int, min_intpercent, min_tic_percent_intensity,
+                                                    defects=ms2_filtered_df["mz_defect"].to_numpy(), massdefect_min=massdefect_min, massdefect_max=massdefect_max)]
+            else:
+                mz_tol = _get_mz_tolerance(condition.get("qualifiers", None), mz)
+                mz_min = mz - mz_tol
+                mz_max = mz + mz_tol
 
-            min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
+                min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
 
-            ms2_filtered_df = ms2_df[(ms2_df["mz"] > mz_min) & 
-                                    (ms2_df["mz"] < mz_max) & 
-                                    (ms2_df["i"] > min_int) & 
-                                    (ms2_df["i_norm"] > min_intpercent) & 
-                                    (ms2_df["i_tic_norm"] > min_tic_percent_intensity)]
+                ms2_filtered_df = _filter_range(ms2_df, "mz", mz_min, mz_max, ms_index=ms2_index)
+                ms2_filtered_df = ms2_filtered_df[(ms2_filtered_df["i"] > min_int) & 
+                                        (ms2_filtered_df["i_norm"] > min_intpercent) & 
+                                        (ms2_filtered_df["i_tic_norm"] > min_tic_percent_intensity)]
 
-        # Setting the intensity match register
-        _set_intensity_register(ms2_filtered_df, reference_conditions_register, condition)
+            # Setting the intensity match register
+            _set_intensity_register(ms2_filtered_df, reference_conditions_register, condition)
 
-        # Applying the intensity match
-        ms2_filtered_df = _filter_intensitymatch(ms2_filtered_df, reference_conditions_register, condition)
+            # Applying the intensity match
+            ms2_filtered_df = _filter_intensitymatch(ms2_filtered_df, reference_conditions_register, condition)
 
-        ms2_list.append(ms2_filtered_df)
+            ms2_list.append(ms2_filtered_df)
 
     if len(ms2_list) == 1:
         ms2_filtered_df = ms2_list[0]
     else:
         ms2_filtered_df = pd.concat(ms2_list)
 
-    # Apply the negation operator
-    if exclusion_flag:
-        filtered_scans = set(ms2_filtered_df["scan"])
-        original_scans = set(ms2_df["scan"])
-        negation_scans = original_scans - filtered_scans
-
-        ms2_filtered_df = ms2_df[ms2_df["scan"].isin(negation_scans)]
+    # Filtering the actual data structures, with the negation operator these are the scans that did not match
+    ms2_df = _filter_scans(ms2_df, ms2_filtered_df, exclusion_flag=exclusion_flag)
 
-    if len(ms2_filtered_df) == 0:
+    if len(ms2_df) == 0:
        return pd.DataFrame(), pd.DataFrame()
-    
-    # Filtering the actual data structures
-    filtered_scans = set(ms2_filtered_df["scan"])
-    ms2_df = ms2_df[ms2_df["scan"].isin(filtered_scans)]
 
     # Filtering the MS1 data now
-    ms1_scans = set(ms2_df["ms1scan"])
-    ms1_df = ms1_df[ms1_df["scan"].isin(ms1_scans)]
+    ms1_df = ms1_df[_rows_mask(ms1_df, "scan", _unique_values(ms2_df, "ms1scan"))]
 
     return ms1_df, ms2_df
 
-def ms2nl_condition(condition, ms1_df, ms2_df, reference_conditions_register):
+def ms2nl_condition(condition, ms1_df, ms2_df, reference_conditions_register, ms2_index=None):
     """
     Filters the MS1 and MS2 data based upon MS2 neutral loss conditions
 
@@ -235,6 +454,7 @@ def ms2nl_condition(condition, ms1_df, ms2_df, reference_conditions_register):
         ms1_df ([type]): [description]
         ms2_df ([type]): [description]
         reference_conditions_register ([type]): Edits this in place
+        ms2_index ([type], optional): [description]. Defaults to None. Sorted index of ms2_df, used for the neutral loss windows
 
     Returns:
         ms1_df ([type]): [description]
@@ -245,73 +465,63 @@ def ms2nl_condition(condition, ms1_df, ms2_df, reference_conditions_register):
     if len(ms2_df) == 0:
         return ms1_df, ms2_df
 
-    ms2_list = []
-    for mz in condition["value"]:
-        if mz == "ANY":
-            # Checking defect options
-            massdefect_min, massdefect_max = _get_massdefect_min(condition.get("qualifiers", None))
-            ms2_filtered_df = ms2_df
-            ms2_filtered_df["mz_defect"] = ms2_filtered_df["mz"] - ms2_filtered_df["mz"].astype(int)
+    tolerance_windows = _get_tolerance_windows(condition, ppm=False)
+    if tolerance_windows is not None:
+        # All the values in one pass, a peak in overlapping windows is only matched once
+        min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
 
-            min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
+        ms2_filtered_df = _filter_windows(ms2_df, msql_engine_index.NEUTRAL_LOSS_COLUMN, *tolerance_windows, ms_index=ms2_index)
+        ms2_filtered_df = ms2_filtered_df[(ms2_filtered_df["i"] > min_int) & 
+                                (ms2_filtered_df["i_norm"] > min_intpercent) & 
+                                (ms2_filtered_df["i_tic_norm"] > min_tic_percent_intensity)]
 
-            ms2_filtered_df = ms2_filtered_df[
-                (ms2_filtered_df["mz_defect"] > massdefect_min) & 
-                (ms2_filtered_df["mz_defect"] < massdefect_max) &
-                (ms2_filtered_df["i"] > min_int) & 
-                (ms2_filtered_df["i_norm"] > min_intpercent) & 
-                (ms2_filtered_df["i_tic_norm"] > min_tic_percent_intensity)
-            ]
-        else:
-            mz_tol = _get_mz_tolerance(condition.get("qualifiers", None), mz) #TODO: This is incorrect logic if it comes to PPM accuracy
-            nl_min = mz - mz_tol
-            nl_max = mz + mz_tol
-
-            min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
-
-            ms2_filtered_df = ms2_df[
-                ((ms2_df["precmz"] - ms2_df["mz"]) > nl_min) & 
-                ((ms2_df["precmz"] - ms2_df["mz"]) < nl_max) &
-                (ms2_df["i"] > min_int) & 
-                (ms2_df["i_norm"] > min_intpercent) & 
-                (ms2_df["i_tic_norm"] > min_tic_percent_intensity)
-            ]
+        ms2_list = [ms2_filtered_df]
+    else:
+        ms2_list = []
+        for mz in condition["value"]:
+            if mz == "ANY":
+                # Checking defect options
+                massdefect_min, massdefect_max = _get_massdefect_min(condition.get("qualifiers", None))
+                ms2_filtered_df = ms2_df
+                ms2_filtered_df["mz_defect"] = ms2_filtered_df["mz"] - ms2_filtered_df["mz"].astype(int)
+
+                min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
 
-        # Setting the intensity match register
-        _set_intensity_register(ms2_filtered_df, reference_conditions_register, condition)
+                ms2_filtered_df = ms2_filtered_df[msql_engine_kernels.peaks_mask(ms2_filtered_df, min_int, min_intpercent, min_tic_percent_intensity,
+                                                    defects=ms2_filtered_df["mz_defect"].to_numpy(), massdefect_min=massdefect_min, massdefect_max=massdefect_max)]
+            else:
+                min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
 
-        # Applying the intensity match
-        ms2_filtered_df = _filter_intensitymatch(ms2_filtered_df, reference_conditions_register, condition)
+                ms2_filtered_df = _filter_neutral_loss(ms2_df, mz, condition.get("qualifiers", None), ms_index=ms2_index)
+                ms2_filtered_df = ms2_filtered_df[(ms2_filtered_df["i"] > min_int) & 
+                                        (ms2_filtered_df["i_norm"] > min_intpercent) & 
+                                        (ms2_filtered_df["i_tic_norm"] > min_tic_percent_intensity)]
 
-        ms2_list.append(ms2_filtered_df)
+            # Setting the intensity match register
+            _set_intensity_register(ms2_filtered_df, reference_conditions_register, condition)
+
+            # Applying the intensity match
+            ms2_filtered_df = _filter_intensitymatch(ms2_filtered_df, reference_conditions_register, condition)
+
+            ms2_list.append(ms2_filtered_df)
 
     if len(ms2_list) == 1:
         ms2_filtered_df = ms2_list[0]
     else:
         ms2_filtered_df = pd.concat(ms2_list)
 
-    # Apply the negation operator
-    if exclusion_flag:
-        filtered_scans = set(ms2_filtered_df["scan"])
-        original_scans = set(ms2_df["scan"])
-        negation_scans = original_scans - filtered_scans
-
-        ms2_filtered_df = ms2_df[ms2_df["scan"].isin(negation_scans)]
+    # Filtering the actual data structures, with the negation operator these are the scans that did not match
+    ms2_df = _filter_scans(ms2_df, ms2_filtered_df, exclusion_flag=exclusion_flag)
 
-    if len(ms2_filtered_df) == 0:
+    if len(ms2_df) == 0:
        return pd.DataFrame(), pd.DataFrame()
 
-    # Filtering the actual data structures
-    filtered_scans = set(ms2_filtered_df["scan"])
-    ms2_df = ms2_df[ms2_df["scan"].isin(filtered_scans)]
-
     # Filtering the MS1 data now
-    ms1_scans = set(ms2_df["ms1scan"])
-    ms1_df = ms1_df[ms1_df["scan"].isin(ms1_scans)]
+    ms1_df = ms1_df[_rows_mask(ms1_df, "scan", _unique_values(ms2_df, "ms1scan"))]
 
     return ms1_df, ms2_df
 
-def ms2prec_condition(condition, ms1_df, ms2_df, reference_conditions_register):
+def ms2prec_condition(condition, ms1_df, ms2_df, reference_conditions_register, ms2_index=None):
     """
     Filters the MS1 and MS2 data based upon MS2 precursor conditions
 
@@ -320,6 +530,7 @@ def ms2prec_condition(condition, ms1_df, ms2_df, reference_conditions_register):
         ms1_df ([type]): [description]
         ms2_df ([type]): [description]
         reference_conditions_register ([type]): Edits this in place
+        ms2_index ([type], optional): [description]. Defaults to None. Sorted index of ms2_df, used for the precursor windows
 
     Returns:
         ms1_df ([type]): [description]
@@ -330,58 +541,43 @@ def ms2prec_condition(condition, ms1_df, ms2_df, reference_conditions_register):
     if len(ms2_df) == 0:
         return ms1_df, ms2_df
 
-    ms2_list = []
+    # Precursors are answered on the scans, ms2_df is a subset of the data the index was built on
+    if ms2_index is None:
+        ms2_index = msql_engine_index.PeakIndex(ms2_df)
+
+    scans_list = []
     for mz in condition["value"]:
         if mz == "ANY":
             # Checking defect options
             massdefect_min, massdefect_max = _get_massdefect_min(condition.get("qualifiers", None))
-            ms2_filtered_df = ms2_df
-            ms2_filtered_df["precmz_defect"] = ms2_filtered_df["precmz"] - ms2_filtered_df["precmz"].astype(int)
-
-            ms2_filtered_df = ms2_filtered_df[(
-                ms2_filtered_df["precmz_defect"] > massdefect_min) & 
-                (ms2_filtered_df["precmz_defect"] < massdefect_max)
-            ]
+            scans_list.append(ms2_index.precursor_scans(massdefect_min, massdefect_max, massdefect=True))
         else:
             mz_tol = _get_mz_tolerance(condition.get("qualifiers", None), mz)
             mz_min = mz - mz_tol
             mz_max = mz + mz_tol
 
-            ms2_filtered_df = ms2_df[(
-                ms2_df["precmz"] > mz_min) & 
-                (ms2_df["precmz"] < mz_max)
-            ]
+            scans_list.append(ms2_index.precursor_scans(mz_min, mz_max))
 
-        ms2_list.append(ms2_filtered_df)
+    matched_scans = np.concatenate(scans_list)
 
-    if len(ms2_list) == 1:
-        ms2_filtered_df = ms2_list[0]
-    else:
-        ms2_filtered_df = pd.concat(ms2_list)
-    
     # Apply the negation operator
+    scans_mask = _rows_mask(ms2_df, "scan", matched_scans)
     if exclusion_flag:
-        filtered_scans = set(ms2_filtered_df["scan"])
-        original_scans = set(ms2_df["scan"])
-        negation_scans = original_scans - filtered_scans
-
-        ms2_filtered_df = ms2_df[ms2_df["scan"].isin(negation_scans)]
+        scans_mask = ~scans_mask
 
-    if len(ms2_filtered_df) == 0:
+    if not scans_mask.any():
        return pd.DataFrame(), pd.DataFrame()
     
     # Filtering the actual data structures
-    filtered_scans = set(ms2_filtered_df["scan"])
-    ms2_df = ms2_df[ms2_df["scan"].isin(filtered_scans)]
+    ms2_df = ms2_df[scans_mask]
 
     # Filtering the MS1 data now
     if len(ms1_df) > 0:
-        ms1_scans = set(ms2_df["ms1scan"])
-        ms1_df = ms1_df[ms1_df["scan"].isin(ms1_scans)]
+        ms1_df = ms1_df[_rows_mask(ms1_df, "scan", _unique_values(ms2_df, "ms1scan"))]
 
     return ms1_df, ms2_df
 
-def ms1_condition(condition, ms1_df, ms2_df, reference_conditions_register):
+def ms1_condition(condition, ms1_df, ms2_df, reference_conditions_register, ms1_index=None):
     """
     Filters the MS1 and MS2 data based upon MS1 peak conditions
 
@@ -390,6 +586,7 @@ def ms1_condition(condition, ms1_df, ms2_df, reference_conditions_register):
         ms1_df ([type]): [description]
         ms2_df ([type]): [description]
         reference_conditions_register ([type]): Edits this in place
+        ms1_index ([type], optional): [description]. Defaults to None. Sorted index of ms1_df, used for the m/z windows
 
     Returns:
         ms1_df ([type]): [description]
@@ -400,77 +597,84 @@ def ms1_condition(condition, ms1_df, ms2_df, reference_conditions_register):
     if len(ms1_df) == 0:
         return ms1_df, ms2_df
 
-    ms1_list = []
-    for mz in condition["value"]:
-        if mz == "ANY":
-            # Checking defect options
-            massdefect_min, massdefect_max = _get_massdefect_min(condition.get("qualifiers", None))
-            ms1_filtered_df = ms1_df
-            ms1_filtered_df["mz_defect"] = ms1_filtered_df["mz"] - ms1_filtered_df["mz"].astype(int)
+    tolerance_windows = _get_tolerance_windows(condition)
+    if tolerance_windows is not None:
+        # All the values in one pass, a peak in overlapping windows is only matched once
+        min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
 
-            min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
+        ms1_filtered_df = _filter_windows(ms1_df, "mz", *tolerance_windows, ms_index=ms1_index)
+        ms1_filtered_df = ms1_filtered_df[(ms1_filtered_df["i"] > min_int) & 
+                                (ms1_filtered_df["i_norm"] > min_intpercent) & 
+                                (ms1_filtered_df["i_tic_norm"] > min_tic_percent_intensity)]
+
+        massdefect_min, massdefect_max = _get_massdefect_min(condition.get("qualifiers", None))
+        if massdefect_min > 0 or massdefect_max < 1:
+            ms1_filtered_df["mz_defect"] = ms1_filtered_df["mz"] - ms1_filtered_df["mz"].astype(int)
 
             ms1_filtered_df = ms1_filtered_df[
                 (ms1_filtered_df["mz_defect"] > massdefect_min) & 
-                (ms1_filtered_df["mz_defect"] < massdefect_max) &
-                (ms1_filtered_df["i"] > min_int) & 
-                (ms1_filtered_df["i_norm"] > min_intpercent) & 
-                (ms1_filtered_df["i_tic_norm"] > min_tic_percent_intensity)
+                (ms1_filtered_df["mz_defect"] < massdefect_max)
             ]
-        else:
-            # Checking defect options
-            massdefect_min, massdefect_max = _get_massdefect_min(condition.get("qualifiers", None))
 
-            mz_tol = _get_mz_tolerance(condition.get("qualifiers", None), mz)
-            mz_min = mz - mz_tol
-            mz_max = mz + mz_tol
+        ms1_list = [ms1_filtered_df]
+    else:
+        ms1_list = []
+        for mz in condition["value"]:
+            if mz == "ANY":
+                # Checking defect options
+                massdefect_min, massdefect_max = _get_massdefect_min(condition.get("qualifiers", None))
+                ms1_filtered_df = ms1_df
+                ms1_filtered_df["mz_defect"] = ms1_filtered_df["mz"] - ms1_filtered_df["mz"].astype(int)
 
-            min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
-            ms1_filtered_df = ms1_df[
-                (ms1_df["mz"] > mz_min) & 
-                (ms1_df["mz"] < mz_max) & 
-                (ms1_df["i"] > min_int) & 
-                (ms1_df["i_norm"] > min_intpercent) & 
-                (ms1_df["i_tic_norm"] > min_tic_percent_intensity)]
+                min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
 
-            if massdefect_min > 0 or massdefect_max < 1:
-                ms1_filtered_df["mz_defect"] = ms1_filtered_df["mz"] - ms1_filtered_df["mz"].astype(int)
-                
+                ms1_filtered_df = ms1_filtered_df[msql_engine_kernels.peaks_mask(ms1_filtered_df, min_int, min_intpercent, min_tic_percent_intensity,
+                                                    defects=ms1_filtered_df["mz_defect"].to_numpy(), massdefect_min=massdefect_min, massdefect_max=massdefect_max)]
+            else:
+                # Checking defect options
+                massdefect_min, massdefect_max = _get_massdefect_min(condition.get("qualifiers", None))
+
+                mz_tol = _get_mz_tolerance(condition.get("qualifiers", None), mz)
+                mz_min = mz - mz_tol
+                mz_max = mz + mz_tol
+
+                min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
+                ms1_filtered_df = _filter_range(ms1_df, "mz", mz_min, mz_max, ms_index=ms1_index)
                 ms1_filtered_df = ms1_filtered_df[
-                    (ms1_filtered_df["mz_defect"] > massdefect_min) & 
-                    (ms1_filtered_df["mz_defect"] < massdefect_max)
-                ]
+                    (ms1_filtered_df["i"] > min_int) & 
+                    (ms1_filtered_df["i_norm"] > min_intpercent) & 
+                    (ms1_filtered_df["i_tic_norm"] > min_tic_percent_intensity)]
+
+                if massdefect_min > 0 or massdefect_max < 1:
+                    ms1_filtered_df["mz_defect"] = ms1_filtered_df["mz"] - ms1_filtered_df["mz"].astype(int)
+                
+                    ms1_filtered_df = ms1_filtered_df[
+                        (ms1_filtered_df["mz_defect"] > massdefect_min) & 
+                        (ms1_filtered_df["mz_defect"] < massdefect_max)
+                    ]
 
-        # Setting the intensity match register
-        _set_intensity_register(ms1_filtered_df, reference_conditions_register, condition)
+            # Setting the intensity match register
+            _set_intensity_register(ms1_filtered_df, reference_conditions_register, condition)
 
-        # Applying the intensity match
-        ms1_filtered_df = _filter_intensitymatch(ms1_filtered_df, reference_conditions_register, condition)
+            # Applying the intensity match
+            ms1_filtered_df = _filter_intensitymatch(ms1_filtered_df, reference_conditions_register, condition)
+
+            ms1_list.append(ms1_filtered_df)
 
-        ms1_list.append(ms1_filtered_df)
     
     if len(ms1_list) == 1:
         ms1_filtered_df = ms1_list[0]
     else:
         ms1_filtered_df = pd.concat(ms1_list)
 
-    # Apply the negation operator
-    if exclusion_flag:
-        filtered_scans = set(ms1_filtered_df["scan"])
-        original_scans = set(ms1_df["scan"])
-        negation_scans = original_scans - filtered_scans
-
-        ms1_filtered_df = ms1_df[ms1_df["scan"].isin(negation_scans)]
+    # Filtering the actual data structures, with the negation operator these are the scans that did not match
+    ms1_df = _filter_scans(ms1_df, ms1_filtered_df, exclusion_flag=exclusion_flag)
 
-    if len(ms1_filtered_df) == 0:
+    if len(ms1_df) == 0:
        return pd.DataFrame(), pd.DataFrame()
 
-    # Filtering the actual data structures
-    filtered_scans = set(ms1_filtered_df["scan"])
-    ms1_df = ms1_df[ms1_df["scan"].isin(filtered_scans)]
-
     if "ms1scan" in ms2_df:
-        ms2_df = ms2_df[ms2_df["ms1scan"].isin(filtered_scans)]
+        ms2_df = ms2_df[_rows_mask(ms2_df, "ms1scan", _unique_values(ms1_df, "scan"))]
 
     return ms1_df, ms2_df
 
@@ -490,53 +694,32 @@ def ms1_filter(condition, ms1_df):
     if len(ms1_df) == 0:
         return ms1_df
 
-    ms1_list = []
-    for mz in condition["value"]:
-        if mz == "ANY":
-            # Checking defect options
-            massdefect_min, massdefect_max = _get_massdefect_min(condition.get("qualifiers", None))
-            ms1_filtered_df = ms1_df
-            ms1_filtered_df["mz_defect"] = ms1_filtered_df["mz"] - ms1_filtered_df["mz"].astype(int)
+    # Checking defect options
+    massdefect_min, massdefect_max = _get_massdefect_min(condition.get("qualifiers", None))
+    min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
+
+    if "ANY" in condition["value"]:
+        # Every peak is in range, the other values cannot add any
+        ms1_filtered_df = ms1_df
+        ms1_filtered_df["mz_defect"] = ms1_filtered_df["mz"] - ms1_filtered_df["mz"].astype(int)
 
-            min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
+        ms1_filtered_df = ms1_filtered_df[msql_engine_kernels.peaks_mask(ms1_filtered_df, min_int, min_intpercent, min_tic_percent_intensity,
+                                            defects=ms1_filtered_df["mz_defect"].to_numpy(), massdefect_min=massdefect_min, massdefect_max=massdefect_max)]
+    else:
+        # All the values in one pass, a peak in overlapping windows is only kept once
+        ms1_filtered_df = _filter_windows(ms1_df, "mz", *_get_tolerance_windows(condition, intensity_match=False))
+        ms1_filtered_df = ms1_filtered_df[
+            (ms1_filtered_df["i"] > min_int) & 
+            (ms1_filtered_df["i_norm"] > min_intpercent) & 
+            (ms1_filtered_df["i_tic_norm"] > min_tic_percent_intensity)]
+
+        if massdefect_min > 0 or massdefect_max < 1:
+            ms1_filtered_df["mz_defect"] = ms1_filtered_df["mz"] - ms1_filtered_df["mz"].astype(int)
 
             ms1_filtered_df = ms1_filtered_df[
                 (ms1_filtered_df["mz_defect"] > massdefect_min) & 
-                (ms1_filtered_df["mz_defect"] < massdefect_max) &
-                (ms1_filtered_df["i"] > min_int) & 
-                (ms1_filtered_df["i_norm"] > min_intpercent) & 
-                (ms1_filtered_df["i_tic_norm"] > min_tic_percent_intensity)
+                (ms1_filtered_df["mz_defect"] < massdefect_max)
             ]
-        else:
-            # Checking defect options
-            massdefect_min, massdefect_max = _get_massdefect_min(condition.get("qualifiers", None))
-            
-            mz_tol = _get_mz_tolerance(condition.get("qualifiers", None), mz)
-            mz_min = mz - mz_tol
-            mz_max = mz + mz_tol
-
-            min_int, min_intpercent, min_tic_percent_intensity = _get_minintensity(condition.get("qualifiers", None))
-            ms1_filtered_df = ms1_df[
-                (ms1_df["mz"] > mz_min) & 
-                (ms1_df["mz"] < mz_max) & 
-                (ms1_df["i"] > min_int) & 
-                (ms1_df["i_norm"] > min_intpercent) & 
-                (ms1_df["i_tic_norm"] > min_tic_percent_intensity)]
-
-            if massdefect_min > 0 or massdefect_max < 1:
-                ms1_filtered_df["mz_defect"] = ms1_filtered_df["mz"] - ms1_filtered_df["mz"].astype(int)
-
-                ms1_filtered_df = ms1_filtered_df[
-                    (ms1_filtered_df["mz_defect"] > massdefect_min) & 
-                    (ms1_filtered_df["mz_defect"] < massdefect_max)
-                ]
-
-        ms1_list.append(ms1_filtered_df)
-    
-    if len(ms1_list) == 1:
-        ms1_filtered_df = ms1_list[0]
-    else:
-        ms1_filtered_df = pd.concat(ms1_list)
 
     if len(ms1_filtered_df) == 0:
        return pd.DataFrame()
@@ -0,0 +1,219 @@
+import numpy as np
+import pandas as pd
+
+# Derived column of MS2 peaks, precmz - mz
+NEUTRAL_LOSS_COLUMN = "neutral_loss"
+
+# Columns the loaders emit in acquisition order, range filters on them can be slices
+SORTED_COLUMNS = ["scan", "rt"]
+
+def column_values(ms_df, column):
+    """
+    Values of a column of the data frame, including the derived columns that are not stored in it
+
+    Args:
+        ms_df ([type]): [description]
+        column ([type]): [description]
+
+    Returns:
+        [type]: pandas series
+    """
+    if column == NEUTRAL_LOSS_COLUMN:
+        return ms_df["precmz"] - ms_df["mz"]
+
+    return ms_df[column]
+
+def merge_windows(min_values, max_values):
+    """
+    Merges overlapping windows, min_value < x < max_value, so every value falls in at most one of them
+
+    Args:
+        min_values ([type]): numpy array of exclusive lower bounds
+        max_values ([type]): numpy array of exclusive upper bounds
+
+    Returns:
+        min_values ([type]): sorted, disjoint windows
+        max_values ([type]): [description]
+    """
+    order = np.argsort(min_values, kind="stable")
+    min_values, max_values = min_values[order], max_values[order]
+
+    # A window starts a new group when it begins at or after the end of all the windows before it
+    new_group = np.ones(len(min_values), dtype=bool)
+    new_group[1:] = min_values[1:] >= np.maximum.accumulate(max_values)[:-1]
+    group_starts = np.flatnonzero(new_group)
+
+    return min_values[group_starts], np.maximum.reduceat(max_values, group_starts)
+
+def is_sorted(ms_df, column):
+    """
+    Whether the rows are sorted by the column. This is checked on the values every time, so data that was reordered or
+    edited after loading, e.g. sorted by m/z or concatenated, is not taken as sorted. It is one pass over the column,
+    less than the masks it saves.
+
+    Args:
+        ms_df ([type]): [description]
+        column ([type]): [description]
+
+    Returns:
+        [type]: bool
+    """
+    if not column in ms_df or not pd.api.types.is_numeric_dtype(ms_df[column]):
+        return False
+
+    values = ms_df[column].to_numpy()
+
+    return bool(not np.any(pd.isna(values)) and np.all(values[1:] >= values[:-1]))
+
+def range_rows(ms_df, column, min_value=None, max_value=None, inclusive=False):
+    """
+    Rows where the column is within the bounds, a positional slice found with searchsorted when the rows are sorted
+    by the column, a boolean mask otherwise
+
+    Args:
+        ms_df ([type]): [description]
+        column ([type]): [description]
+        min_value ([type], optional): [description]. Defaults to None, no lower bound.
+        max_value ([type], optional): [description]. Defaults to None, no upper bound.
+        inclusive (bool, optional): [description]. Defaults to False, min_value < x < max_value.
+
+    Returns:
+        [type]: filtered data frame
+    """
+    if column in SORTED_COLUMNS and is_sorted(ms_df, column):
+        values = ms_df[column].to_numpy()
+
+        start_index = 0
+        if min_value is not None:
+            start_index = np.searchsorted(values, min_value, side="left" if inclusive else "right")
+
+        end_index = len(values)
+        if max_value is not None:
+            end_index = np.searchsorted(values, max_value, side="right" if inclusive else "left")
+
+        return ms_df.iloc[start_index:max(start_index, end_index)]
+
+    if min_value is not None:
+        ms_df = ms_df[ms_df[column] >= min_value] if inclusive else ms_df[ms_df[column] > min_value]
+    if max_value is not None:
+        ms_df = ms_df[ms_df[column] <= max_value] if inclusive else ms_df[ms_df[column] < max_value]
+
+    return ms_df
+
+class PeakIndex(object):
+    """
+    Sorted views of the columns of a peak data frame, they are built lazily the first time a column is looked up.
+
+    Lookups return row positions in the original order of the data frame, so they can be used with iloc
+    in place of a boolean mask. The index is only valid for the data frame it was built on. The engine only passes
+    it that data frame or rows filtered down from it, which keeps the order, so a data frame with as many rows has the same rows.
+
+    For MS2 data it also keeps one row per scan sorted by precursor m/z, so precursor windows are answered
+    without going through the peaks. Scans are valid for any data frame filtered down from the one the index was built on.
+    """
+
+    def __init__(self, ms_df):
+        self.num_rows = len(ms_df)
+        self._ms_df = ms_df
+        self._sorted_columns = {}
+        self._precursor_table = {}
+
+    def matches(self, ms_df):
+        return len(ms_df) == self.num_rows
+
+    def _get_sorted_column(self, column):
+        if not column in self._sorted_columns:
+            values = column_values(self._ms_df, column).to_numpy()
+            order = np.argsort(values, kind="stable")
+            self._sorted_columns[column] = (order, values[order])
+
+        return self._sorted_columns[column]
+
+    def window_positions(self, column, min_value, max_value):
+        """
+        Finds the rows where min_value < column < max_value
+
+        Args:
+            column ([type]): [description]
+            min_value ([type]): exclusive lower bound
+            max_value ([type]): exclusive upper bound
+
+        Returns:
+            [type]: row positions, sorted
+        """
+        order, sorted_values = self._get_sorted_column(column)
+
+        start = np.searchsorted(sorted_values, min_value, side="right")
+        end = np.searchsorted(sorted_values, max_value, side="left")
+
+        if end <= start:
+            return np.array([], dtype=np.int64)
+
+        return np.sort(order[start:end])
+
+    def windows_positions(self, column, min_values, max_values):
+        """
+        Finds the rows that fall in any of the windows
+
+        Args:
+            column ([type]): [description]
+            min_values ([type]): windows from merge_windows
+            max_values ([type]): [description]
+
+        Returns:
+            [type]: row positions, sorted
+        """
+        order, sorted_values = self._get_sorted_column(column)
+
+        starts = np.searchsorted(sorted_values, min_values, side="right")
+        ends = np.searchsorted(sorted_values, max_values, side="left")
+        lengths = np.maximum(ends - starts, 0)
+
+        # The windows are disjoint, so are their ranges of sorted positions
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+
+        return np.sort(order[offsets + np.arange(lengths.sum())])
+
+    def _get_precursor_table(self, column):
+        if not column in self._precursor_table:
+            scan_df = self._ms_df[["scan", "precmz"]].drop_duplicates("scan")
+            scans = scan_df["scan"].to_numpy()
+            precmz = scan_df["precmz"].to_numpy()
+
+            if column == "precmz":
+                values = precmz
+            else:
+                values = precmz - precmz.astype(int)
+
+            order = np.argsort(values, kind="stable")
+            self._precursor_table[column] = (scans[order], values[order])
+
+        return self._precursor_table[column]
+
+    def max_precursor(self):
+        """
+        Returns:
+            [type]: highest precursor m/z of the data, also an upper bound for the data frames filtered down from it
+        """
+        _, sorted_values = self._get_precursor_table("precmz")
+
+        return sorted_values[-1]
+
+    def precursor_scans(self, min_value, max_value, massdefect=False):
+        """
+        Finds the scans where min_value < precmz < max_value, the precursor m/z is the same for every peak of a scan
+
+        Args:
+            min_value ([type]): exclusive lower bound
+            max_value ([type]): exclusive upper bound
+            massdefect (bool, optional): [description]. Defaults to False. Bounds are on the mass defect of the precursor instead
+
+        Returns:
+            [type]: scans, in the order of their precursor m/z
+        """
+        scans, sorted_values = self._get_precursor_table("precmz_defect" if massdefect else "precmz")
+
+        start = np.searchsorted(sorted_values, min_value, side="right")
+        end = np.searchsorted(sorted_values, max_value, side="left")
+
+        return scans[start:max(start, end)]
@@ -0,0 +1,198 @@
+"""
+Kernels for matching peaks scan by scan. The peaks are flat numpy arrays, and the scans are runs of rows with the same scan,
+given by the offsets where every run starts like the rows of a CSR matrix. The loaders emit the peaks of a scan next to each
+other and filtering keeps the order, so there is one run per scan.
+
+When numba is installed the kernels are compiled the first time they are used and run over the rows or runs in parallel,
+otherwise the same results come from numpy. Numba is only imported then, so it does not add to the startup time.
+"""
+import importlib.util
+import threading
+
+import numpy as np
+
+# The compiled kernels are used when numba is installed, this can be turned off to compare with the numpy versions
+USE_NUMBA = importlib.util.find_spec("numba") is not None
+
+# Below this many rows compiling and starting the threads costs more than it saves
+NUMBA_MIN_ROWS = 100000
+
+# Up to this many windows, comparing a value with every window is faster than searching them, numpy makes a pass per window
+WINDOWS_COMPARE_MAX = 16
+WINDOWS_COMPARE_MAX_NUMBA = 128
+
+# Overwritten with numba.prange before compiling, so the kernels also run as plain python
+prange = range
+
+_KERNELS = None
+
+# The default threading layer of numba aborts when kernels are called from several threads at once
+_KERNELS_LOCK = threading.Lock()
+
+def _run_sums_kernel(values, offsets):
+    # Kahan summation in row order, the same as the groupby sum of pandas
+    sums = np.zeros(len(offsets) - 1, dtype=np.float64)
+    for run in prange(len(offsets) - 1):
+        run_sum = 0.0
+        compensation = 0.0
+        for row in range(offsets[run], offsets[run + 1]):
+            y = values[row] - compensation
+            t = run_sum + y
+            compensation = t - run_sum - y
+            run_sum = t
+        sums[run] = run_sum
+
+    return sums
+
+def _windows_mask_kernel(values, min_values, max_values):
+    mask = np.empty(len(values), dtype=np.bool_)
+    if len(min_values) <= WINDOWS_COMPARE_MAX_NUMBA:
+        # Without branches, so the loop over the windows is vectorized
+        for row in prange(len(values)):
+            in_window = False
+            for window_index in range(len(min_values)):
+                in_window |= (values[row] > min_values[window_index]) & (values[row] < max_values[window_index])
+            mask[row] = in_window
+    else:
+        for row in prange(len(values)):
+            window_index = np.searchsorted(min_values, values[row]) - 1
+            mask[row] = window_index >= 0 and values[row] < max_values[window_index]
+
+    return mask
+
+def _peaks_mask_kernel(i, i_norm, i_tic_norm, min_int, min_intpercent, min_tic_percent_intensity, defects, massdefect_min, massdefect_max):
+    # Without branches, so the loop is vectorized
+    mask = np.empty(len(i), dtype=np.bool_)
+    for row in prange(len(i)):
+        mask[row] = (i[row] > min_int) & (i_norm[row] > min_intpercent) & (i_tic_norm[row] > min_tic_percent_intensity) & \
+                    (defects[row] > massdefect_min) & (defects[row] < massdefect_max)
+
+    return mask
+
+def _get_kernels():
+    global _KERNELS, prange
+
+    if _KERNELS is None:
+        import numba
+
+        prange = numba.prange
+
+        compile_kernel = numba.njit(parallel=True, cache=True)
+        _KERNELS = {"run_sums" : compile_kernel(_run_sums_kernel), "windows_mask" : compile_kernel(_windows_mask_kernel),
+                    "peaks_mask" : compile_kernel(_peaks_mask_kernel)}
+
+    return _KERNELS
+
+def _use_numba(num_rows):
+    return USE_NUMBA and num_rows >= NUMBA_MIN_ROWS
+
+def _run_kernel(name, *args):
+    with _KERNELS_LOCK:
+        return _get_kernels()[name](*args)
+
+def run_offsets(values):
+    """
+    Offsets of the runs of equal values, e.g. the scans of the scan column
+
+    Args:
+        values ([type]): numpy array
+
+    Returns:
+        [type]: int64 array of the first row of every run, followed by the number of rows
+    """
+    if len(values) == 0:
+        return np.zeros(1, dtype=np.int64)
+
+    run_starts = np.flatnonzero(values[1:] != values[:-1]) + 1
+
+    return np.concatenate([[0], run_starts, [len(values)]]).astype(np.int64)
+
+def expand_runs(run_mask, offsets):
+    """
+    Args:
+        run_mask ([type]): boolean numpy array with a value per run
+        offsets ([type]): from run_offsets
+
+    Returns:
+        [type]: boolean numpy array with the value of its run for every row
+    """
+    # Copying the runs is memory bound, np.repeat is already faster than a compiled loop
+    return np.repeat(np.asarray(run_mask, dtype=bool), np.diff(offsets))
+
+def run_sums(values, offsets):
+    """
+    Args:
+        values ([type]): numpy array
+        offsets ([type]): from run_offsets
+
+    Returns:
+        [type]: numpy array of the sum of every run
+    """
+    values = np.asarray(values, dtype=np.float64)
+
+    if _use_numba(len(values)):
+        return _run_kernel("run_sums", values, offsets)
+
+    import pandas as pd
+
+    run_numbers = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+    return pd.Series(values).groupby(run_numbers, sort=False).sum().to_numpy(dtype=np.float64)
+
+def windows_mask(values, min_values, max_values):
+    """
+    Args:
+        values ([type]): numpy array
+        min_values ([type]): windows from msql_engine_index.merge_windows
+        max_values ([type]): [description]
+
+    Returns:
+        [type]: boolean mask of the values that fall in one of the windows
+    """
+    if _use_numba(len(values)):
+        return _run_kernel("windows_mask", np.asarray(values, dtype=np.float64), np.asarray(min_values, dtype=np.float64), np.asarray(max_values, dtype=np.float64))
+
+    if len(min_values) <= WINDOWS_COMPARE_MAX:
+        mask = np.zeros(len(values), dtype=bool)
+        for min_value, max_value in zip(min_values, max_values):
+            mask |= (values > min_value) & (values < max_value)
+
+        return mask
+
+    window_index = np.searchsorted(min_values, values, side="left") - 1
+
+    return (window_index >= 0) & (values < max_values[np.maximum(window_index, 0)])
+
+def peaks_mask(ms_df, min_int, min_intpercent, min_tic_percent_intensity, defects=None, massdefect_min=0, massdefect_max=1):
+    """
+    Peaks over the intensity thresholds, and inside the mass defect window when defects are given, in one pass
+
+    Args:
+        ms_df ([type]): [description]
+        min_int ([type]): exclusive lower bounds, from msql_engine_filters._get_minintensity
+        min_intpercent ([type]): [description]
+        min_tic_percent_intensity ([type]): [description]
+        defects ([type], optional): [description]. Defaults to None. Mass defect of every peak
+        massdefect_min ([type], optional): [description]. Defaults to 0.
+        massdefect_max ([type], optional): [description]. Defaults to 1.
+
+    Returns:
+        [type]: boolean numpy array
+    """
+    i = ms_df["i"].to_numpy(dtype=np.float64)
+    i_norm = ms_df["i_norm"].to_numpy(dtype=np.float64)
+    i_tic_norm = ms_df["i_tic_norm"].to_numpy(dtype=np.float64)
+
+    if _use_numba(len(i)):
+        # Without defects every peak is inside the window, peaks without an intensity are not kept either way
+        if defects is None:
+            defects, massdefect_min, massdefect_max = i, -np.inf, np.inf
+
+        return _run_kernel("peaks_mask", i, i_norm, i_tic_norm, float(min_int), float(min_intpercent), float(min_tic_percent_intensity),
+                            np.asarray(defects, dtype=np.float64), float(massdefect_min), float(massdefect_max))
+
+    mask = (i > min_int) & (i_norm > min_intpercent) & (i_tic_norm > min_tic_percent_intensity)
+    if defects is not None:
+        mask &= (defects > massdefect_min) & (defects < massdefect_max)
+
+    return mask
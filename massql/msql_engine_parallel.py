@@ -0,0 +1,207 @@
+import os
+import concurrent.futures
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Before python 3.8, the concrete queries then run serially
+    shared_memory = None
+
+import numpy as np
+import pandas as pd
+
+from massql import msql_engine
+
+# Below this many concrete queries, starting the workers costs more than it saves
+PARALLEL_MIN_QUERIES = 100
+
+# Every worker gets this many chunks on average, smaller chunks balance better but cost more round trips
+CHUNKS_PER_WORKER = 8
+
+def _get_num_workers(num_workers=None):
+    if num_workers is not None:
+        return max(int(num_workers), 1)
+
+    try:
+        return max(len(os.sched_getaffinity(0)), 1)
+    except AttributeError:
+        return max(os.cpu_count() or 1, 1)
+
+# Every array starts on a cache line in the shared memory
+SHARED_ALIGNMENT = 64
+
+def _share_dataframe(ms_df):
+    """
+    Copies the columns of a data frame into one shared memory block, so workers can attach without copying.
+    Columns of the same dtype are laid out as one 2D array, the way pandas keeps them. The data frames of the workers
+    are then already consolidated, otherwise pandas merges their columns on the first filter and copies them out of the shared memory.
+
+    Args:
+        ms_df ([type]): [description]
+
+    Returns:
+        shared_block ([type]): shared memory block, the caller must close and unlink it
+        frame_spec ([type]): picklable description of the columns in the block
+    """
+    columns = list(ms_df.columns)
+    index_values = ms_df.index.to_numpy()
+
+    # Anything that is not a plain numeric array is sent along with the spec
+    dtype_positions = {}
+    pickled_columns = []
+    for position, column in enumerate(columns):
+        values = ms_df.iloc[:, position].to_numpy()
+        if values.dtype.kind in "biuf":
+            dtype_positions.setdefault(values.dtype.str, []).append(position)
+        else:
+            pickled_columns.append((position, values))
+
+    shared_arrays = [(dtype, positions, len(positions)) for dtype, positions in dtype_positions.items()]
+    if index_values.dtype.kind in "biuf":
+        shared_arrays.append((index_values.dtype.str, None, 1))
+
+    array_specs = []
+    offset = 0
+    for dtype, positions, num_columns in shared_arrays:
+        offset = -(-offset // SHARED_ALIGNMENT) * SHARED_ALIGNMENT
+        array_specs.append((dtype, positions, offset))
+        offset += num_columns * len(ms_df) * np.dtype(dtype).itemsize
+
+    shared_block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+
+    for dtype, positions, array_offset in array_specs:
+        if positions is None:
+            shared_values = np.ndarray(index_values.shape, dtype=np.dtype(dtype), buffer=shared_block.buf, offset=array_offset)
+            shared_values[:] = index_values
+        else:
+            shared_values = np.ndarray((len(positions), len(ms_df)), dtype=np.dtype(dtype), buffer=shared_block.buf, offset=array_offset)
+            for row, position in enumerate(positions):
+                shared_values[row] = ms_df.iloc[:, position].to_numpy()
+
+    frame_spec = {}
+    frame_spec["block"] = shared_block.name
+    frame_spec["rows"] = len(ms_df)
+    frame_spec["columns"] = columns
+    frame_spec["shared_arrays"] = [array_spec for array_spec in array_specs if array_spec[1] is not None]
+    frame_spec["shared_index"] = [array_spec for array_spec in array_specs if array_spec[1] is None]
+    frame_spec["pickled_columns"] = pickled_columns
+    frame_spec["pickled_index"] = index_values if len(frame_spec["shared_index"]) == 0 else None
+
+    return shared_block, frame_spec
+
+def _frame_from_blocks(blocks, index, columns):
+    # blocks are pairs of 2D values and the positions of their columns, pandas keeps them as they are
+    try:
+        from pandas.api.internals import create_dataframe_from_blocks
+    except ImportError:
+        from pandas.core.internals import BlockManager
+        from pandas.core.internals.api import make_block
+
+        block_manager = BlockManager([make_block(values, placement=placement, ndim=2) for values, placement in blocks], [columns, index])
+        if hasattr(pd.DataFrame, "_from_mgr"):
+            return pd.DataFrame._from_mgr(block_manager, axes=block_manager.axes)
+        return pd.DataFrame(block_manager)
+
+    return create_dataframe_from_blocks(blocks, index=index, columns=columns)
+
+def _attach_dataframe(frame_spec):
+    # Workers share the resource tracker of the parent, which unlinks the block when it is done
+    try:
+        shared_block = shared_memory.SharedMemory(name=frame_spec["block"], track=False)
+    except TypeError:
+        # Before python 3.13
+        shared_block = shared_memory.SharedMemory(name=frame_spec["block"])
+
+    num_rows = frame_spec["rows"]
+
+    if len(frame_spec["shared_index"]) > 0:
+        dtype, _, offset = frame_spec["shared_index"][0]
+        index_values = np.ndarray((num_rows,), dtype=np.dtype(dtype), buffer=shared_block.buf, offset=offset)
+    else:
+        index_values = frame_spec["pickled_index"]
+
+    # The numeric columns keep their order, the others are put back in between them
+    pickled_positions = [position for position, _ in frame_spec["pickled_columns"]]
+    shared_positions = [position for position in range(len(frame_spec["columns"])) if not position in pickled_positions]
+    shared_placement = {position : placement for placement, position in enumerate(shared_positions)}
+
+    blocks = []
+    for dtype, positions, offset in frame_spec["shared_arrays"]:
+        values = np.ndarray((len(positions), num_rows), dtype=np.dtype(dtype), buffer=shared_block.buf, offset=offset)
+        blocks.append((values, np.array([shared_placement[position] for position in positions], dtype=np.intp)))
+
+    ms_df = _frame_from_blocks(blocks, pd.Index(index_values), pd.Index([frame_spec["columns"][position] for position in shared_positions]))
+
+    for position, values in frame_spec["pickled_columns"]:
+        ms_df.insert(position, frame_spec["columns"][position], values)
+
+    return shared_block, ms_df
+
+# Set once in every worker by _init_worker
+_worker_state = {}
+
+def _init_worker(parsed_dict, ms1_spec, ms2_spec):
+    ms1_block, ms1_df = _attach_dataframe(ms1_spec)
+    ms2_block, ms2_df = _attach_dataframe(ms2_spec)
+
+    _worker_state["parsed_dict"] = parsed_dict
+    _worker_state["blocks"] = [ms1_block, ms2_block]     # Keeping the blocks open for the life of the worker
+    _worker_state["ms1_df"] = ms1_df
+    _worker_state["ms2_df"] = ms2_df
+    _worker_state["shared_plan"] = {}
+
+def _execute_chunk(concrete_query_list):
+    collated_list = []
+
+    for concrete_query in concrete_query_list:
+        results_ms1_df, results_ms2_df = msql_engine._executeconditions_query(concrete_query, None,
+                                                                            ms1_input_df=_worker_state["ms1_df"], ms2_input_df=_worker_state["ms2_df"],
+                                                                            shared_plan=_worker_state["shared_plan"])
+
+        collated_df = msql_engine._executecollate_query(_worker_state["parsed_dict"], results_ms1_df, results_ms2_df)
+        collated_list.append(collated_df)
+
+    return collated_list
+
+def execute_concrete_queries(parsed_dict, all_concrete_queries, ms1_df, ms2_df, num_workers=None):
+    """
+    Runs the concrete queries on a pool of processes. The data is placed once in shared memory, the workers attach to it
+    without copying and pull small chunks of queries as they finish, so slow candidates do not hold up the rest.
+
+    Args:
+        parsed_dict ([type]): query, this is used to collate
+        all_concrete_queries ([type]): [description]
+        ms1_df ([type]): [description]
+        ms2_df ([type]): [description]
+        num_workers ([type], optional): [description]. Defaults to None, which uses every available core
+
+    Yields:
+        [type]: collated results of each concrete query, in the order of all_concrete_queries
+    """
+    num_workers = min(_get_num_workers(num_workers), len(all_concrete_queries))
+    chunk_size = max(len(all_concrete_queries) // (num_workers * CHUNKS_PER_WORKER), 1)
+    concrete_query_lists = [all_concrete_queries[i:i + chunk_size] for i in range(0, len(all_concrete_queries), chunk_size)]
+
+    shared_blocks = []
+    try:
+        ms1_block, ms1_spec = _share_dataframe(ms1_df)
+        shared_blocks.append(ms1_block)
+        ms2_block, ms2_spec = _share_dataframe(ms2_df)
+        shared_blocks.append(ms2_block)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(parsed_dict, ms1_spec, ms2_spec)) as executor:
+            futures = [executor.submit(_execute_chunk, concrete_query_list) for concrete_query_list in concrete_query_lists]
+
+            # Results are handed out in order, the deduplication keeps the first result it sees
+            try:
+                for future in futures:
+                    for collated_df in future.result():
+                        yield collated_df
+            finally:
+                # When the caller stops early, e.g. a LIMIT, the chunks that have not started are dropped
+                for future in futures:
+                    future.cancel()
+    finally:
+        for shared_block in shared_blocks:
+            shared_block.close()
+            shared_block.unlink()
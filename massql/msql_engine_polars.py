@@ -0,0 +1,501 @@
+"""
+Polars backend, the conditions of a parsed query run as lazy Polars queries over the Arrow data of the feather cache,
+so the predicates of every condition are fused into one pass that runs on all cores.
+
+The WHERE conditions narrow down the scans one condition at a time like the pandas engine, every step collects the scans
+that are left. The peaks are only read again for the FILTER conditions and the collate function at the end, and the
+results are pandas data frames like the other engines.
+"""
+import numpy as np
+import pandas as pd
+
+from massql import msql_engine_duckdb
+from massql import msql_engine_filters
+from massql import msql_engine_index
+from massql import msql_engine_results
+from massql import msql_engine_summary
+
+# Columns every level needs to run, used for data without any peaks of a level
+EMPTY_COLUMNS = {"i" : "Float64", "i_norm" : "Float64", "i_tic_norm" : "Float64", "mz" : "Float64", "scan" : "Int64",
+                    "rt" : "Float64", "polarity" : "Int64", "precmz" : "Float64", "ms1scan" : "Int64", "charge" : "Int64"}
+
+# Position of the peak in the loaded data, keeps the results in the order of the pandas engine
+ROW_COLUMN = "_row"
+
+def unsupported_reason(parsed_dict):
+    """
+    Checks if the query can run with Polars, these are the same queries as the DuckDB backend, everything else runs with the pandas engine
+
+    Args:
+        parsed_dict ([type]): [description]
+
+    Returns:
+        [type]: what is not supported, None when the whole query is
+    """
+    return msql_engine_duckdb.unsupported_reason(parsed_dict)
+
+def _intensity_expr(qualifiers):
+    import polars as pl
+
+    min_int, min_intpercent, min_tic_percent_intensity = msql_engine_filters._get_minintensity(qualifiers)
+
+    return (pl.col("i") > min_int) & (pl.col("i_norm") > min_intpercent) & (pl.col("i_tic_norm") > min_tic_percent_intensity)
+
+def _defect_expr(column, qualifiers):
+    import polars as pl
+
+    massdefect_min, massdefect_max = msql_engine_filters._get_massdefect_min(qualifiers)
+
+    # Truncated towards zero, like astype(int) in the pandas engine
+    value = pl.col(column)
+    defect = value - pl.when(value >= 0).then(value.floor()).otherwise(value.ceil())
+
+    return (defect > massdefect_min) & (defect < massdefect_max)
+
+def _windows_expr(value_expr, min_values, max_values):
+    """
+    Expression for value_expr falling in any of the windows, min_value < value < max_value, like msql_engine_kernels.windows_mask
+
+    Returns:
+        [type]: boolean expression
+    """
+    import polars as pl
+
+    min_values, max_values = msql_engine_index.merge_windows(np.asarray(min_values, dtype=float), np.asarray(max_values, dtype=float))
+
+    # The windows are disjoint, so a value is in one when more of them start below it than end at or below it
+    started = pl.lit(pl.Series(min_values)).search_sorted(value_expr, side="left").cast(pl.Int64)
+    ended = pl.lit(pl.Series(max_values)).search_sorted(value_expr, side="right").cast(pl.Int64)
+
+    return started > ended
+
+def _match_expr(condition, max_precmz=None):
+    """
+    Expression for the peaks that match the condition, a scan matches when it has one of them
+
+    Args:
+        condition ([type]): [description]
+        max_precmz ([type], optional): [description]. Defaults to None. Highest precursor of the scan filtered data, for neutral losses with a ppm tolerance
+
+    Returns:
+        [type]: boolean expression
+    """
+    import polars as pl
+
+    qualifiers = condition.get("qualifiers", None)
+    numeric_values = [value for value in condition["value"] if not isinstance(value, str)]
+    neutral_loss = pl.col("precmz") - pl.col("mz")
+
+    expr_list = []
+
+    if "ANY" in condition["value"]:
+        if condition["type"] == "ms2precursorcondition":
+            expr_list.append(_defect_expr("precmz", qualifiers))
+        else:
+            # The mass defect of neutral losses is the one of the product ion, like the pandas engine
+            expr_list.append(_defect_expr("mz", qualifiers) & _intensity_expr(qualifiers))
+
+    if len(numeric_values) > 0:
+        numeric_condition = dict(condition, value=numeric_values)
+
+        if condition["type"] == "ms2neutrallosscondition" and qualifiers is not None and "qualifierppmtolerance" in qualifiers:
+            # The ppm tolerance is on the product ion, the window at the highest precursor holds the others
+            ppm = qualifiers["qualifierppmtolerance"]["value"]
+
+            nl_expr_list = []
+            for nl in numeric_values:
+                nl_tol = abs(ppm * (max_precmz - nl) / 1000000)
+                product_mz = pl.col("precmz") - nl
+                nl_expr_list.append((neutral_loss > nl - nl_tol) & (neutral_loss < nl + nl_tol) &
+                                    ((pl.col("mz") - product_mz).abs() < (ppm * product_mz / 1000000).abs()))
+
+            match_expr = pl.any_horizontal(nl_expr_list)
+        else:
+            min_values, max_values = msql_engine_filters._get_tolerance_windows(numeric_condition)
+
+            value_expr = {"ms1mzcondition" : pl.col("mz"), "ms2productcondition" : pl.col("mz"), "ms2precursorcondition" : pl.col("precmz"),
+                            "ms2neutrallosscondition" : neutral_loss}[condition["type"]]
+            match_expr = _windows_expr(value_expr, min_values, max_values)
+
+        if condition["type"] != "ms2precursorcondition":
+            match_expr = match_expr & _intensity_expr(qualifiers)
+
+        if condition["type"] == "ms1mzcondition" and msql_engine_duckdb._has_massdefect(qualifiers):
+            match_expr = match_expr & _defect_expr("mz", qualifiers)
+
+        expr_list.append(match_expr)
+
+    return pl.any_horizontal(expr_list)
+
+def _base_frames(frames, all_conditions, linked=True):
+    """
+    Lazy frames of the peaks that pass the scan filters, RT, polarity, scan, charge and mobility
+
+    Returns:
+        [type]: MS1 and MS2 lazy frames
+    """
+    import polars as pl
+
+    predicates = {"ms1" : [], "ms2" : []}
+
+    for condition in all_conditions:
+        if not condition["conditiontype"] == "where":
+            continue
+
+        if condition["type"] == "rtmincondition":
+            for level in predicates:
+                predicates[level].append(pl.col("rt") > condition["value"][0])
+
+        if condition["type"] == "rtmaxcondition":
+            for level in predicates:
+                predicates[level].append(pl.col("rt") < condition["value"][0])
+
+        if condition["type"] == "polaritycondition":
+            polarity_code = msql_engine_summary.POLARITY_CODES.get(condition["value"][0], None)
+            if polarity_code is not None:
+                for level in predicates:
+                    predicates[level].append(pl.col("polarity") == polarity_code)
+
+        if condition["type"] == "scanmincondition":
+            for level in predicates:
+                predicates[level].append(pl.col("scan") >= int(condition["value"][0]))
+
+        if condition["type"] == "scanmaxcondition":
+            for level in predicates:
+                predicates[level].append(pl.col("scan") <= int(condition["value"][0]))
+
+        if condition["type"] == "chargecondition":
+            predicates["ms2"].append(pl.col("charge") == int(condition["value"][0]))
+
+            # MS1 scans of the MS2 scans left at this point
+            if linked:
+                ms1_scans = frames["ms2"].filter(pl.all_horizontal(predicates["ms2"])).select("ms1scan").collect().to_series()
+                predicates["ms1"].append(pl.col("scan").is_in(ms1_scans.cast(frames["ms1"].collect_schema()["scan"]).implode()))
+            else:
+                predicates["ms1"].append(pl.lit(False))
+
+        if condition["type"] == "mobilitycondition":
+            for level in predicates:
+                if "mobility" in frames[level].collect_schema():
+                    predicates[level].append((pl.col("mobility") >= condition["min"]) & (pl.col("mobility") <= condition["max"]))
+
+    return {level : frames[level].filter(pl.all_horizontal(predicates[level])) if len(predicates[level]) > 0 else frames[level] for level in ["ms1", "ms2"]}
+
+def _in_scans(scans):
+    import polars as pl
+
+    return pl.col("scan").is_in(scans.implode())
+
+def _unique_scans(ms_lf):
+    return ms_lf.select("scan").unique().collect().to_series()
+
+def _execute_peak_condition(condition, state, base_frames, max_precmz, linked=True):
+    """
+    Narrows down the scans of state with a WHERE peak condition, the same way as msql_engine_filters
+
+    Args:
+        condition ([type]): [description]
+        state ([type]): scans and flags of each level, edited in place
+        base_frames ([type]): [description]
+        max_precmz ([type]): [description]
+        linked (bool, optional): [description]. Defaults to True. False when the MS1 scans and the ms1scan of MS2 scans cannot be equal
+    """
+    import polars as pl
+
+    exclusion_flag = msql_engine_filters._get_exclusion_flag(condition.get("qualifiers", None))
+
+    # Nothing to match against, e.g. a subquery without results
+    if len(condition["value"]) == 0:
+        if not exclusion_flag:
+            _set_empty(state)
+        return
+
+    level = "ms1" if condition["type"] == "ms1mzcondition" else "ms2"
+    other_level = "ms2" if level == "ms1" else "ms1"
+
+    if len(state[level]["scans"]) == 0:
+        return
+
+    level_lf = base_frames[level].filter(_in_scans(state[level]["scans"]))
+    level_scans = _unique_scans(level_lf.filter(_match_expr(condition, max_precmz=max_precmz)))
+    if exclusion_flag:
+        level_scans = state[level]["scans"].filter(~state[level]["scans"].is_in(level_scans.implode()))
+
+    if len(level_scans) == 0:
+        _set_empty(state)
+        return
+
+    # The scans of the other level are the ones linked to the scans left
+    if not linked:
+        other_scans = state[other_level]["scans"].clear()
+    elif level == "ms2":
+        ms1_scans = base_frames["ms2"].filter(_in_scans(level_scans)).select("ms1scan").collect().to_series()
+        other_scans = state[other_level]["scans"].filter(state[other_level]["scans"].is_in(ms1_scans.cast(state[other_level]["scans"].dtype).implode()))
+    else:
+        ms2_scans = _unique_scans(base_frames["ms2"].filter(pl.col("ms1scan").is_in(level_scans.cast(base_frames["ms2"].collect_schema()["ms1scan"]).implode())))
+        other_scans = state[other_level]["scans"].filter(state[other_level]["scans"].is_in(ms2_scans.implode()))
+
+    state[level]["scans"] = level_scans
+    state[other_level]["scans"] = other_scans
+
+def _set_empty(state):
+    # The pandas engine gives back data frames without columns here
+    for level in ["ms1", "ms2"]:
+        state[level]["scans"] = state[level]["scans"].clear()
+        state[level]["no_columns"] = True
+
+def _filter_peaks(condition, peaks_lf, part_column):
+    """
+    Peaks kept by a FILTER condition, the filter of every value adds its peaks, a peak can be there more than once
+
+    Returns:
+        [type]: lazy frame of the peaks, with part_column ordering the peaks by the value that kept them
+    """
+    import polars as pl
+
+    qualifiers = condition.get("qualifiers", None)
+
+    # Only the first value of MS2PROD is used as a filter
+    values = condition["value"] if condition["type"] == "ms1mzcondition" else condition["value"][:1]
+
+    part_list = []
+    for part, value in enumerate(values):
+        if value == "ANY":
+            filter_expr = _defect_expr("mz", qualifiers) & _intensity_expr(qualifiers)
+        else:
+            mz_tol = msql_engine_filters._get_mz_tolerance(qualifiers, value)
+            filter_expr = (pl.col("mz") > value - mz_tol) & (pl.col("mz") < value + mz_tol) & _intensity_expr(qualifiers)
+
+            if condition["type"] == "ms1mzcondition" and msql_engine_duckdb._has_massdefect(qualifiers):
+                filter_expr = filter_expr & _defect_expr("mz", qualifiers)
+
+        part_list.append(peaks_lf.filter(filter_expr).with_columns(pl.lit(part, dtype=pl.Int64).alias(part_column)))
+
+    return pl.concat(part_list)
+
+def _first_expr(column):
+    import polars as pl
+
+    # The first value that is not missing, like pandas
+    return pl.col(column).drop_nulls().first().alias(column)
+
+def _collate(parsed_dict, level, peaks_lf, columns, order_columns, ms1_peaks_lf=None):
+    """
+    Lazy frame of the collate function, the columns and their order are the ones of msql_engine._executecollate_query
+
+    Returns:
+        [type]: lazy frame, None for functions that are collated by the pandas engine
+    """
+    import polars as pl
+
+    function = parsed_dict["querytype"]["function"]
+    peaks_lf = peaks_lf.sort(order_columns, maintain_order=True)
+
+    if function is None:
+        return peaks_lf.select(columns)
+
+    if function in ["functionscansum", "functionscanmaxint"]:
+        intensity_expr = pl.col("i").sum() if function == "functionscansum" else pl.col("i").max()
+        aggregations = [intensity_expr if column == "i" else _first_expr(column) for column in columns if column != "scan"]
+        return peaks_lf.group_by("scan").agg(aggregations).sort("scan")
+
+    if function == "functionscannum":
+        return peaks_lf.select("scan").unique().sort("scan")
+
+    if function == "functionscanmz":
+        return peaks_lf.select("precmz").unique().sort("precmz")
+
+    if function == "functionexists":
+        return peaks_lf.select(pl.col("scan").min(), pl.lit(1, dtype=pl.Int64).alias("exists"))
+
+    if function == "functionscaninfo":
+        if level == "ms1":
+            kept_columns = ["scan", "rt"] + (["mobility"] if "mobility" in columns else [])
+            aggregations = [_first_expr(column) for column in kept_columns[1:]] + [pl.lit(1, dtype=pl.Int64).alias("mslevel"), pl.col("i").sum(), pl.col("i_norm").max()]
+            return peaks_lf.group_by("scan").agg(aggregations).sort("scan")
+
+        kept_columns = ["scan", "precmz", "ms1scan", "rt", "charge"] + (["mobility"] if "mobility" in columns else [])
+        aggregations = [_first_expr(column) for column in kept_columns[1:]] + [pl.col("i").sum(), pl.col("i_norm").max(), pl.lit(2, dtype=pl.Int64).alias("mslevel")]
+        scaninfo_lf = peaks_lf.group_by("scan").agg(aggregations).sort("scan")
+
+        if ms1_peaks_lf is None:
+            return scaninfo_lf
+
+        # The highest MS1 i_norm of the MS1 scan of every MS2 scan
+        ms1norm_lf = ms1_peaks_lf.group_by("scan").agg(pl.col("i_norm").max().alias("i_norm_ms1")).rename({"scan" : "ms1scan"})
+        return scaninfo_lf.join(ms1norm_lf, on="ms1scan", how="left", maintain_order="left")
+
+    return None
+
+def _load_frames(input_filename, cache=True, ms1_df=None, ms2_df=None):
+    """
+    Lazy frames of the data, the Arrow tables of the feather cache are converted without copying
+
+    Returns:
+        [type]: lazy frames and columns of each level, and if the levels are linked
+    """
+    import polars as pl
+
+    tables = msql_engine_duckdb._load_tables(input_filename, cache=cache, ms1_df=ms1_df, ms2_df=ms2_df)
+
+    frames, columns = {}, {}
+    for level, table in zip(["ms1", "ms2"], tables):
+        if table is None:
+            schema = {column : getattr(pl, column_type) for column, column_type in EMPTY_COLUMNS.items()}
+            frames[level] = pl.DataFrame(schema=schema).with_row_index(ROW_COLUMN).lazy()
+            columns[level] = []
+            continue
+
+        columns[level] = [column for column in table.column_names if column != ROW_COLUMN]
+        frames[level] = pl.from_arrow(table.select(columns[level])).with_row_index(ROW_COLUMN).lazy()
+
+    return frames, columns, msql_engine_duckdb._is_linked(tables)
+
+def _evaluate_subqueries(data, parsed_dict):
+    # Subqueries run on the same data, their precursor m/z become the values of the condition
+    for condition in parsed_dict["conditions"]:
+        if not "value" in condition or len(condition["value"]) == 0:
+            continue
+
+        subquery_dict = condition["value"][0]
+        if not isinstance(subquery_dict, dict) or not "querytype" in subquery_dict:
+            continue
+
+        subquery_val_df = _collect_results(data, subquery_dict)
+
+        if "precmz" in subquery_val_df:
+            condition["value"] = np.sort(subquery_val_df["precmz"].to_numpy(dtype=float))
+        elif len(subquery_val_df) == 0:
+            condition["value"] = np.array([], dtype=float)
+        else:
+            raise Exception("SUBQUERY MUST RETURN PRECMZ")
+
+def _execute_query(data, parsed_dict):
+    import polars as pl
+    from massql import msql_engine
+
+    frames, columns, linked = data
+
+    _evaluate_subqueries(data, parsed_dict)
+
+    all_conditions = msql_engine._sort_reference_conditions(parsed_dict["conditions"])
+    base_frames = _base_frames(frames, all_conditions, linked=linked)
+
+    state = {}
+    for level in ["ms1", "ms2"]:
+        state[level] = {"no_columns" : len(columns[level]) == 0, "scans" : _unique_scans(base_frames[level])}
+
+    max_precmz = base_frames["ms2"].select(pl.col("precmz").max()).collect().item()
+
+    # WHERE
+    for condition in all_conditions:
+        if not condition["conditiontype"] == "where" or condition["type"] in msql_engine.SCAN_CONDITION_TYPES:
+            continue
+
+        _execute_peak_condition(condition, state, base_frames, max_precmz, linked=linked)
+
+    # FILTER, these keep the scans but remove peaks
+    peaks = {}
+    for level in ["ms1", "ms2"]:
+        peaks_lf = base_frames[level].filter(_in_scans(state[level]["scans"]))
+        peaks[level] = {"lf" : peaks_lf, "order" : [ROW_COLUMN], "count" : len(state[level]["scans"])}
+
+    for condition_index, condition in enumerate(all_conditions):
+        if not condition["conditiontype"] == "filter" or not condition["type"] in ["ms1mzcondition", "ms2productcondition"]:
+            continue
+
+        level = "ms1" if condition["type"] == "ms1mzcondition" else "ms2"
+
+        if len(condition["value"]) == 0:
+            peaks[level]["count"] = 0
+            state[level]["no_columns"] = True
+            continue
+
+        if peaks[level]["count"] == 0:
+            continue
+
+        part_column = "_part_{}".format(condition_index)
+        peaks[level]["lf"] = _filter_peaks(condition, peaks[level]["lf"], part_column).collect().lazy()
+        peaks[level]["order"] = [part_column] + peaks[level]["order"]
+        peaks[level]["count"] = peaks[level]["lf"].select(pl.len()).collect().item()
+
+        if peaks[level]["count"] == 0:
+            state[level]["no_columns"] = True
+
+    # Collating
+    if peaks["ms1"]["count"] == 0 and peaks["ms2"]["count"] == 0:
+        return pd.DataFrame()
+
+    # scanmz is always the precursors of the MS2 scans
+    level = "ms1" if parsed_dict["querytype"]["datatype"] == "datams1data" else "ms2"
+    if parsed_dict["querytype"]["function"] == "functionscanmz":
+        level = "ms2"
+
+    if peaks[level]["count"] == 0:
+        return pd.DataFrame()
+
+    ms1_peaks_lf = None
+    if not state["ms1"]["no_columns"]:
+        if linked:
+            ms1_peaks_lf = peaks["ms1"]["lf"]
+        elif peaks["ms1"]["count"] == 0:
+            # The pandas engine can only merge scans of different types when there are no MS1 peaks, i_norm_ms1 is then empty
+            ms1_peaks_lf = pl.LazyFrame(schema={"scan" : base_frames["ms2"].collect_schema()["ms1scan"], "i_norm" : pl.Float64})
+    collate_lf = _collate(parsed_dict, level, peaks[level]["lf"], columns[level], peaks[level]["order"], ms1_peaks_lf=ms1_peaks_lf)
+
+    if collate_lf is None:
+        # Everything else is collated by the pandas engine on the filtered peaks
+        ms_dfs = {}
+        for ms_level in ["ms1", "ms2"]:
+            if peaks[ms_level]["count"] == 0:
+                ms_dfs[ms_level] = pd.DataFrame()
+                continue
+
+            data_dict = dict(parsed_dict, querytype=dict(parsed_dict["querytype"], function=None))
+            ms_dfs[ms_level] = _collate(data_dict, ms_level, peaks[ms_level]["lf"], columns[ms_level], peaks[ms_level]["order"]).collect().to_pandas()
+
+        return msql_engine._executecollate_query(parsed_dict, ms_dfs["ms1"], ms_dfs["ms2"])
+
+    limit = msql_engine._get_result_limit(parsed_dict)
+    if limit is not None:
+        collate_lf = collate_lf.head(int(limit))
+
+    return collate_lf.collect().to_pandas()
+
+def _collect_results(data, parsed_dict):
+    from massql import msql_engine
+
+    collated_df = _execute_query(data, parsed_dict)
+
+    # Same materialization as the pandas engine, so the column types match
+    results_accumulator = msql_engine_results.ResultAccumulator()
+    results_accumulator.append(collated_df)
+    results_df = results_accumulator.to_dataframe()
+
+    result_limit = msql_engine._get_result_limit(parsed_dict)
+    if result_limit is not None:
+        results_df = results_df.head(result_limit)
+
+    return results_df
+
+def execute_query(parsed_dict, input_filename, cache=True, ms1_df=None, ms2_df=None):
+    """
+    Runs a parsed query with Polars, the results are the same as the pandas engine
+
+    Args:
+        parsed_dict ([type]): from msql_parser.parse_msql, check it with unsupported_reason first
+        input_filename ([type]): [description]
+        cache (bool, optional): [description]. Defaults to True. Reads the feather cache, and writes it when loading the file
+        ms1_df ([type], optional): [description]. Defaults to None. Pass in if you have these data in memory
+        ms2_df ([type], optional): [description]. Defaults to None. Pass in if you have these data in memory
+
+    Returns:
+        [type]: results data frame
+    """
+    reason = unsupported_reason(parsed_dict)
+    if reason is not None:
+        raise Exception("POLARS BACKEND DOES NOT SUPPORT {}".format(reason.upper()))
+
+    data = _load_frames(input_filename, cache=cache, ms1_df=ms1_df, ms2_df=ms2_df)
+
+    return _collect_results(data, parsed_dict)
@@ -0,0 +1,249 @@
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+class ProfileNode(object):
+    """
+    One operator of the query plan. Repeated calls of the same operator, e.g. once per value of X,
+    are accumulated into the same node so the cost per call can be read off.
+    """
+
+    def __init__(self, name, detail=None):
+        self.name = name
+        self.detail = detail
+        self.calls = 0
+        self.wall_time = 0.0
+        self.rows_in = {}
+        self.rows_out = {}
+        self.scans_in = {}
+        self.scans_out = {}
+        self.bytes_out = 0
+        self.extra = {}
+        self.children = {}
+
+    def child(self, name, detail=None, key=None):
+        child_key = (name, key)
+
+        if not child_key in self.children:
+            self.children[child_key] = ProfileNode(name, detail=detail)
+        elif self.children[child_key].detail != detail:
+            # e.g. the concrete conditions of every value of X
+            self.children[child_key].detail = "<varies>"
+
+        return self.children[child_key]
+
+    def _add_frame(self, rows, scans, label, ms_df):
+        if ms_df is None:
+            return 0
+
+        rows[label] = rows.get(label, 0) + len(ms_df)
+        if len(ms_df) > 0 and "scan" in ms_df:
+            scans[label] = scans.get(label, 0) + ms_df["scan"].nunique()
+        else:
+            scans[label] = scans.get(label, 0)
+
+        return 1
+
+    def set_input(self, ms1_df=None, ms2_df=None):
+        self._add_frame(self.rows_in, self.scans_in, "ms1", ms1_df)
+        self._add_frame(self.rows_in, self.scans_in, "ms2", ms2_df)
+
+    def set_output(self, ms1_df=None, ms2_df=None, results_df=None):
+        for label, ms_df in [("ms1", ms1_df), ("ms2", ms2_df), ("results", results_df)]:
+            if self._add_frame(self.rows_out, self.scans_out, label, ms_df) and len(ms_df) > 0:
+                self.bytes_out += int(ms_df.memory_usage(index=True, deep=False).sum())
+
+    def add(self, key, value):
+        self.extra[key] = self.extra.get(key, 0) + value
+
+    def to_dict(self):
+        """
+        Returns:
+            [type]: json serializable dictionary of this node and its children
+        """
+        node_dict = {}
+        node_dict["operator"] = self.name
+        node_dict["detail"] = self.detail
+        node_dict["calls"] = self.calls
+        node_dict["wall_time"] = self.wall_time
+        node_dict["rows_in"] = self.rows_in
+        node_dict["rows_out"] = self.rows_out
+        node_dict["scans_in"] = self.scans_in
+        node_dict["scans_out"] = self.scans_out
+        node_dict["bytes_out"] = self.bytes_out
+        node_dict.update(self.extra)
+        node_dict["children"] = [child.to_dict() for child in self.children.values()]
+
+        return node_dict
+
+    def _format_line(self):
+        line = self.name
+        if self.detail is not None:
+            line += " [{}]".format(self.detail)
+
+        if self.calls > 0:
+            line += "  time={:.2f}ms".format(self.wall_time * 1000)
+            if self.calls > 1:
+                line += " calls={} ({:.3f}ms/call)".format(self.calls, self.wall_time * 1000 / self.calls)
+
+        for label in ["ms1", "ms2", "results"]:
+            if label in self.rows_in or label in self.rows_out:
+                line += "  {} rows {} -> {} scans {} -> {}".format(label,
+                                                            self.rows_in.get(label, "-"), self.rows_out.get(label, "-"),
+                                                            self.scans_in.get(label, "-"), self.scans_out.get(label, "-"))
+
+        if self.bytes_out > 0:
+            line += "  bytes={}".format(self.bytes_out)
+
+        for key, value in self.extra.items():
+            line += "  {}={}".format(key, value)
+
+        return line
+
+    def format_tree(self, prefix="", is_last=True, is_root=True):
+        """
+        Returns:
+            [type]: the plan as an indented tree, one operator per line
+        """
+        if is_root:
+            lines = [self._format_line()]
+            child_prefix = ""
+        else:
+            lines = [prefix + ("└── " if is_last else "├── ") + self._format_line()]
+            child_prefix = prefix + ("    " if is_last else "│   ")
+
+        children = list(self.children.values())
+        for i, child in enumerate(children):
+            lines.append(child.format_tree(prefix=child_prefix, is_last=(i == len(children) - 1), is_root=False))
+
+        return "\n".join(lines)
+
+class QueryProfile(object):
+    """
+    Tree of operators with their wall time, rows and scans going in and out and the size of the data they output.
+    Built either by executing a query with profiling on, or without timings by explaining a query.
+    """
+
+    def __init__(self, name="query", detail=None):
+        self.root = ProfileNode(name, detail=detail)
+        self._stack = [self.root]
+        self._start_time = time.perf_counter()
+
+    def finish(self):
+        # Records the total time on the root
+        self.root.calls = 1
+        self.root.wall_time = time.perf_counter() - self._start_time
+
+    @property
+    def current(self):
+        return self._stack[-1]
+
+    @contextmanager
+    def operator(self, name, detail=None, key=None, ms1_df=None, ms2_df=None):
+        node = self.current.child(name, detail=detail, key=key)
+        node.set_input(ms1_df=ms1_df, ms2_df=ms2_df)
+
+        self._stack.append(node)
+        start_time = time.perf_counter()
+        try:
+            yield node
+        finally:
+            node.wall_time += time.perf_counter() - start_time
+            node.calls += 1
+            self._stack.pop()
+
+    @contextmanager
+    def plan(self, name, detail=None, key=None):
+        # Adds an operator without executing anything, this is for explaining queries. Operators added inside become children
+        node = self.current.child(name, detail=detail, key=key)
+
+        self._stack.append(node)
+        try:
+            yield node
+        finally:
+            self._stack.pop()
+
+    def to_dict(self):
+        return self.root.to_dict()
+
+    def to_json(self, indent=4):
+        return json.dumps(self.to_dict(), indent=indent)
+
+    def format_tree(self):
+        return self.root.format_tree()
+
+    def __str__(self):
+        return self.format_tree()
+
+class _NullNode(object):
+    def set_input(self, ms1_df=None, ms2_df=None):
+        pass
+
+    def set_output(self, ms1_df=None, ms2_df=None, results_df=None):
+        pass
+
+    def add(self, key, value):
+        pass
+
+_NULL_NODE = _NullNode()
+
+def operator(profile, name, detail=None, key=None, condition=None, ms1_df=None, ms2_df=None):
+    """
+    Times an operator when profiling, otherwise does nothing
+
+    Args:
+        profile ([type]): QueryProfile or None
+        name ([type]): [description]
+        detail ([type], optional): [description]. Defaults to None.
+        key ([type], optional): [description]. Defaults to None. Tells apart operators with the same name, e.g. the position of the condition
+        condition ([type], optional): [description]. Defaults to None. Described as the detail when detail is not given
+        ms1_df ([type], optional): [description]. Defaults to None. Input data
+        ms2_df ([type], optional): [description]. Defaults to None. Input data
+
+    Returns:
+        [type]: context manager yielding the node, call set_output on it with the results
+    """
+    if profile is None:
+        return nullcontext(_NULL_NODE)
+
+    if detail is None and condition is not None:
+        detail = describe_condition(condition)
+
+    return profile.operator(name, detail=detail, key=key, ms1_df=ms1_df, ms2_df=ms2_df)
+
+def describe_condition(condition):
+    """
+    Short text for a condition, used as the detail of its operator
+
+    Args:
+        condition ([type]): [description]
+
+    Returns:
+        [type]: [description]
+    """
+    description_list = []
+
+    if "value" in condition:
+        values = condition["value"]
+        if len(values) > 0 and isinstance(values[0], dict):
+            description_list.append("value=<subquery>")
+        elif len(values) > 5:
+            description_list.append("value=<{} values>".format(len(values)))
+        else:
+            description_list.append("value={}".format(" OR ".join(str(value) for value in values)))
+
+    for key in ["min", "max", "mindefect", "maxdefect"]:
+        if key in condition:
+            description_list.append("{}={}".format(key, condition[key]))
+
+    for qualifier in condition.get("qualifiers", {}):
+        if not "qualifier" in qualifier:
+            continue
+        qualifier_value = condition["qualifiers"][qualifier].get("value", None)
+        qualifier_name = qualifier.replace("qualifier", "")
+        if qualifier_value is None:
+            description_list.append(qualifier_name)
+        else:
+            description_list.append("{}={}".format(qualifier_name, qualifier_value))
+
+    return " ".join(description_list)
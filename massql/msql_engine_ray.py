@@ -1,28 +1,132 @@
+import os
+import time
+
 from massql.msql_engine import _executeconditions_query, _executecollate_query
 import ray
 
+# Chunks are sized so each one takes about this long, long enough to hide the scheduling overhead
+TARGET_CHUNK_SECONDS = 0.5
+
+# The first chunks are this small, so we can measure how long a candidate takes
+PROBE_CHUNK_SIZE = 4
+
+MAX_CHUNK_SIZE = 5000
+
+def get_ray_resources(num_cpus=None, object_store_memory=None):
+    """
+    Sizes ray from the arguments, then the MASSQL_RAY_NUM_CPUS and MASSQL_RAY_OBJECT_STORE_MEMORY environment variables,
+    otherwise ray sizes itself from the machine
+
+    Args:
+        num_cpus ([type], optional): [description]. Defaults to None.
+        object_store_memory ([type], optional): [description]. Defaults to None. In bytes
+
+    Returns:
+        [type]: keyword arguments for ray.init
+    """
+    if num_cpus is None and "MASSQL_RAY_NUM_CPUS" in os.environ:
+        num_cpus = int(os.environ["MASSQL_RAY_NUM_CPUS"])
+
+    if object_store_memory is None and "MASSQL_RAY_OBJECT_STORE_MEMORY" in os.environ:
+        object_store_memory = int(os.environ["MASSQL_RAY_OBJECT_STORE_MEMORY"])
+
+    ray_resources = {}
+    if num_cpus is not None:
+        ray_resources["num_cpus"] = num_cpus
+    if object_store_memory is not None:
+        ray_resources["object_store_memory"] = object_store_memory
+
+    return ray_resources
+
 @ray.remote
-def _executeconditions_query_ray(parsed_dict_list, input_filename, ms1_input_df=None, ms2_input_df=None, cache=True):
+def _executeconditions_query_ray(parsed_dict, concrete_query_list, ms1_input_df, ms2_input_df):
     """
-    Here we will use parallel ray, we will give a list of dictionaries to query, and return a list of results that are collated
+    Here we will use parallel ray, we will give a list of dictionaries to query, and return a list of results that are collated.
+    The data is passed as references to the object store, so ray hands the workers the same copy every time
 
     Args:
-        parsed_dict_list ([type]): [description]
-        input_filename ([type]): [description]
-        ms1_input_df ([type], optional): [description]. Defaults to None.
-        ms2_input_df ([type], optional): [description]. Defaults to None.
-        cache (bool, optional): [description]. Defaults to True.
+        parsed_dict ([type]): query, this is used to collate
+        concrete_query_list ([type]): [description]
+        ms1_input_df ([type]): [description]
+        ms2_input_df ([type]): [description]
 
     Returns:
-        [type]: [description]
+        [type]: list of collated results and the time it took
     """
+    start_time = time.perf_counter()
 
     collated_list = []
-
-    for parsed_dict in parsed_dict_list:
-        ms1_df, ms2_df = _executeconditions_query(parsed_dict, input_filename, ms1_input_df=ms1_input_df, ms2_input_df=ms2_input_df, cache=cache)
+    for concrete_query in concrete_query_list:
+        ms1_df, ms2_df = _executeconditions_query(concrete_query, None, ms1_input_df=ms1_input_df, ms2_input_df=ms2_input_df)
 
         collated_df = _executecollate_query(parsed_dict, ms1_df, ms2_df)
         collated_list.append(collated_df)
 
-    return collated_list
\ No newline at end of file
+    return collated_list, time.perf_counter() - start_time
+
+def _get_chunk_size(seconds_per_query):
+    if seconds_per_query is None:
+        return PROBE_CHUNK_SIZE
+
+    chunk_size = int(TARGET_CHUNK_SECONDS / max(seconds_per_query, 1e-6))
+
+    return min(max(chunk_size, 1), MAX_CHUNK_SIZE)
+
+def execute_concrete_queries(parsed_dict, all_concrete_queries, ms1_df, ms2_df):
+    """
+    Runs the concrete queries on ray. The data is put in the object store once, chunks are sized from the measured
+    cost of the chunks that came back, and results are handed back as soon as they are in order so collating overlaps the search
+
+    Args:
+        parsed_dict ([type]): query, this is used to collate
+        all_concrete_queries ([type]): [description]
+        ms1_df ([type]): [description]
+        ms2_df ([type]): [description]
+
+    Yields:
+        [type]: collated results of each concrete query, in the order of all_concrete_queries
+    """
+    ms1_ref = ray.put(ms1_df)
+    ms2_ref = ray.put(ms2_df)
+
+    max_in_flight = max(int(ray.available_resources().get("CPU", 1)), 1) * 2
+
+    next_query = 0              # Position of the first query not sent out
+    next_chunk = 0              # Number of the next chunk to hand back
+    chunks_sent = 0
+    pending_futures = {}        # Future to chunk number and length
+    finished_chunks = {}        # Chunk number to list of results
+    total_queries_timed = 0
+    total_seconds = 0.0
+
+    try:
+        while next_query < len(all_concrete_queries) or len(pending_futures) > 0:
+            # Keeping the workers busy
+            while next_query < len(all_concrete_queries) and len(pending_futures) < max_in_flight:
+                seconds_per_query = total_seconds / total_queries_timed if total_queries_timed > 0 else None
+                chunk_size = _get_chunk_size(seconds_per_query)
+
+                concrete_query_list = all_concrete_queries[next_query:next_query + chunk_size]
+                future = _executeconditions_query_ray.remote(parsed_dict, concrete_query_list, ms1_ref, ms2_ref)
+                pending_futures[future] = (chunks_sent, len(concrete_query_list))
+                chunks_sent += 1
+                next_query += len(concrete_query_list)
+
+            ready_futures, _ = ray.wait(list(pending_futures.keys()), num_returns=1)
+            for future in ready_futures:
+                chunk_number, chunk_length = pending_futures.pop(future)
+                collated_list, chunk_seconds = ray.get(future)
+
+                finished_chunks[chunk_number] = collated_list
+                total_queries_timed += chunk_length
+                total_seconds += chunk_seconds
+
+            # Handing back what is in order
+            while next_chunk in finished_chunks:
+                for collated_df in finished_chunks.pop(next_chunk):
+                    yield collated_df
+                next_chunk += 1
+    finally:
+        # When the caller stops early, e.g. a LIMIT, the chunks still out are cancelled
+        for future in pending_futures:
+            ray.cancel(future)
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+
+class ResultAccumulator(object):
+    """
+    Collects the collated results of many concrete queries column by column, so we do not concat
+    thousands of small data frames at the end.
+
+    Rows that carry the value of X in the comment column are deduplicated as they come in on
+    (scan, truncated X), the first row seen for a key is kept. Only unique rows are kept around.
+    """
+
+    def __init__(self):
+        self.columns = {}           # column name -> list of (row offset, numpy array)
+        self.total_rows = 0
+        self._seen_keys = set()
+
+    def __len__(self):
+        return self.total_rows
+
+    def _unique_positions(self, results_df):
+        if not "comment" in results_df or not "scan" in results_df:
+            return None
+
+        try:
+            truncated_values = results_df["comment"].to_numpy(dtype=float).astype(int)
+        except (TypeError, ValueError):
+            # We are not able to compare these, keeping everything
+            return None
+
+        unique_positions = []
+        for position, key in enumerate(zip(results_df["scan"].tolist(), truncated_values.tolist())):
+            if key in self._seen_keys:
+                continue
+            self._seen_keys.add(key)
+            unique_positions.append(position)
+
+        return unique_positions
+
+    def append(self, results_df):
+        """
+        Adds the results of one query
+
+        Args:
+            results_df ([type]): collated results data frame
+        """
+        if len(results_df) == 0:
+            return
+
+        unique_positions = self._unique_positions(results_df)
+        if unique_positions is not None:
+            if len(unique_positions) == 0:
+                return
+            if len(unique_positions) < len(results_df):
+                results_df = results_df.iloc[unique_positions]
+
+        for column in results_df.columns:
+            if not column in self.columns:
+                self.columns[column] = []
+            self.columns[column].append((self.total_rows, results_df[column].to_numpy()))
+
+        self.total_rows += len(results_df)
+
+    def to_dataframe(self):
+        """
+        Materializes the results, rows are in the order they were added. Rows without a value for a column get NaN.
+
+        Returns:
+            [type]: results data frame
+        """
+        if self.total_rows == 0:
+            return pd.DataFrame()
+
+        results_dict = {}
+        for column, chunks in self.columns.items():
+            values_list = []
+            row_offset = 0
+            for chunk_offset, values in chunks:
+                if chunk_offset > row_offset:
+                    values_list.append(np.full(chunk_offset - row_offset, np.nan))
+                values_list.append(values)
+                row_offset = chunk_offset + len(values)
+            if row_offset < self.total_rows:
+                values_list.append(np.full(self.total_rows - row_offset, np.nan))
+
+            results_dict[column] = np.concatenate(values_list) if len(values_list) > 1 else values_list[0]
+
+        return pd.DataFrame(results_dict)
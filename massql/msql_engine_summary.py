@@ -0,0 +1,330 @@
+import base64
+import json
+import os
+
+import numpy as np
+
+from massql import msql_engine_index
+
+# Bump this when the contents of the summary change, older summaries are then ignored
+SUMMARY_VERSION = 2
+
+SUMMARY_EXTENSION = "_summary.msql.json"
+
+# Width of the bins of the precursor histogram, in Da
+PRECMZ_HISTOGRAM_WIDTH = 1
+
+POLARITY_CODES = {"positivepolarity" : 1, "negativepolarity" : 2}
+
+MS2_PEAK_CONDITION_TYPES = ["ms2productcondition", "ms2precursorcondition", "ms2neutrallosscondition"]
+
+# Width of the m/z bins in the bloom filters, in Da
+BLOOM_BIN_WIDTH = 0.01
+
+DEFAULT_FALSE_POSITIVE_RATE = 0.01
+
+# Windows wider than this many bins, e.g. a TOLERANCEMZ of several Da, are not looked up in the bloom filters
+MAX_BLOOM_LOOKUPS = 1000
+
+# Bloom filter and name of the peak conditions, by the level of data they can prune
+BLOOM_CONDITIONS = {
+    "ms1" : {"ms1mzcondition" : ("ms1_mz", "MS1MZ")},
+    "ms2" : {"ms2productcondition" : ("ms2_mz", "MS2PROD"), "ms2neutrallosscondition" : ("ms2_nl", "MS2NL")}
+}
+
+def _get_range(ms_df, column):
+    if not column in ms_df or len(ms_df) == 0:
+        return None
+
+    return [float(ms_df[column].min()), float(ms_df[column].max())]
+
+def _summarize_level(ms_df):
+    level_summary = {}
+    level_summary["scans"] = int(ms_df["scan"].nunique()) if "scan" in ms_df else 0
+    level_summary["rt"] = _get_range(ms_df, "rt")
+    level_summary["mz"] = _get_range(ms_df, "mz")
+    level_summary["mobility"] = _get_range(ms_df, "mobility")
+    level_summary["polarity"] = sorted(int(polarity) for polarity in ms_df["polarity"].unique()) if "polarity" in ms_df else None
+
+    return level_summary
+
+def _hash_bins(bins, seed):
+    # splitmix64, the arithmetic wraps around on purpose
+    hashes = bins.astype(np.uint64) + np.uint64(seed * 0x9E3779B97F4A7C15 % 2 ** 64)
+    hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return hashes ^ (hashes >> np.uint64(31))
+
+def _bloom_positions(bloom, bins):
+    # Double hashing, k positions per bin from two hashes
+    first_hashes = _hash_bins(bins, 1)
+    second_hashes = _hash_bins(bins, 2) | np.uint64(1)
+    hash_indices = np.arange(bloom["hashes"], dtype=np.uint64)
+
+    return (first_hashes[:, None] + hash_indices[None, :] * second_hashes[:, None]) % np.uint64(bloom["size"])
+
+def build_bloom(values, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE):
+    """
+    Bloom filter of the m/z bins of the values. The neighbouring bins of every value are added too, so a lookup only needs
+    every third bin of a window and values next to the edge of a bin are not missed.
+
+    Args:
+        values ([type]): numpy array of m/z values
+        false_positive_rate ([type], optional): [description]. Defaults to DEFAULT_FALSE_POSITIVE_RATE.
+
+    Returns:
+        [type]: bloom filter dictionary, the bits are base64 so it can go in the json of the summary
+    """
+    value_bins = np.unique(np.floor(np.asarray(values, dtype=float) / BLOOM_BIN_WIDTH).astype(np.int64))
+    bins = np.unique(np.concatenate([value_bins - 1, value_bins, value_bins + 1]))
+
+    num_bins = max(len(bins), 1)
+    size = max(int(np.ceil(-num_bins * np.log(false_positive_rate) / np.log(2) ** 2)), 64)
+    hashes = max(int(round(size / num_bins * np.log(2))), 1)
+
+    bloom = {"size" : size, "hashes" : hashes, "false_positive_rate" : false_positive_rate}
+
+    bits = np.zeros(size, dtype=bool)
+    bits[_bloom_positions(bloom, bins).ravel().astype(np.int64)] = True
+    bloom["bits"] = base64.b64encode(np.packbits(bits).tobytes()).decode("ascii")
+
+    return bloom
+
+def bloom_might_contain(bloom, min_value, max_value):
+    """
+    Args:
+        bloom ([type]): from build_bloom
+        min_value ([type]): [description]
+        max_value ([type]): [description]
+
+    Returns:
+        [type]: False when no value is in the window, min_value < x < max_value, True when one might be
+    """
+    min_bin = int(np.floor(min_value / BLOOM_BIN_WIDTH))
+    max_bin = int(np.floor(max_value / BLOOM_BIN_WIDTH))
+
+    # Every bin covers its neighbours, so every third bin covers the window
+    bins = np.arange(min_bin + 1, max_bin + 2, 3, dtype=np.int64)
+    if len(bins) > MAX_BLOOM_LOOKUPS:
+        return True
+
+    if not "_bits" in bloom:
+        bloom["_bits"] = np.unpackbits(np.frombuffer(base64.b64decode(bloom["bits"]), dtype=np.uint8), count=bloom["size"]).astype(bool)
+
+    positions = _bloom_positions(bloom, bins).astype(np.int64)
+    return bool(np.any(np.all(bloom["_bits"][positions], axis=1)))
+
+def summarize(ms1_df, ms2_df, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE):
+    """
+    Small summary of the data of a file, so we can tell a query cannot match it without loading it
+
+    Args:
+        ms1_df ([type]): [description]
+        ms2_df ([type]): [description]
+        false_positive_rate ([type], optional): [description]. Defaults to DEFAULT_FALSE_POSITIVE_RATE. Of the bloom filters of the peaks
+
+    Returns:
+        [type]: summary dictionary
+    """
+    summary = {}
+    summary["ms1"] = _summarize_level(ms1_df)
+    summary["ms2"] = _summarize_level(ms2_df)
+
+    summary["ms2"]["precmz"] = _get_range(ms2_df, "precmz")
+    summary["ms2"]["charge"] = None
+    summary["ms2"]["precmz_histogram"] = None
+
+    if len(ms2_df) > 0:
+        # One row per scan, every peak of a scan has the same precursor and charge
+        scans_df = ms2_df.drop_duplicates("scan")
+
+        if "charge" in scans_df:
+            summary["ms2"]["charge"] = {str(int(charge)) : int(count) for charge, count in scans_df["charge"].value_counts().items()}
+
+        if "precmz" in scans_df:
+            precmz_bins = np.floor(scans_df["precmz"].to_numpy() / PRECMZ_HISTOGRAM_WIDTH).astype(np.int64)
+            summary["ms2"]["precmz_histogram"] = {str(precmz_bin) : int(count) for precmz_bin, count in zip(*np.unique(precmz_bins, return_counts=True))}
+
+    summary["bloom"] = {}
+    summary["bloom"]["ms1_mz"] = build_bloom(ms1_df["mz"].to_numpy() if "mz" in ms1_df else [], false_positive_rate=false_positive_rate)
+    summary["bloom"]["ms2_mz"] = build_bloom(ms2_df["mz"].to_numpy() if "mz" in ms2_df else [], false_positive_rate=false_positive_rate)
+    summary["bloom"]["ms2_nl"] = build_bloom(msql_engine_index.column_values(ms2_df, msql_engine_index.NEUTRAL_LOSS_COLUMN) if len(ms2_df) > 0 else [],
+                                            false_positive_rate=false_positive_rate)
+
+    return summary
+
+def save_summary(input_filename, ms1_df, ms2_df, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE):
+    """
+    Writes the summary next to the file, with the size and modification time of the file so we know when it is out of date
+
+    Args:
+        input_filename ([type]): [description]
+        ms1_df ([type]): [description]
+        ms2_df ([type]): [description]
+        false_positive_rate ([type], optional): [description]. Defaults to DEFAULT_FALSE_POSITIVE_RATE.
+    """
+    file_stat = os.stat(input_filename)
+
+    summary = summarize(ms1_df, ms2_df, false_positive_rate=false_positive_rate)
+    summary["version"] = SUMMARY_VERSION
+    summary["size"] = file_stat.st_size
+    summary["mtime_ns"] = file_stat.st_mtime_ns
+
+    summary_filename = input_filename + SUMMARY_EXTENSION
+    temp_filename = "{}.{}.tmp".format(summary_filename, os.getpid())
+
+    with open(temp_filename, "w") as summary_file:
+        json.dump(summary, summary_file)
+    os.replace(temp_filename, summary_filename)
+
+def load_summary(input_filename):
+    """
+    Args:
+        input_filename ([type]): [description]
+
+    Returns:
+        [type]: summary dictionary, None when there is no summary or the file changed since it was written
+    """
+    try:
+        with open(input_filename + SUMMARY_EXTENSION) as summary_file:
+            summary = json.load(summary_file)
+        file_stat = os.stat(input_filename)
+    except (OSError, ValueError):
+        return None
+
+    if summary.get("version", None) != SUMMARY_VERSION:
+        return None
+
+    if summary["size"] != file_stat.st_size or summary["mtime_ns"] != file_stat.st_mtime_ns:
+        return None
+
+    return summary
+
+def _is_number(value):
+    # Variables are expressions of X, these are only known once X is
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _outside(value_range, min_value, max_value):
+    # Windows are exclusive, min_value < x < max_value
+    return value_range is None or max_value <= value_range[0] or min_value >= value_range[1]
+
+def _no_precursors(level_summary, min_value, max_value):
+    if _outside(level_summary["precmz"], min_value, max_value):
+        return True
+
+    precmz_histogram = level_summary["precmz_histogram"] or {}
+    min_bin = int(np.floor(min_value / PRECMZ_HISTOGRAM_WIDTH))
+    max_bin = int(np.floor(max_value / PRECMZ_HISTOGRAM_WIDTH))
+
+    return not any(str(precmz_bin) in precmz_histogram for precmz_bin in range(min_bin, max_bin + 1))
+
+def _get_windows(condition, summary):
+    from massql import msql_engine_filters
+
+    max_precmz = summary["ms2"]["precmz"][1] if summary["ms2"]["precmz"] is not None else None
+    return msql_engine_filters._get_required_windows(condition, max_precmz=max_precmz)
+
+def _level_prune_reason(condition, level, level_summary):
+    """
+    Reason the condition leaves no scans of this level, None when it might not
+    """
+    if condition["type"] == "rtmincondition" and level_summary["rt"] is not None and _is_number(condition["value"][0]):
+        if level_summary["rt"][1] <= condition["value"][0]:
+            return "RTMIN after the last {} scan".format(level)
+
+    if condition["type"] == "rtmaxcondition" and level_summary["rt"] is not None and _is_number(condition["value"][0]):
+        if level_summary["rt"][0] >= condition["value"][0]:
+            return "RTMAX before the first {} scan".format(level)
+
+    if condition["type"] == "polaritycondition" and level_summary["polarity"] is not None:
+        polarity_code = POLARITY_CODES.get(condition["value"][0], None)
+        if polarity_code is not None and not polarity_code in level_summary["polarity"]:
+            return "no {} scans of this polarity".format(level)
+
+    # Data without mobility is not filtered by mobility
+    if condition["type"] == "mobilitycondition" and level_summary["mobility"] is not None and _is_number(condition["min"]) and _is_number(condition["max"]):
+        if level_summary["mobility"][1] < condition["min"] or level_summary["mobility"][0] > condition["max"]:
+            return "MOBILITY outside the {} mobility range".format(level)
+
+    return None
+
+def prune_reason(parsed_dict, summary):
+    """
+    Checks if the query can match the summarized file. Only conditions that are certain to leave nothing are used,
+    i.e. scan filters and MS2 peak values for MS2 data and MS1 peak values for MS1 data.
+
+    Args:
+        parsed_dict ([type]): [description]
+        summary ([type]): from load_summary
+
+    Returns:
+        [type]: reason the query cannot match, None when it might match
+    """
+    level = "ms1" if parsed_dict["querytype"].get("datatype", None) == "datams1data" else "ms2"
+    level_summary = summary[level]
+
+    if level_summary["scans"] == 0:
+        return "no {} scans".format(level)
+
+    for condition in parsed_dict["conditions"]:
+        if condition["conditiontype"] != "where":
+            continue
+
+        reason = _level_prune_reason(condition, level, level_summary)
+        if reason is not None:
+            return reason
+
+        # Charge filters the MS2 scans, and the MS1 scans by their MS2 scans
+        if condition["type"] == "chargecondition" and summary["ms2"]["charge"] is not None and _is_number(condition["value"][0]):
+            if not str(int(condition["value"][0])) in summary["ms2"]["charge"]:
+                return "no MS2 scans of this charge"
+
+        if level == "ms2" and condition["type"] in MS2_PEAK_CONDITION_TYPES:
+            windows = _get_windows(condition, summary)
+            if windows is None:
+                continue
+
+            if condition["type"] == "ms2productcondition":
+                if all(_outside(level_summary["mz"], min_value, max_value) for min_value, max_value in zip(*windows)):
+                    return "MS2PROD outside the MS2 m/z range"
+
+            if condition["type"] == "ms2precursorcondition":
+                if all(_no_precursors(level_summary, min_value, max_value) for min_value, max_value in zip(*windows)):
+                    return "no precursors in MS2PREC"
+
+        if level == "ms1" and condition["type"] == "ms1mzcondition":
+            windows = _get_windows(condition, summary)
+            if windows is None:
+                continue
+
+            if all(_outside(level_summary["mz"], min_value, max_value) for min_value, max_value in zip(*windows)):
+                return "MS1MZ outside the MS1 m/z range"
+
+        # Peaks inside the m/z range can still be missing
+        if condition["type"] in BLOOM_CONDITIONS[level]:
+            bloom_name, condition_name = BLOOM_CONDITIONS[level][condition["type"]]
+            bloom = summary["bloom"][bloom_name]
+
+            if not any(bloom_might_contain(bloom, min_value, max_value) for min_value, max_value in zip(*windows)):
+                return "no {} peaks in {}".format(level.upper(), condition_name)
+
+    return None
+
+def prune_file(parsed_dict_list, input_filename):
+    """
+    Args:
+        parsed_dict_list ([type]): parsed queries
+        input_filename ([type]): [description]
+
+    Returns:
+        [type]: reason none of the queries can match the file, None when one might or there is no summary
+    """
+    summary = load_summary(input_filename)
+    if summary is None:
+        return None
+
+    reasons = [prune_reason(parsed_dict, summary) for parsed_dict in parsed_dict_list]
+    if any(reason is None for reason in reasons):
+        return None
+
+    return "; ".join(sorted(set(reasons)))
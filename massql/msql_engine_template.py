@@ -0,0 +1,147 @@
+import copy
+from py_expression_eval import Parser
+math_parser = Parser()
+
+VARIABLE_NAME = "X"
+
+def _has_variable(value):
+    try:
+        # Checking if X is in any string
+        return VARIABLE_NAME in value
+    except TypeError:
+        # This is when the target is actually a float
+        return False
+
+class QueryTemplate(object):
+    """
+    A parsed query with explicit parameter slots for the variable X. Binding a value of X only evaluates
+    the slots, the conditions that do not reference X are shared between the template and every bound query.
+
+    The template and the conditions it hands out must be treated as read only.
+    """
+
+    __slots__ = ["parsed_dict", "conditions", "value_slots", "bound_slots", "qualifier_slots", "_compiled_expressions"]
+
+    def __init__(self, parsed_dict):
+        """
+        Args:
+            parsed_dict ([type]): parse from msql_parser.parse_msql, this is copied so the caller can keep using it
+        """
+        parsed_dict = copy.deepcopy(parsed_dict)
+
+        self.conditions = tuple(parsed_dict.pop("conditions"))
+        self.parsed_dict = parsed_dict
+
+        # Slots are keyed by the index of the condition
+        self.value_slots = {}       # condition["value"][i] is an expression of X
+        self.bound_slots = {}       # condition["min"] or condition["max"] is an expression of X
+        self.qualifier_slots = {}   # condition["qualifiers"][qualifier]["value"] has X substituted as text
+
+        for condition_index, condition in enumerate(self.conditions):
+            if "value" in condition:
+                value_slots = [(i, value) for i, value in enumerate(condition["value"]) if _has_variable(value)]
+                if len(value_slots) > 0:
+                    self.value_slots[condition_index] = value_slots
+
+                qualifier_slots = []
+                for qualifier in condition.get("qualifiers", {}):
+                    if not "qualifier" in qualifier:
+                        continue
+                    qualifier_value = condition["qualifiers"][qualifier].get("value", None)
+                    if isinstance(qualifier_value, str) and _has_variable(qualifier_value):
+                        qualifier_slots.append((qualifier, qualifier_value))
+                if len(qualifier_slots) > 0:
+                    self.qualifier_slots[condition_index] = qualifier_slots
+
+            bound_slots = [(key, condition[key]) for key in ["min", "max"] if key in condition and _has_variable(condition[key])]
+            if len(bound_slots) > 0:
+                self.bound_slots[condition_index] = bound_slots
+
+        self._compiled_expressions = None
+
+    def __getstate__(self):
+        # The compiled expressions carry the parser operator tables, we rebuild them on the other side
+        return (self.parsed_dict, self.conditions, self.value_slots, self.bound_slots, self.qualifier_slots)
+
+    def __setstate__(self, state):
+        self.parsed_dict, self.conditions, self.value_slots, self.bound_slots, self.qualifier_slots = state
+        self._compiled_expressions = None
+
+    def __len__(self):
+        return len(self.conditions)
+
+    @property
+    def has_variable(self):
+        return len(self.parameterized_condition_indices) > 0
+
+    @property
+    def parameterized_condition_indices(self):
+        return set(self.value_slots) | set(self.bound_slots) | set(self.qualifier_slots)
+
+    def _get_compiled_expressions(self):
+        if self._compiled_expressions is None:
+            compiled_expressions = {}
+            for slots in list(self.value_slots.values()) + list(self.bound_slots.values()):
+                for _, expression in slots:
+                    if not expression in compiled_expressions:
+                        compiled_expressions[expression] = math_parser.parse(expression)
+            self._compiled_expressions = compiled_expressions
+
+        return self._compiled_expressions
+
+    def _make_query(self, conditions):
+        query_dict = dict(self.parsed_dict)
+        query_dict["conditions"] = conditions
+
+        return query_dict
+
+    def non_variable_query(self):
+        """
+        Returns the query with only the conditions that do not reference X, this is used for the pre-search
+
+        Returns:
+            [type]: parsed query dictionary
+        """
+        parameterized_condition_indices = self.parameterized_condition_indices
+        conditions = [condition for condition_index, condition in enumerate(self.conditions) if not condition_index in parameterized_condition_indices]
+
+        return self._make_query(conditions)
+
+    def bind(self, variable_value):
+        """
+        Creates the concrete query for a value of X. Only the conditions with parameter slots are shallow copied.
+
+        Args:
+            variable_value ([type]): value of X
+
+        Returns:
+            [type]: parsed query dictionary, with comment set to the value of X
+        """
+        compiled_expressions = self._get_compiled_expressions()
+        variable_values = {VARIABLE_NAME : variable_value}
+
+        conditions = list(self.conditions)
+        for condition_index in self.parameterized_condition_indices:
+            condition = dict(conditions[condition_index])
+
+            if condition_index in self.value_slots:
+                condition["value"] = list(condition["value"])
+                for i, expression in self.value_slots[condition_index]:
+                    condition["value"][i] = compiled_expressions[expression].evaluate(variable_values)
+
+            if condition_index in self.bound_slots:
+                for key, expression in self.bound_slots[condition_index]:
+                    condition[key] = compiled_expressions[expression].evaluate(variable_values)
+
+            if condition_index in self.qualifier_slots:
+                condition["qualifiers"] = dict(condition["qualifiers"])
+                for qualifier, expression in self.qualifier_slots[condition_index]:
+                    condition["qualifiers"][qualifier] = dict(condition["qualifiers"][qualifier])
+                    condition["qualifiers"][qualifier]["value"] = expression.replace(VARIABLE_NAME, str(variable_value))
+
+            conditions[condition_index] = condition
+
+        query_dict = self._make_query(conditions)
+        query_dict["comment"] = variable_value
+
+        return query_dict
@@ -5,10 +5,6 @@ import glob
 import sys
 import pandas as pd
 import numpy as np
-import pymzml
-from pyteomics import mzxml
-from matchms.importing import load_from_mgf
-from psims.mzml.writer import MzMLWriter
 
 def main():
     parser = argparse.ArgumentParser(description="MSQL Query in Proteosafe")
@@ -36,6 +32,8 @@ def main():
         pass
 
 def _extract_mzML_scan(input_filename, spectrum_identifier_list):
+    import pymzml
+
     MS_precisions = {
         1: 5e-6,
         2: 20e-6,
@@ -101,6 +99,8 @@ def _extract_mzML_scan(input_filename, spectrum_identifier_list):
     return output_list
 
 def _extract_mzXML_scan(input_filename, spectrum_identifier_list):
+    from pyteomics import mzxml
+
     output_list = []
     spectrum_identifier_set = set([str(spectrum_scan) for spectrum_scan in spectrum_identifier_list])
 
@@ -134,6 +134,8 @@ def _extract_mzXML_scan(input_filename, spectrum_identifier_list):
     return output_list
 
 def _extract_mgf_scan(input_filename, spectrum_identifier_list):
+    from matchms.importing import load_from_mgf
+
     output_list = []
     spectrum_identifier_set = set([str(spectrum_scan) for spectrum_scan in spectrum_identifier_list])
 
@@ -281,6 +283,8 @@ def _export_mgf(spectrum_list, output_mgf_filename):
             o.write("END IONS\n")
 
 def _export_mzML(spectrum_list, output_mzML_filename):
+    from psims.mzml.writer import MzMLWriter
+
     with MzMLWriter(open(output_mzML_filename, 'wb'), close=True) as out:
         # Add default controlled vocabularies
         out.controlled_vocabularies()
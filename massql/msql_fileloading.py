@@ -1,11 +1,10 @@
 import json
 import os
-import pymzml
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
-from matchms.importing import load_from_mgf
-from pyteomics import mzxml, mzml
+
+from massql import msql_engine_summary
 
 import logging
 logger = logging.getLogger('msql_fileloading')
@@ -36,6 +35,9 @@ def load_data(input_filename, cache=False):
             except:
                 ms2_df = pd.DataFrame()
 
+            if msql_engine_summary.load_summary(input_filename) is None:
+                _save_summary(input_filename, ms1_df, ms2_df)
+
             return ms1_df, ms2_df
 
     # Actually loading
@@ -77,9 +79,20 @@ def load_data(input_filename, cache=False):
             except:
                 pass
 
+        _save_summary(input_filename, ms1_df, ms2_df)
+
     return ms1_df, ms2_df
 
+def _save_summary(input_filename, ms1_df, ms2_df):
+    # The summary lets the engine skip the file for queries that cannot match, it is fine to not have one
+    try:
+        msql_engine_summary.save_summary(input_filename, ms1_df, ms2_df)
+    except Exception:
+        logger.warning("Cannot save the summary of {}".format(input_filename))
+
 def _load_data_mgf(input_filename):
+    from matchms.importing import load_from_mgf
+
     file = load_from_mgf(input_filename)
 
     ms2mz_list = []
@@ -180,6 +193,8 @@ def _load_data_gnps_json(input_filename):
     return ms1_df, ms2_df
 
 def _load_data_mzXML(input_filename):
+    from pyteomics import mzxml
+
     ms1mz_list = []
     ms2mz_list = []
     previous_ms1_scan = 0
@@ -293,6 +308,7 @@ def _load_data_mzML_pyteomics(input_filename):
     Args:
         input_filename ([type]): [description]
     """
+    from pyteomics import mzml
 
     previous_ms1_scan = 0
 
@@ -418,7 +434,7 @@ def _load_data_mzML2(input_filename):
     Returns:
         [type]: [description]
     """    
-
+    import pymzml
 
     MS_precisions = {
         1: 5e-6,
@@ -535,6 +551,8 @@ def _load_data_mzML2(input_filename):
     return ms1_df, ms2_df
 
 def _load_data_mzML(input_filename):
+    import pymzml
+
     MS_precisions = {
         1: 5e-6,
         2: 20e-6,
@@ -0,0 +1,436 @@
+"""
+Inverted index of the MS2 fragments of many files, every fragment m/z bin and neutral loss bin points to the (file, scan)
+postings that have a peak in it, with the max intensity of those peaks. The planner intersects the postings of the query's
+fragments to find the files and scans that can match, only these are then loaded and run through the engine.
+
+Layout on disk
+
+    manifest.json                       bin width and the indexed files
+    prod/<shard>/<segment>.feather      postings of product ions, sorted by bin
+    nl/<shard>/<segment>.feather        postings of neutral losses, sorted by bin
+
+Every build adds new segments, so files can be added to an index without rewriting it.
+"""
+
+import argparse
+import json
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+
+# Bump this when the layout of the postings changes, older indices have to be built again
+INDEX_VERSION = 1
+
+DEFAULT_BIN_WIDTH = 0.01
+
+# Bins in each shard, the bins of a tolerance window are then almost always in one shard
+SHARD_BINS = 1000
+
+DEFAULT_EXTENSIONS = [".mzml", ".mzxml", ".mgf"]
+
+MANIFEST_FILENAME = "manifest.json"
+
+# Conditions that have postings, and the folder of their postings
+POSTING_KINDS = {}
+POSTING_KINDS["ms2productcondition"] = "prod"
+POSTING_KINDS["ms2neutrallosscondition"] = "nl"
+
+def _load_manifest(index_dir):
+    manifest_path = os.path.join(index_dir, MANIFEST_FILENAME)
+
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if manifest["version"] != INDEX_VERSION:
+        raise Exception("FRAGMENT INDEX VERSION NOT SUPPORTED, PLEASE BUILD IT AGAIN")
+
+    return manifest
+
+def _save_manifest(index_dir, manifest):
+    manifest_path = os.path.join(index_dir, MANIFEST_FILENAME)
+    temp_path = "{}.{}.tmp".format(manifest_path, uuid.uuid4().hex)
+
+    with open(temp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.replace(temp_path, manifest_path)
+
+def _new_manifest(bin_width):
+    manifest = {}
+    manifest["version"] = INDEX_VERSION
+    manifest["bin_width"] = bin_width
+    manifest["next_file_id"] = 0
+    manifest["max_precmz"] = 0
+    manifest["files"] = {}
+
+    return manifest
+
+def find_files(input_paths, extensions=DEFAULT_EXTENSIONS):
+    """
+    Args:
+        input_paths ([type]): files and folders, folders are searched recursively
+        extensions ([type], optional): [description]. Defaults to DEFAULT_EXTENSIONS.
+
+    Returns:
+        [type]: sorted absolute paths of the files with one of the extensions
+    """
+    all_files = []
+    for input_path in input_paths:
+        if os.path.isfile(input_path):
+            all_files.append(os.path.abspath(input_path))
+            continue
+
+        for root, _, filenames in os.walk(input_path):
+            for filename in filenames:
+                if os.path.splitext(filename)[1].lower() in extensions:
+                    all_files.append(os.path.abspath(os.path.join(root, filename)))
+
+    return sorted(set(all_files))
+
+def _get_postings(ms2_df, file_id, bin_width):
+    """
+    Postings of one file, one row per kind, bin and scan with the max intensity of the peaks in it
+
+    Returns:
+        [type]: dictionary of posting kind to data frame
+    """
+    all_postings = {}
+
+    if len(ms2_df) == 0:
+        return all_postings
+
+    peaks_df = pd.DataFrame()
+    peaks_df["scan"] = ms2_df["scan"].astype(str).to_numpy()
+    peaks_df["i"] = ms2_df["i"].to_numpy()
+
+    kind_values = {}
+    kind_values["prod"] = ms2_df["mz"].to_numpy()
+    kind_values["nl"] = (ms2_df["precmz"] - ms2_df["mz"]).to_numpy()
+
+    for kind, values in kind_values.items():
+        # Neutral losses below zero are peaks above the precursor, these are not indexed
+        kept_mask = values > 0
+        kind_peaks_df = peaks_df[kept_mask].assign(bin=np.floor(values[kept_mask] / bin_width).astype(np.int64))
+
+        postings_df = kind_peaks_df.groupby(["bin", "scan"], sort=False)["i"].max().reset_index()
+        postings_df["file_id"] = np.int32(file_id)
+
+        all_postings[kind] = postings_df
+
+    return all_postings
+
+def _write_segments(index_dir, kind, postings_list):
+    if len(postings_list) == 0:
+        return
+
+    import pyarrow
+    from pyarrow import feather
+
+    postings_df = pd.concat(postings_list, ignore_index=True)
+    postings_df["shard"] = postings_df["bin"] // SHARD_BINS
+
+    segment_name = uuid.uuid4().hex
+    for shard, shard_df in postings_df.groupby("shard"):
+        shard_df = shard_df.sort_values(["bin", "file_id", "scan"])[["bin", "file_id", "scan", "i"]]
+
+        shard_dir = os.path.join(index_dir, kind, str(shard))
+        os.makedirs(shard_dir, exist_ok=True)
+
+        # Written under a temporary name so a query never reads half a segment
+        segment_path = os.path.join(shard_dir, segment_name + ".feather")
+        temp_path = segment_path + ".tmp"
+        feather.write_feather(pyarrow.Table.from_pandas(shard_df, preserve_index=False), temp_path, compression="zstd")
+        os.replace(temp_path, segment_path)
+
+def build_index(index_dir, input_paths, bin_width=DEFAULT_BIN_WIDTH, extensions=DEFAULT_EXTENSIONS, cache=True, batch_size=1000, false_positive_rate=None):
+    """
+    Adds files to the index, creating it when it does not exist. Files that are already in the index are skipped,
+    files that changed since they were added are indexed again.
+
+    Args:
+        index_dir ([type]): [description]
+        input_paths ([type]): files and folders
+        bin_width ([type], optional): [description]. Defaults to DEFAULT_BIN_WIDTH. Only used for a new index
+        extensions ([type], optional): [description]. Defaults to DEFAULT_EXTENSIONS.
+        cache (bool, optional): [description]. Defaults to True. Loads files with the feather cache and writes their summaries
+        batch_size (int, optional): [description]. Defaults to 1000. Files in every segment
+        false_positive_rate ([type], optional): [description]. Defaults to None, the default of the summaries. Of the bloom filters in the summaries written
+
+    Returns:
+        [type]: number of files added
+    """
+    from massql import msql_fileloading
+    from massql import msql_engine_summary
+
+    os.makedirs(index_dir, exist_ok=True)
+
+    manifest = _load_manifest(index_dir)
+    if manifest is None:
+        manifest = _new_manifest(bin_width)
+    bin_width = manifest["bin_width"]
+
+    if false_positive_rate is None:
+        false_positive_rate = msql_engine_summary.DEFAULT_FALSE_POSITIVE_RATE
+
+    files_to_add = []
+    for input_filename in find_files(input_paths, extensions=extensions):
+        file_stat = os.stat(input_filename)
+        file_info = manifest["files"].get(input_filename, None)
+
+        if file_info is not None:
+            if file_info["size"] == file_stat.st_size and file_info["mtime_ns"] == file_stat.st_mtime_ns:
+                continue
+
+        # A file that changed gets a new id, postings of the older version are then not used anymore
+        files_to_add.append((input_filename, file_stat))
+
+    for batch_start in range(0, len(files_to_add), batch_size):
+        batch_postings = {kind : [] for kind in POSTING_KINDS.values()}
+        batch_files = {}
+
+        for input_filename, file_stat in files_to_add[batch_start:batch_start + batch_size]:
+            try:
+                ms1_df, ms2_df = msql_fileloading.load_data(input_filename, cache=cache)
+            except Exception as e:
+                print("Cannot index {}: {}".format(input_filename, e))
+                manifest["files"].pop(input_filename, None)
+                continue
+
+            # The summary lets queries skip the file before loading it, it is written next to the file like the feather cache
+            if cache and msql_engine_summary.load_summary(input_filename) is None:
+                msql_engine_summary.save_summary(input_filename, ms1_df, ms2_df, false_positive_rate=false_positive_rate)
+
+            file_id = manifest["next_file_id"]
+            manifest["next_file_id"] += 1
+
+            for kind, postings_df in _get_postings(ms2_df, file_id, bin_width).items():
+                batch_postings[kind].append(postings_df)
+
+            if len(ms2_df) > 0:
+                manifest["max_precmz"] = max(manifest["max_precmz"], float(ms2_df["precmz"].max()))
+
+            batch_files[input_filename] = {"file_id" : file_id, "size" : file_stat.st_size, "mtime_ns" : file_stat.st_mtime_ns}
+
+        for kind, postings_list in batch_postings.items():
+            _write_segments(index_dir, kind, postings_list)
+
+        # Files only show up in the manifest once their postings are written
+        manifest["files"].update(batch_files)
+        _save_manifest(index_dir, manifest)
+
+        print("Indexed {} of {} files".format(min(batch_start + batch_size, len(files_to_add)), len(files_to_add)))
+
+    _save_manifest(index_dir, manifest)
+
+    return len(files_to_add)
+
+def _get_condition_windows(condition, manifest):
+    """
+    Tolerance windows of a condition on the indexed values, None when the postings cannot tell which scans match,
+    e.g. variables, ANY, exclusion and intensity matching
+
+    Returns:
+        [type]: lower and upper bounds, numpy arrays
+    """
+    from massql import msql_engine_filters
+
+    if condition["conditiontype"] != "where" or not condition["type"] in POSTING_KINDS:
+        return None
+
+    condition_windows = msql_engine_filters._get_required_windows(condition, max_precmz=manifest["max_precmz"])
+    if condition_windows is None:
+        return None
+    min_values, max_values = condition_windows
+
+    # Negative neutral losses are not indexed
+    if condition["type"] == "ms2neutrallosscondition" and np.any(min_values < 0):
+        return None
+
+    return min_values, max_values
+
+def _read_postings(index_dir, kind, bin_ranges, min_intensity=0):
+    """
+    Postings in any of the bin ranges, min_bin <= bin <= max_bin
+
+    Args:
+        index_dir ([type]): [description]
+        kind ([type]): [description]
+        bin_ranges ([type]): list of min_bin and max_bin
+        min_intensity (int, optional): [description]. Defaults to 0. Postings need a peak above this
+
+    Returns:
+        [type]: data frame of file_id and scan
+    """
+    from pyarrow import feather
+
+    shards = sorted(set(shard for min_bin, max_bin in bin_ranges for shard in range(min_bin // SHARD_BINS, max_bin // SHARD_BINS + 1)))
+
+    postings_list = []
+    for shard in shards:
+        shard_dir = os.path.join(index_dir, kind, str(shard))
+        if not os.path.isdir(shard_dir):
+            continue
+
+        for segment_name in os.listdir(shard_dir):
+            if not segment_name.endswith(".feather"):
+                continue
+
+            segment_table = feather.read_table(os.path.join(shard_dir, segment_name), memory_map=True)
+            bins = segment_table.column("bin").to_numpy()
+
+            for min_bin, max_bin in bin_ranges:
+                start = np.searchsorted(bins, min_bin, side="left")
+                end = np.searchsorted(bins, max_bin, side="right")
+                if end <= start:
+                    continue
+
+                postings_df = segment_table.slice(start, end - start).to_pandas()
+                postings_list.append(postings_df[postings_df["i"] > min_intensity][["file_id", "scan"]])
+
+    if len(postings_list) == 0:
+        return pd.DataFrame(columns=["file_id", "scan"])
+
+    return pd.concat(postings_list, ignore_index=True).drop_duplicates()
+
+def plan_query(index_dir, input_query):
+    """
+    Finds the files and scans that can match the query, every MS2PROD and MS2NL condition in the WHERE clause with values
+    has to have a posting in the same scan. Queries without these conditions can match any indexed file.
+
+    Args:
+        index_dir ([type]): [description]
+        input_query ([type]): [description]
+
+    Returns:
+        [type]: dictionary of filename to the candidate scans as strings, None when every scan of the file can match
+    """
+    from massql import msql_parser
+    from massql import msql_engine_filters
+    from massql import msql_engine_index
+
+    manifest = _load_manifest(index_dir)
+    if manifest is None:
+        raise Exception("FRAGMENT INDEX NOT FOUND")
+
+    parsed_dict = msql_parser.parse_msql(input_query)
+    bin_width = manifest["bin_width"]
+
+    candidates_df = None
+    for condition in parsed_dict["conditions"]:
+        condition_windows = _get_condition_windows(condition, manifest)
+        if condition_windows is None:
+            continue
+
+        min_intensity, _, _ = msql_engine_filters._get_minintensity(condition.get("qualifiers", None))
+        kind = POSTING_KINDS[condition["type"]]
+
+        # Overlapping windows are read once
+        min_values, max_values = msql_engine_index.merge_windows(*condition_windows)
+        bin_ranges = [(int(np.floor(min_value / bin_width)), int(np.floor(max_value / bin_width))) for min_value, max_value in zip(min_values, max_values)]
+
+        condition_df = _read_postings(index_dir, kind, bin_ranges, min_intensity=min_intensity)
+
+        if candidates_df is None:
+            candidates_df = condition_df
+        else:
+            candidates_df = candidates_df.merge(condition_df, on=["file_id", "scan"])
+
+    indexed_files = {file_info["file_id"] : filename for filename, file_info in manifest["files"].items()}
+
+    if candidates_df is None:
+        return {filename : None for filename in sorted(indexed_files.values())}
+
+    candidates = {}
+    for file_id, file_df in candidates_df.groupby("file_id"):
+        if int(file_id) in indexed_files:
+            candidates[indexed_files[int(file_id)]] = set(file_df["scan"])
+
+    return candidates
+
+def query_index(index_dir, input_query, cache=True):
+    """
+    Runs the query on the files of the index that can match it, the candidate scans are checked with the engine
+
+    Args:
+        index_dir ([type]): [description]
+        input_query ([type]): [description]
+        cache (bool, optional): [description]. Defaults to True.
+
+    Returns:
+        [type]: results data frame, with the filename of every result
+    """
+    from massql import msql_parser
+    from massql import msql_fileloading
+    from massql import msql_engine
+    from massql import msql_engine_summary
+
+    parsed_dict = msql_parser.parse_msql(input_query)
+    candidates = plan_query(index_dir, input_query)
+
+    results_list = []
+    pruned_files = 0
+    for input_filename, candidate_scans in candidates.items():
+        # The summary can still show the query cannot match, e.g. for RT and polarity
+        if msql_engine_summary.prune_file([parsed_dict], input_filename) is not None:
+            pruned_files += 1
+            continue
+
+        ms1_df, ms2_df = msql_fileloading.load_data(input_filename, cache=cache)
+
+        # Every matching scan has a posting for all the indexed conditions, so the others cannot match
+        if candidate_scans is not None and len(ms2_df) > 0:
+            ms2_df = ms2_df[ms2_df["scan"].astype(str).isin(candidate_scans)]
+
+        results_df = msql_engine.process_query(input_query, input_filename, ms1_df=ms1_df, ms2_df=ms2_df)
+
+        if len(results_df) > 0:
+            results_df["filename"] = input_filename
+            results_list.append(results_df)
+
+    print("MassQL Pruned {} of {} candidate files".format(pruned_files, len(candidates)))
+
+    if len(results_list) == 0:
+        return pd.DataFrame()
+
+    return pd.concat(results_list, ignore_index=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MassQL fragment index, to find the files that can match a query before loading them")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Adds files to the index, creating it when it does not exist")
+    build_parser.add_argument('input_paths', nargs="+", help='Files and folders to index')
+    build_parser.add_argument('--index', required=True, help='Index folder')
+    build_parser.add_argument('--bin_width', default=DEFAULT_BIN_WIDTH, type=float, help='Width of the m/z bins of a new index')
+    build_parser.add_argument('--extensions', default=",".join(DEFAULT_EXTENSIONS), help='Extensions of the files to index, comma separated')
+    build_parser.add_argument('--cache', default="YES", help='YES to cache with feather, YES is the default')
+    build_parser.add_argument('--batch_size', default=1000, type=int, help='Files written in every segment of the index')
+    build_parser.add_argument('--bloom_false_positive_rate', default=None, type=float, help='False positive rate of the peak bloom filters in the file summaries, default is 0.01')
+
+    query_parser = subparsers.add_parser("query", help="Runs a query on the files of the index that can match it")
+    query_parser.add_argument('query', help='Input Query')
+    query_parser.add_argument('--index', required=True, help='Index folder')
+    query_parser.add_argument('--output_file', default=None, help='output results filename')
+    query_parser.add_argument('--cache', default="YES", help='YES to cache with feather, YES is the default')
+
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        extensions = [extension.strip().lower() for extension in args.extensions.split(",")]
+        added_files = build_index(args.index, args.input_paths, bin_width=args.bin_width, extensions=extensions,
+                                    cache=(args.cache == "YES"), batch_size=args.batch_size, false_positive_rate=args.bloom_false_positive_rate)
+        print("MassQL Indexed {} new files".format(added_files))
+
+    if args.command == "query":
+        results_df = query_index(args.index, args.query, cache=(args.cache == "YES"))
+        print("MassQL Found {} results".format(len(results_df)))
+
+        if args.output_file is not None and len(results_df) > 0:
+            if ".tsv" in args.output_file:
+                results_df.to_csv(args.output_file, index=False, sep="\t")
+            else:
+                results_df.to_csv(args.output_file, index=False)
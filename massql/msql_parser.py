@@ -1,14 +1,15 @@
 import os
+import copy
+import functools
 
 from lark import Lark
+from lark.exceptions import GrammarError
 from lark import Transformer
 from lark import tree
 
 from py_expression_eval import Parser
 math_parser = Parser()
 
-from pyteomics import mass
-
 
 
 #TODO: Update language definition to make it such that we can distinguish different functions
@@ -20,6 +21,17 @@ class MassQLToJSON(Transformer):
    def querykeyword(self, items):
       return "QUERY"
 
+   def limitkeyword(self, items):
+      return "LIMIT"
+
+   def limitclause(self, items):
+      limit = items[-1]
+
+      if limit != int(limit) or limit < 1:
+         raise Exception("LIMIT MUST BE A POSITIVE INTEGER")
+
+      return {"limit" : int(limit)}
+
    def booleanandconjunction(self, s):
       return "AND"
 
@@ -312,6 +324,9 @@ class MassQLToJSON(Transformer):
       items = [item for item in items if item != "WHERE"]
       items = [item for item in items if item != "QUERY"]
 
+      limit_items = [item for item in items if isinstance(item, dict) and "limit" in item]
+      items = [item for item in items if not (isinstance(item, dict) and "limit" in item)]
+
       if len(items) == 1:
          query_dict = {}
          query_dict["querytype"] = items[0]
@@ -327,6 +342,9 @@ class MassQLToJSON(Transformer):
          query_dict["querytype"] = items[0]
          query_dict["conditions"] = items[1] + items[2]
 
+      if len(limit_items) > 0:
+         query_dict["limit"] = limit_items[0]["limit"]
+
       return query_dict
 
    def qualifierfields(self, items):
@@ -404,11 +422,16 @@ class MassQLToJSON(Transformer):
       return merged_list
     
    def moleculeformula(self, items):
+      # pyteomics takes a while to import, only formulas and peptides need it
+      from pyteomics import mass
+
       exact_mass = mass.calculate_mass(formula=items[0])
 
       return exact_mass
 
    def aminoacids(self, items):
+      from pyteomics import mass
+
       exact_mass = mass.calculate_mass(sequence=items[0])
       exact_mass = exact_mass - mass.calculate_mass(formula="H2O")
       return exact_mass
@@ -423,6 +446,8 @@ class MassQLToJSON(Transformer):
       return items[0]
 
    def peptidefunction(self, items):
+      from pyteomics import mass
+
       exact_mass = mass.calculate_mass(sequence=items[0], ion_type=items[2].lower(), charge=int(items[1]))
       return exact_mass
    
@@ -447,11 +472,28 @@ def _has_variable(items):
 
    return False 
 
+# Parsed queries that are kept around, by query text
+PARSE_CACHE_SIZE = 1024
+
+# Parsers are built once per grammar
+_parsers = {}
+
+def _get_parser(path_to_grammar):
+   if not path_to_grammar in _parsers:
+      grammar = open(path_to_grammar).read()
+      try:
+         _parsers[path_to_grammar] = Lark(grammar, start='statement', parser='lalr')
+      except GrammarError:
+         # Custom grammars that are not LALR
+         _parsers[path_to_grammar] = Lark(grammar, start='statement')
+
+   return _parsers[path_to_grammar]
+
 def _visualize_parse(input_query, path_to_grammar=None, output_filename="parse.png"):
    if path_to_grammar is None:
       path_to_grammar = os.path.join(os.path.dirname(__file__), "msql.ebnf")
 
-   msql_parser = Lark(open(path_to_grammar).read(), start='statement')
+   msql_parser = _get_parser(path_to_grammar)
    parsed_tree = msql_parser.parse(input_query)
    tree.pydot__tree_to_png(parsed_tree, output_filename)
 
@@ -459,6 +501,11 @@ def parse_msql(input_query, path_to_grammar=None):
    if path_to_grammar is None:
       path_to_grammar = os.path.join(os.path.dirname(__file__), "msql.ebnf")
 
+   # Callers change the parse, e.g. the engine fills in subquery results, so everyone gets their own copy
+   return copy.deepcopy(_parse_msql_cached(input_query, path_to_grammar))
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_msql_cached(input_query, path_to_grammar):
    # NOTE: Force capitalization on the input_query, turning this off due to needing lower case in formulas
    # input_query = input_query.upper()
 
@@ -472,7 +519,7 @@ def parse_msql(input_query, path_to_grammar=None):
 
    input_query = "\n".join(query_splits)
 
-   msql_parser = Lark(open(path_to_grammar).read(), start='statement')
+   msql_parser = _get_parser(path_to_grammar)
    parsed_tree = msql_parser.parse(input_query)
    parsed_list = MassQLToJSON().transform(parsed_tree)
 
@@ -0,0 +1,241 @@
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import signal
+import socket
+import socketserver
+import time
+
+# Loaded files kept in memory by every worker
+DEFAULT_MAX_CACHED_FILES = 8
+
+def job_from_args(args):
+    """
+    Turns the arguments of msql_cmd into a job, paths are made absolute since the server runs somewhere else
+
+    Args:
+        args ([type]): parsed arguments of msql_cmd
+
+    Returns:
+        [type]: job dictionary
+    """
+    def _absolute(path):
+        return os.path.abspath(path) if path is not None else None
+
+    job = {}
+    job["filename"] = _absolute(args.filename)
+    job["query"] = args.query
+    job["output_file"] = _absolute(args.output_file)
+    job["cache"] = args.cache
+    job["original_path"] = args.original_path
+    job["extract_json"] = _absolute(args.extract_json)
+    job["maxfilesize"] = args.maxfilesize
+    job["backend"] = args.backend
+
+    return job
+
+def submit_jobs(socket_path, jobs):
+    """
+    Sends jobs to a running server, this does not import the engine so it starts quickly
+
+    Args:
+        socket_path ([type]): [description]
+        jobs ([type]): list of job dictionaries
+
+    Yields:
+        [type]: the result of every job as it finishes, job_index is the position of the job in jobs
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
+        client_socket.connect(socket_path)
+
+        for job in jobs:
+            client_socket.sendall((json.dumps(job) + "\n").encode("utf-8"))
+        client_socket.shutdown(socket.SHUT_WR)
+
+        with client_socket.makefile("r", encoding="utf-8") as response_file:
+            for line in response_file:
+                if len(line.strip()) > 0:
+                    yield json.loads(line)
+
+# Set once in every worker by _init_worker
+_worker_state = {}
+
+def _init_worker(max_cached_files):
+    # The server shuts the workers down, Ctrl-C in the terminal should not kill them in the middle of a job
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Paying for the imports and building the parser once per worker
+    from massql import msql_parser
+    from massql import msql_engine
+    from massql import msql_cmd
+
+    msql_parser.parse_msql("QUERY scaninfo(MS2DATA)")
+
+    _worker_state["data_cache"] = collections.OrderedDict()
+    _worker_state["max_cached_files"] = max_cached_files
+
+def _warm_worker(_):
+    return os.getpid()
+
+def _load_data_cached(filename, cache=True):
+    from massql import msql_fileloading
+
+    # A file that changed on disk is loaded again
+    file_stat = os.stat(filename)
+    data_key = (filename, file_stat.st_size, file_stat.st_mtime_ns, cache)
+
+    data_cache = _worker_state["data_cache"]
+    if data_key in data_cache:
+        data_cache.move_to_end(data_key)
+        return data_cache[data_key]
+
+    data_cache[data_key] = msql_fileloading.load_data(filename, cache=cache)
+    while len(data_cache) > _worker_state["max_cached_files"]:
+        data_cache.popitem(last=False)
+
+    return data_cache[data_key]
+
+def _execute_job(job):
+    from massql import msql_parser
+    from massql import msql_engine
+    from massql import msql_engine_summary
+    from massql import msql_cmd
+
+    start_time = time.perf_counter()
+
+    job_result = {}
+    job_result["status"] = "ok"
+    job_result["filename"] = job["filename"]
+
+    if job.get("maxfilesize", None) is not None:
+        if os.path.getsize(job["filename"]) / 1024 / 1024 > int(job["maxfilesize"]):
+            job_result["results"] = 0
+            job_result["skipped"] = "File is too big"
+            return job_result
+
+    all_queries = job["query"].split("|||")
+    parsed_queries = [msql_parser.parse_msql(query) for query in all_queries]
+    exists_only = all(parsed_query["querytype"]["function"] == "functionexists" for parsed_query in parsed_queries)
+
+    # Files whose summary shows the queries cannot match are not loaded
+    prune_reason = msql_engine_summary.prune_file(parsed_queries, job["filename"])
+    if prune_reason is not None:
+        job_result["results"] = 0
+        job_result["pruned"] = prune_reason
+        job_result["seconds"] = time.perf_counter() - start_time
+        return job_result
+
+    ms1_df, ms2_df = _load_data_cached(job["filename"], cache=(job.get("cache", "YES") == "YES"))
+    results_df = msql_engine.process_queries(all_queries, job["filename"], ms1_df=ms1_df, ms2_df=ms2_df, backend=job.get("backend", "pandas"))
+
+    msql_cmd._save_results(results_df, job["filename"], output_file=job.get("output_file", None), original_path=job.get("original_path", None),
+                            extract_json=job.get("extract_json", None), exists_only=exists_only)
+
+    job_result["results"] = len(results_df)
+    job_result["seconds"] = time.perf_counter() - start_time
+
+    return job_result
+
+def _error_result(e, filename=None):
+    return {"status" : "error", "error" : "{}: {}".format(type(e).__name__, e), "filename" : filename}
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    def _send_result(self, job_result, job_index):
+        job_result["job_index"] = job_index
+
+        self.wfile.write((json.dumps(job_result) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self):
+        futures = {}
+        for job_index, line in enumerate(self.rfile):
+            if len(line.strip()) == 0:
+                continue
+
+            # A line that is not a job fails on its own, the other jobs still run
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise Exception("JOB IS NOT AN OBJECT")
+            except Exception as e:
+                self._send_result(_error_result(e), job_index)
+                continue
+
+            futures[self.server.executor.submit(_execute_job, job)] = (job_index, job)
+
+        # Results go back as soon as they are done, not in the order they were sent
+        for future in concurrent.futures.as_completed(futures):
+            job_index, job = futures[future]
+            try:
+                job_result = future.result()
+            except Exception as e:
+                job_result = _error_result(e, filename=job.get("filename", None))
+
+            self._send_result(job_result, job_index)
+
+class QueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Takes jobs over a unix socket and runs them on a pool of warm workers. Every worker has the engine imported,
+    the parser built and the last few files it loaded in memory.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, num_workers=None, max_cached_files=DEFAULT_MAX_CACHED_FILES):
+        from massql import msql_engine_parallel
+
+        # Left over from a server that did not shut down cleanly
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        self.socket_path = socket_path
+        self.num_workers = msql_engine_parallel._get_num_workers(num_workers)
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.num_workers, initializer=_init_worker, initargs=(max_cached_files,))
+
+        # Starting the workers now so the first jobs do not wait for them
+        list(self.executor.map(_warm_worker, range(self.num_workers)))
+
+        socketserver.UnixStreamServer.__init__(self, socket_path, _JobHandler)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.executor.shutdown(wait=True)
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+def serve(socket_path, num_workers=None, max_cached_files=DEFAULT_MAX_CACHED_FILES):
+    """
+    Runs the server until it is interrupted
+
+    Args:
+        socket_path ([type]): [description]
+        num_workers ([type], optional): [description]. Defaults to None, which uses every available core
+        max_cached_files ([type], optional): [description]. Defaults to DEFAULT_MAX_CACHED_FILES.
+    """
+    server = QueryServer(socket_path, num_workers=num_workers, max_cached_files=max_cached_files)
+
+    # Stopping cleanly when the scheduler kills us too
+    def _stop(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, _stop)
+
+    print("MassQL serving on {} with {} workers".format(socket_path, server.num_workers), flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MassQL server, run queries with massql --server")
+    parser.add_argument('--socket', required=True, help='Unix socket to listen on')
+    parser.add_argument('--num_workers', default=None, type=int, help='Number of worker processes, default is every available core')
+    parser.add_argument('--max_cached_files', default=DEFAULT_MAX_CACHED_FILES, type=int, help='Number of loaded files every worker keeps in memory')
+
+    args = parser.parse_args(argv)
+
+    serve(args.socket, num_workers=args.num_workers, max_cached_files=args.max_cached_files)
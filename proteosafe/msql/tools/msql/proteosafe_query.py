@@ -6,7 +6,6 @@ import argparse
 import glob
 import sys
 import pandas as pd
-import ray
 
 import ming_proteosafe_library
 
@@ -34,36 +33,18 @@ def main():
     input_files_list += glob.glob(os.path.join(input_folder, "*.mzXML"))
     input_files_list += glob.glob(os.path.join(input_folder, "*.mgf"))
 
+    # Files run on local processes as they fit in memory, a file that fails does not stop the others
     all_results_list = []
+    workers = None if len(input_files_list) > 1 and PARALLEL == "YES" else 1
+    for input_filename, results_df, error in msql_engine.process_query_files(msql_query, input_files_list, path_to_grammar=path_to_grammar, cache=False, parallel=(PARALLEL=="YES"), workers=workers):
+        if error is not None:
+            print("MassQL Error", input_filename, error)
 
-    # Initialize Ray
-    msql_engine.init_ray()
+        real_filename = mangled_mapping[os.path.basename(input_filename)]
+        results_df["filename"] = real_filename
+        results_df["mangled_filename"] = os.path.basename(input_filename)
 
-    # Parallel Version
-    if len(input_files_list) > 1 and PARALLEL == "YES":
-        all_futures = []
-
-        for input_filename in input_files_list:
-            results_future = execute_query_ray.remote(msql_query, input_filename, path_to_grammar=path_to_grammar, cache=False, parallel=(PARALLEL=="YES"))
-            all_futures.append((results_future, input_filename))
-
-        for result_future, input_filename in all_futures:
-            results_df = ray.get(result_future)
-            real_filename = mangled_mapping[os.path.basename(input_filename)]
-            results_df["filename"] = real_filename
-            results_df["mangled_filename"] = os.path.basename(input_filename)
-
-            all_results_list.append(results_df)
-    else:
-        # Serial Version
-        all_results_list = []
-        for input_filename in input_files_list:
-            results_df = execute_query(msql_query, input_filename, path_to_grammar=path_to_grammar, cache=False, parallel=(PARALLEL=="YES"))
-            real_filename = mangled_mapping[os.path.basename(input_filename)]
-            results_df["filename"] = real_filename
-            results_df["mangled_filename"] = os.path.basename(input_filename)
-
-            all_results_list.append(results_df)
+        all_results_list.append(results_df)
 
     merged_results_df = pd.concat(all_results_list)
     if "scan" in merged_results_df:
@@ -81,22 +62,5 @@ def main():
     merged_results_df.to_csv(output_results_file, sep='\t', index=False)
 
 
-@ray.remote
-def execute_query_ray(msql_query, input_filename, path_to_grammar="msql.ebnl", cache=False, parallel=True):
-    try:
-        results_df = msql_engine.process_query(msql_query, input_filename, path_to_grammar=path_to_grammar, cache=cache, parallel=parallel)
-    except:
-        return pd.DataFrame()
-
-    return results_df
-
-def execute_query(msql_query, input_filename, path_to_grammar="msql.ebnl", cache=False, parallel=True):
-    try:
-        results_df = msql_engine.process_query(msql_query, input_filename, path_to_grammar=path_to_grammar, cache=cache, parallel=parallel)
-    except:
-        return pd.DataFrame()
-
-    return results_df
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# Time of the numba kernels against the pandas code they replace, and against their numpy versions, on synthetic peaks
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(current_dir, ".."))
+
+from massql import msql_engine_index
+from massql import msql_engine_kernels
+
+def _synthetic_peaks(num_scans, peaks_per_scan, seed=0):
+    random_generator = np.random.default_rng(seed)
+    num_peaks = num_scans * peaks_per_scan
+
+    return pd.DataFrame({"i" : random_generator.exponential(1000, num_peaks), "i_norm" : random_generator.uniform(0, 1, num_peaks),
+                        "i_tic_norm" : random_generator.uniform(0, 0.05, num_peaks), "mz" : random_generator.uniform(50, 1000, num_peaks),
+                        "scan" : np.repeat(np.arange(1, num_scans + 1), peaks_per_scan)})
+
+def _benchmarks(ms_df):
+    scans = ms_df["scan"].to_numpy()
+    offsets = msql_engine_kernels.run_offsets(scans)
+    matched_scans = np.unique(scans)[::7]
+    run_mask = np.isin(scans[offsets[:-1]], matched_scans)
+    defects = (ms_df["mz"] - ms_df["mz"].astype(int)).to_numpy()
+    windows = [(226.17, 226.19), (300.09, 300.11), (451.19, 451.21)]
+    min_values, max_values = msql_engine_index.merge_windows(np.array([window[0] for window in windows]), np.array([window[1] for window in windows]))
+    mz = ms_df["mz"].to_numpy()
+
+    benchmarks = {}
+
+    # Keeping the peaks of the matched scans, e.g. EXCLUDED
+    benchmarks["expand_runs"] = {
+        "pandas" : lambda: ms_df["scan"].isin(set(matched_scans)).to_numpy(),
+        "kernel" : lambda: msql_engine_kernels.expand_runs(run_mask, offsets)}
+
+    # Summed intensity of every scan, for the intensity match register
+    benchmarks["run_sums"] = {
+        "pandas" : lambda: ms_df.groupby("scan")["i"].sum().to_numpy(),
+        "kernel" : lambda: msql_engine_kernels.run_sums(ms_df["i"].to_numpy(), offsets)}
+
+    # Peaks in any of the m/z windows of a condition, e.g. MS2PROD with several values
+    benchmarks["windows_mask"] = {
+        "pandas" : lambda: np.logical_or.reduce([((ms_df["mz"] > min_value) & (ms_df["mz"] < max_value)).to_numpy() for min_value, max_value in windows]),
+        "kernel" : lambda: msql_engine_kernels.windows_mask(mz, min_values, max_values)}
+
+    # Intensity and mass defect of ANY
+    benchmarks["peaks_mask"] = {
+        "pandas" : lambda: ((ms_df["i"] > 100) & (ms_df["i_norm"] > 0.1) & (ms_df["i_tic_norm"] > 0.01) &
+                            (pd.Series(defects) > 0.1).to_numpy() & (pd.Series(defects) < 0.2).to_numpy()).to_numpy(),
+        "kernel" : lambda: msql_engine_kernels.peaks_mask(ms_df, 100, 0.1, 0.01, defects=defects, massdefect_min=0.1, massdefect_max=0.2)}
+
+    return benchmarks
+
+def _time_function(function, repeats):
+    wall_times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        wall_times.append(time.perf_counter() - start_time)
+
+    return wall_times
+
+def main():
+    parser = argparse.ArgumentParser(description="MassQL kernel benchmark")
+    parser.add_argument('--num_scans', default=20000, type=int, help='Number of scans')
+    parser.add_argument('--peaks_per_scan', default=200, type=int, help='Number of peaks in each scan')
+    parser.add_argument('--repeats', default=5, type=int, help='Number of times to run each function')
+    parser.add_argument('--output_json', default=None, help='Saving the timings as json to this filename, to track them over time')
+
+    args = parser.parse_args()
+
+    ms_df = _synthetic_peaks(args.num_scans, args.peaks_per_scan)
+    print("{} peaks, numba {}".format(len(ms_df), "installed" if msql_engine_kernels.USE_NUMBA else "not installed"))
+
+    implementations = ["pandas", "numpy", "numba"] if msql_engine_kernels.USE_NUMBA else ["pandas", "numpy"]
+
+    results = {}
+    for benchmark_name, functions in _benchmarks(ms_df).items():
+        results[benchmark_name] = {}
+
+        for implementation in implementations:
+            function = functions["pandas"] if implementation == "pandas" else functions["kernel"]
+
+            msql_engine_kernels.USE_NUMBA = implementation == "numba"
+            try:
+                # The first call compiles the kernel
+                expected_values = functions["pandas"]()
+                if not np.allclose(function(), expected_values):
+                    print("{} {} does not match pandas".format(benchmark_name, implementation))
+                    exit(1)
+
+                wall_times = _time_function(function, args.repeats)
+            finally:
+                msql_engine_kernels.USE_NUMBA = "numba" in implementations
+
+            results[benchmark_name][implementation] = {"median" : statistics.median(wall_times), "min" : min(wall_times)}
+
+        print("{:<13} ".format(benchmark_name) + " ".join("{}={:.4f}s".format(implementation, results[benchmark_name][implementation]["median"])
+                                                        for implementation in implementations))
+
+    if args.output_json is not None:
+        with open(args.output_json, "w") as output_file:
+            output_file.write(json.dumps(results, indent=4))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# Startup time of the command line tool, this is paid once per file in the workflow
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.join(current_dir, "..")
+msql_cmd = os.path.join(root_dir, "massql", "msql_cmd.py")
+
+BENCHMARKS = {}
+BENCHMARKS["import_engine"] = [sys.executable, "-c", "import massql.msql_engine"]
+BENCHMARKS["help"] = [sys.executable, msql_cmd, "--help"]
+BENCHMARKS["trivial_query"] = [sys.executable, msql_cmd, os.path.join(current_dir, "test_data", "top_down.mgf"), "QUERY scaninfo(MS2DATA)", "--cache", "NO"]
+
+def _time_command(command, repeats):
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = root_dir + os.pathsep + environment.get("PYTHONPATH", "")
+
+    wall_times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=environment, cwd=root_dir)
+        wall_times.append(time.perf_counter() - start_time)
+
+    return wall_times
+
+def main():
+    parser = argparse.ArgumentParser(description="MassQL startup benchmark")
+    parser.add_argument('--repeats', default=5, type=int, help='Number of times to run each command')
+    parser.add_argument('--output_json', default=None, help='Saving the timings as json to this filename, to track them over time')
+    parser.add_argument('--max_help_seconds', default=None, type=float, help='Fail when the median time of --help is over this')
+
+    args = parser.parse_args()
+
+    results = {}
+    for benchmark_name, command in BENCHMARKS.items():
+        wall_times = _time_command(command, args.repeats)
+        results[benchmark_name] = {"median" : statistics.median(wall_times), "min" : min(wall_times), "max" : max(wall_times)}
+        print("{:<15} median={:.3f}s min={:.3f}s max={:.3f}s".format(benchmark_name, results[benchmark_name]["median"],
+                                                                    results[benchmark_name]["min"], results[benchmark_name]["max"]))
+
+    if args.output_json is not None:
+        with open(args.output_json, "w") as output_file:
+            output_file.write(json.dumps(results, indent=4))
+
+    if args.max_help_seconds is not None and results["help"]["median"] > args.max_help_seconds:
+        print("--help is too slow")
+        exit(1)
+
+if __name__ == "__main__":
+    main()
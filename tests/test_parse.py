@@ -207,6 +207,33 @@ def test_wildcard():
     parsed_output = msql_parser.parse_msql(query)
     print(parsed_output)
 
+def test_limit():
+    query = "QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18 FILTER MS2PROD=226.18 LIMIT 5"
+    parsed_output = msql_parser.parse_msql(query)
+    print(parsed_output)
+    assert(parsed_output["limit"] == 5)
+    assert(len(parsed_output["conditions"]) == 2)
+
+    query = "QUERY exists(MS2DATA) WHERE MS2PROD=226.18"
+    parsed_output = msql_parser.parse_msql(query)
+    assert(parsed_output["querytype"]["function"] == "functionexists")
+    assert(not "limit" in parsed_output)
+
+    with pytest.raises(Exception):
+        msql_parser.parse_msql("QUERY scaninfo(MS2DATA) LIMIT 2.5")
+
+def test_parse_cache():
+    query = "QUERY scaninfo(MS2DATA) WHERE MS2PREC=X AND MS2PROD=226.18"
+    parsed_output = msql_parser.parse_msql(query)
+
+    # Changing what we got back does not change the next parse
+    parsed_output["conditions"][0]["value"] = [1.0]
+    parsed_output["conditions"].pop()
+
+    parsed_output = msql_parser.parse_msql(query)
+    assert(len(parsed_output["conditions"]) == 2)
+    assert(parsed_output["conditions"][0]["value"] == ["X"])
+
 
 def main():
     #test_xrange_parse()
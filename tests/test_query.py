@@ -9,9 +9,24 @@ from massql import msql_parser
 from massql import msql_engine
 from massql import msql_translator
 from massql import msql_fileloading
-
+from massql import msql_engine_template
+from massql import msql_engine_results
+from massql import msql_engine_profile
+from massql import msql_engine_parallel
+from massql import msql_engine_cache
+from massql import msql_engine_filters
+from massql import msql_engine_index
+from massql import msql_engine_files
+from massql import msql_engine_duckdb
+from massql import msql_engine_polars
+
+import copy
 import json
+import pickle
+import shutil
 import pytest
+import numpy as np
+import pandas as pd
 
 
 def test_query():
@@ -657,6 +672,782 @@ def test_scanmaxint_query():
 
     print(results_df)
 
+def test_query_template():
+    query = "QUERY scaninfo(MS2DATA) WHERE MS1MZ=X-2:INTENSITYMATCH=Y*(0.0608+(.000002*X)):INTENSITYMATCHPERCENT=25 AND \
+        MS1MZ=X:INTENSITYMATCH=Y:INTENSITYMATCHREFERENCE AND MS2PROD=119.09 AND \
+        MOBILITY=range(min=X*0.0011+0.5-0.1, max=1)"
+    parse_obj = msql_parser.parse_msql(query)
+    query_template = msql_engine_template.QueryTemplate(parse_obj)
+
+    assert(query_template.has_variable)
+    assert(len(query_template.non_variable_query()["conditions"]) == 1)
+
+    concrete_query = query_template.bind(500)
+    assert(concrete_query["comment"] == 500)
+    assert(concrete_query["conditions"][0]["value"] == [498])
+    assert(concrete_query["conditions"][0]["qualifiers"]["qualifierintensitymatch"]["value"] == "Y*0.0608+2e-06*500")
+    assert(concrete_query["conditions"][1]["value"] == [500])
+    assert(concrete_query["conditions"][3]["min"] == 500 * 0.0011 + 0.5 - 0.1)
+
+    # The conditions without X are shared and the template is untouched
+    assert(concrete_query["conditions"][2] is query_template.conditions[2])
+    assert(query_template.conditions[0]["value"] == ["X-2.0"])
+    assert(query_template.conditions[0]["qualifiers"]["qualifierintensitymatch"]["value"] == "Y*0.0608+2e-06*X")
+
+    # Pickling for sending to other processes
+    unpickled_template = pickle.loads(pickle.dumps(query_template))
+    assert(unpickled_template.bind(500) == concrete_query)
+
+def _synthetic_data():
+    # Two MS1 scans, each followed by two MS2 scans, fragment 226.18 appears in scans 2 and 5. For the edge cases that are hard to find in the test files
+    ms1_df = pd.DataFrame()
+    ms1_df["i"] = [100.0, 50.0, 80.0, 40.0]
+    ms1_df["i_norm"] = [1.0, 0.5, 1.0, 0.5]
+    ms1_df["i_tic_norm"] = [0.66, 0.33, 0.66, 0.33]
+    ms1_df["mz"] = [500.1, 300.2, 500.1, 400.3]
+    ms1_df["scan"] = [1, 1, 4, 4]
+    ms1_df["rt"] = [0.1, 0.1, 0.4, 0.4]
+    ms1_df["polarity"] = [1, 1, 1, 1]
+
+    ms2_df = pd.DataFrame()
+    ms2_df["i"] = [10.0, 5.0, 10.0, 5.0, 10.0, 5.0, 10.0, 5.0]
+    ms2_df["i_norm"] = [1.0, 0.5, 1.0, 0.5, 1.0, 0.5, 1.0, 0.5]
+    ms2_df["i_tic_norm"] = [0.66, 0.33, 0.66, 0.33, 0.66, 0.33, 0.66, 0.33]
+    ms2_df["mz"] = [226.18, 100.0, 150.0, 100.0, 226.18, 120.0, 150.0, 100.0]
+    ms2_df["scan"] = [2, 2, 3, 3, 5, 5, 6, 6]
+    ms2_df["rt"] = [0.2, 0.2, 0.3, 0.3, 0.5, 0.5, 0.6, 0.6]
+    ms2_df["polarity"] = [1, 1, 1, 1, 1, 1, 1, 1]
+    ms2_df["precmz"] = [500.1, 500.1, 300.2, 300.2, 400.3, 400.3, 500.1, 500.1]
+    ms2_df["ms1scan"] = [1, 1, 1, 1, 4, 4, 4, 4]
+    ms2_df["charge"] = [1, 1, 1, 1, 1, 1, 1, 1]
+
+    return ms1_df, ms2_df
+
+def _copy_test_file(tmp_path, name, input_filename="tests/data/GNPS00002_A3_p.mzML", ms2_df=None):
+    # A copy of the file with its feather cache next to it, so the copy can be changed without loading it again
+    ms1_df, file_ms2_df = msql_fileloading.load_data(input_filename, cache=True)
+
+    copy_filename = str(tmp_path / name)
+    shutil.copyfile(input_filename, copy_filename)
+    ms1_df.to_feather(copy_filename + "_ms1.msql.feather")
+    (file_ms2_df if ms2_df is None else ms2_df).to_feather(copy_filename + "_ms2.msql.feather")
+
+    return copy_filename
+
+def _check_index_parity(queries, input_filename="tests/data/GNPS00002_A3_p.mzML"):
+    # With a shared plan the peak conditions go through the sorted index, without one through masks over the peaks
+    ms1_df, ms2_df = msql_fileloading.load_data(input_filename, cache=True)
+
+    for query in queries:
+        parsed_dict = msql_parser.parse_msql(query)
+        index_ms1_df, index_ms2_df = msql_engine._executeconditions_query(copy.deepcopy(parsed_dict), input_filename, ms1_input_df=ms1_df, ms2_input_df=ms2_df, shared_plan={})
+        mask_ms1_df, mask_ms2_df = msql_engine._executeconditions_query(copy.deepcopy(parsed_dict), input_filename, ms1_input_df=ms1_df, ms2_input_df=ms2_df)
+
+        pd.testing.assert_frame_equal(index_ms1_df, mask_ms1_df)
+        pd.testing.assert_frame_equal(index_ms2_df, mask_ms2_df)
+
+def test_subquery_shared_data(monkeypatch):
+    ms1_df, ms2_df = msql_fileloading.load_data("tests/data/GNPS00002_A3_p.mzML", cache=True)
+    expected_df = msql_engine.process_query("QUERY scanmz(MS2DATA) WHERE MS2PROD=226.18", "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+
+    def _fail_loading(*args, **kwargs):
+        raise Exception("Data should not be reloaded")
+    monkeypatch.setattr(msql_fileloading, "load_data", _fail_loading)
+
+    executed_queries = []
+    evalute_variable_query = msql_engine._evalute_variable_query
+    def _counting_evalute_variable_query(parsed_dict, *args, **kwargs):
+        executed_queries.append(parsed_dict)
+        return evalute_variable_query(parsed_dict, *args, **kwargs)
+    monkeypatch.setattr(msql_engine, "_evalute_variable_query", _counting_evalute_variable_query)
+
+    query = "QUERY scaninfo(MS1DATA) WHERE MS1MZ=(QUERY scanmz(MS2DATA) WHERE MS2PROD=226.18) AND \
+        MS2PREC=(QUERY scanmz(MS2DATA) WHERE MS2PROD=226.18)"
+    msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+
+    # Outer query plus a single execution of the repeated subquery
+    assert(len(executed_queries) == 2)
+
+    # Subquery results are flattened into a sorted array
+    subquery_values = executed_queries[0]["conditions"][0]["value"]
+    assert(isinstance(subquery_values, np.ndarray))
+    assert(len(subquery_values) > 0)
+    assert(np.array_equal(subquery_values, np.sort(expected_df["precmz"].to_numpy(dtype=float))))
+
+def test_process_queries_shared():
+    all_queries = ["QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18",
+                    "QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18:TOLERANCEPPM=5 AND RTMIN=1",
+                    "QUERY MS2DATA WHERE MS2PROD=226.18 FILTER MS2PROD=226.18",
+                    "QUERY scaninfo(MS1DATA) WHERE MS1MZ=(QUERY scanmz(MS2DATA) WHERE MS2PROD=226.18)",
+                    "QUERY scaninfo(MS2DATA) WHERE MS2PREC=X AND MS2PROD=226.18"]
+
+    # The file is loaded once for all the queries, against loading it for every query
+    results_df = msql_engine.process_queries(all_queries, "tests/data/GNPS00002_A3_p.mzML")
+
+    for query_index, query in enumerate(all_queries):
+        expected_df = msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML")
+        query_results_df = results_df[results_df["query_index"] == query_index].drop(columns=["query_index"])
+
+        assert(len(query_results_df) == len(expected_df))
+        if len(expected_df) > 0:
+            # Results of all the queries are in one data frame, columns missing from some are promoted to float
+            pd.testing.assert_frame_equal(query_results_df[expected_df.columns].reset_index(drop=True), expected_df.reset_index(drop=True), check_dtype=False)
+
+    # Input data is left untouched
+    ms1_df, ms2_df = msql_fileloading.load_data("tests/data/GNPS00002_A3_p.mzML", cache=True)
+    ms1_columns, ms2_columns = list(ms1_df.columns), list(ms2_df.columns)
+    msql_engine.process_queries(all_queries, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+    assert(list(ms1_df.columns) == ms1_columns)
+    assert(list(ms2_df.columns) == ms2_columns)
+
+def test_intensity_match_register():
+    # Ratios exactly on the edge of INTENSITYMATCHPERCENT
+    ms1_df, ms2_df = _synthetic_data()
+
+    query = "QUERY scaninfo(MS1DATA) WHERE MS1MZ=500.1:INTENSITYMATCH=Y:INTENSITYMATCHREFERENCE AND \
+        MS1MZ=300.2:INTENSITYMATCH=Y*0.5:INTENSITYMATCHPERCENT=10"
+    results_df = msql_engine.process_query(query, "synthetic.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+    assert(list(results_df["scan"]) == [1])
+
+    query = "QUERY scaninfo(MS1DATA) WHERE MS1MZ=500.1:INTENSITYMATCH=Y:INTENSITYMATCHREFERENCE AND \
+        MS1MZ=300.2:INTENSITYMATCH=Y*0.9:INTENSITYMATCHPERCENT=10"
+    results_df = msql_engine.process_query(query, "synthetic.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+    assert(len(results_df) == 0)
+
+def test_collate_functions():
+    ms1_df, ms2_df = msql_fileloading.load_data("tests/data/GNPS00002_A3_p.mzML", cache=True)
+
+    def _query(query):
+        return msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+
+    # Against the groupby of the peaks, the first peak of every scan with the intensity summed or the max
+    for query, ms_df, intensity_function in [("QUERY scansum(MS1DATA)", ms1_df, "sum"), ("QUERY scansum(MS2DATA)", ms2_df, "sum"),
+                                                ("QUERY scanmaxint(MS1DATA)", ms1_df, "max"), ("QUERY scanmaxint(MS2DATA)", ms2_df, "max")]:
+        expected_df = ms_df.groupby("scan").first().reset_index()
+        expected_df["i"] = ms_df.groupby("scan")["i"].agg(intensity_function).to_numpy()
+
+        pd.testing.assert_frame_equal(_query(query), expected_df)
+
+    results_df = _query("QUERY scaninfo(MS2DATA)")
+    assert(list(results_df.columns) == ["scan", "precmz", "ms1scan", "rt", "charge", "i", "i_norm", "mslevel", "i_norm_ms1"])
+    assert(np.allclose(results_df["i"], ms2_df.groupby("scan")["i"].sum()[results_df["scan"]]))
+    assert(np.allclose(results_df["i_norm"], ms2_df.groupby("scan")["i_norm"].max()[results_df["scan"]]))
+
+    # Bins in ascending order, then scans
+    results_df = _query("QUERY scanrangesum(MS1DATA, TOLERANCE=0.1)")
+    binned_df = ms1_df.assign(bin=(ms1_df["mz"] / 0.1).astype(int))
+    expected_i = binned_df.groupby(["bin", "scan"])["i"].sum()
+
+    assert(results_df[["bin", "scan"]].equals(results_df[["bin", "scan"]].sort_values(["bin", "scan"])))
+    assert(len(results_df) == len(expected_i))
+    assert(np.allclose(results_df["i"], expected_i[list(zip(results_df["bin"], results_df["scan"]))]))
+
+def test_scanrangesum_ms2():
+    query = "QUERY scanrangesum(MS2DATA) WHERE MS2PROD=226.18"
+    results_df = msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML")
+
+    peaks_df = msql_engine.process_query("QUERY MS2DATA WHERE MS2PROD=226.18", "tests/data/GNPS00002_A3_p.mzML")
+    scan_intensities = peaks_df.groupby("scan")["i"].sum()
+
+    assert(len(results_df) > 0)
+    assert(np.allclose(results_df["i"], scan_intensities[results_df["scan"]]))
+
+def test_profile_query():
+    ms1_df, ms2_df = msql_fileloading.load_data("tests/data/GNPS00002_A3_p.mzML", cache=True)
+
+    query = "QUERY scaninfo(MS2DATA) WHERE MS2PREC=X AND MS2PROD=226.18 AND RTMIN=0.1"
+    results_df, query_profile = msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df, profile=True)
+    assert(isinstance(query_profile, msql_engine_profile.QueryProfile))
+
+    # Profiling does not change the results
+    pd.testing.assert_frame_equal(results_df, msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df))
+
+    profile_dict = json.loads(query_profile.to_json())
+    operators = {child["operator"] : child for child in profile_dict["children"]}
+    assert(operators["expand X"]["candidates"] > 0)
+    assert(operators["concrete queries"]["calls"] == operators["expand X"]["candidates"])
+    assert(operators["presearch"]["rows_in"]["ms2"] == len(ms2_df))
+
+    # The peaks of the scans with the fragment
+    presearch_df = msql_engine.process_query("QUERY MS2DATA WHERE MS2PROD=226.18 AND RTMIN=0.1", "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+    where_operator = [child for child in operators["presearch"]["children"] if child["operator"] == "where ms2productcondition"][0]
+    assert(where_operator["rows_out"]["ms2"] == len(presearch_df))
+    assert(where_operator["scans_out"]["ms2"] == presearch_df["scan"].nunique())
+
+    assert("concrete queries" in query_profile.format_tree())
+
+    # Explaining does not touch the data
+    explain_tree = msql_engine.explain_query(query).format_tree()
+    assert("where ms2precursorcondition [value=X]" in explain_tree)
+    assert("time=" not in explain_tree)
+
+def test_parallel_processes(monkeypatch):
+    ms1_df, ms2_df = msql_fileloading.load_data("tests/data/GNPS00002_A3_p.mzML", cache=True)
+    monkeypatch.setattr(msql_engine_parallel, "PARALLEL_MIN_QUERIES", 1)
+
+    query = "QUERY scaninfo(MS2DATA) WHERE MS2PREC=X AND MS2PROD=226.18"
+    serial_df = msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+    parallel_df = msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df, parallel=2)
+
+    assert(len(serial_df) > 0)
+    pd.testing.assert_frame_equal(serial_df, parallel_df)
+
+    # Without shared memory, before python 3.8, the queries run serially
+    monkeypatch.setattr(msql_engine_parallel, "shared_memory", None)
+    monkeypatch.setattr(msql_engine_parallel, "execute_concrete_queries", None)
+    pd.testing.assert_frame_equal(serial_df, msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df, parallel=2))
+
+def test_parallel_shared_memory():
+    ms1_df, ms2_df = msql_fileloading.load_data("tests/data/GNPS00002_A3_p.mzML", cache=True)
+
+    ms1_block, ms1_spec = msql_engine_parallel._share_dataframe(ms1_df)
+    ms2_block, ms2_spec = msql_engine_parallel._share_dataframe(ms2_df)
+    try:
+        # What a worker does, the data is still in the shared memory after it is queried
+        parsed_dict = msql_parser.parse_msql("QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18")
+        msql_engine_parallel._init_worker(parsed_dict, ms1_spec, ms2_spec)
+        collated_list = msql_engine_parallel._execute_chunk([msql_parser.parse_msql("QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18")])
+
+        pd.testing.assert_frame_equal(collated_list[0], msql_engine.process_query("QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18", "tests/data/GNPS00002_A3_p.mzML"))
+
+        # Filtering consolidates data frames whose columns are not laid out the way pandas keeps them
+        worker_ms2_df = msql_engine_parallel._worker_state["ms2_df"]
+        worker_ms2_df[worker_ms2_df["mz"] > 226.0].groupby("scan").sum()
+        pd.testing.assert_frame_equal(worker_ms2_df, ms2_df, check_index_type=False)
+
+        shared_values = np.ndarray((msql_engine_parallel._worker_state["blocks"][1].size,), dtype=np.uint8, buffer=msql_engine_parallel._worker_state["blocks"][1].buf)
+        for column in ["i", "mz", "rt", "precmz"]:
+            assert(np.shares_memory(worker_ms2_df[column].to_numpy(), shared_values))
+        del shared_values, worker_ms2_df
+    finally:
+        worker_blocks = msql_engine_parallel._worker_state.get("blocks", [])
+        msql_engine_parallel._worker_state.clear()
+        for shared_block in worker_blocks:
+            shared_block.close()
+        for shared_block in [ms1_block, ms2_block]:
+            shared_block.close()
+            shared_block.unlink()
+
+def test_limit_exists():
+    ms1_df, ms2_df = msql_fileloading.load_data("tests/data/GNPS00002_A3_p.mzML", cache=True)
+
+    def _query(query):
+        return msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+
+    # Stopping early gives the first results of running the whole query
+    for query in ["QUERY scaninfo(MS2DATA) WHERE MS2PREC=X AND MS2PROD=226.18", "QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18"]:
+        all_df = _query(query)
+        assert(len(all_df) > 1)
+
+        for limit in [1, 3]:
+            limit_df = _query(query + " LIMIT {}".format(limit))
+            pd.testing.assert_frame_equal(all_df.head(limit).reset_index(drop=True), limit_df.reset_index(drop=True))
+
+    all_df = _query("QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18")
+    exists_df = _query("QUERY exists(MS2DATA) WHERE MS2PREC=X AND MS2PROD=226.18")
+    assert(len(exists_df) == 1)
+    assert(exists_df["exists"][0] == 1)
+    assert(exists_df["scan"][0] in set(all_df["scan"]))
+
+    exists_df = _query("QUERY exists(MS2DATA) WHERE MS2PROD=999.0")
+    assert(len(exists_df) == 0)
+
+def test_sorted_scan_filters():
+    ms1_df, ms2_df = msql_fileloading.load_data("tests/data/GNPS00002_A3_p.mzML", cache=True)
+
+    # The loaders emit the scans in acquisition order
+    assert(msql_engine_index.is_sorted(ms2_df, "scan"))
+    assert(msql_engine_index.is_sorted(ms2_df, "rt"))
+    assert(msql_engine_index.is_sorted(ms1_df, "rt"))
+
+    # Windows in the middle of the run
+    rt_min, rt_max = ms2_df["rt"].quantile([0.3, 0.6])
+    scan_min, scan_max = ms2_df["scan"].quantile([0.3, 0.6]).astype(int)
+
+    # Slicing, and the mask when it was reordered after it was checked
+    for ms_df in [ms2_df, ms2_df.sort_values("mz"), ms2_df.iloc[::-1], pd.concat([ms2_df, ms2_df])]:
+        masked_df = ms_df[(ms_df["rt"] > rt_min) & (ms_df["rt"] < rt_max)]
+        pd.testing.assert_frame_equal(msql_engine_index.range_rows(ms_df, "rt", min_value=rt_min, max_value=rt_max), masked_df)
+
+        masked_df = ms_df[(ms_df["scan"] >= scan_min) & (ms_df["scan"] <= scan_max)]
+        pd.testing.assert_frame_equal(msql_engine_index.range_rows(ms_df, "scan", min_value=scan_min, max_value=scan_max, inclusive=True), masked_df)
+
+    assert(not msql_engine_index.is_sorted(ms2_df.sort_values("mz"), "rt"))
+
+    # Values edited in place after they were found sorted
+    edited_df = pd.DataFrame({"scan": [1, 2, 3], "rt": [1.0, 2.0, 3.0]})
+    assert(len(msql_engine_index.range_rows(edited_df, "rt", min_value=1.5)) == 2)
+    edited_df.loc[0, "rt"] = 10.0
+    assert(list(msql_engine_index.range_rows(edited_df, "rt", min_value=4.5)["rt"]) == [10.0])
+
+    queries = ["QUERY scaninfo(MS2DATA) WHERE RTMIN={} AND RTMAX={}".format(rt_min, rt_max),
+                "QUERY scaninfo(MS2DATA) WHERE SCANMIN={} AND SCANMAX={}".format(scan_min, scan_max),
+                "QUERY scaninfo(MS1DATA) WHERE RTMIN={}".format(rt_min),
+                "QUERY scaninfo(MS2DATA) WHERE RTMIN={} AND SCANMAX={} AND MS2PROD=226.18".format(ms2_df["rt"].min(), ms2_df["scan"].max())]
+
+    # Data sorted by m/z after loading gives the same scans
+    for query in queries + ["QUERY scaninfo(MS2DATA) WHERE RTMIN=5 AND RTMAX=10"]:
+        ordered_df = msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+        reordered_df = msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df.sort_values("mz"), ms2_df=ms2_df.sort_values("mz"))
+
+        assert(len(ordered_df) > 0 or not query in queries)
+        assert(len(ordered_df) == len(reordered_df))
+        if len(ordered_df) > 0:
+            pd.testing.assert_frame_equal(ordered_df.sort_values("scan").reset_index(drop=True)[["scan", "rt"]], reordered_df.sort_values("scan").reset_index(drop=True)[["scan", "rt"]])
+
+def test_ms2prec_scans():
+    ms1_df, ms2_df = msql_fileloading.load_data("tests/data/GNPS00002_A3_p.mzML", cache=True)
+    ms2_columns = list(ms2_df.columns)
+
+    # Precursors of scans in the file, so the windows have scans in them
+    precursors = ms2_df.drop_duplicates("scan")["precmz"].to_numpy()
+    first_precmz, second_precmz = precursors[0], precursors[len(precursors) // 2]
+
+    _check_index_parity(["QUERY scaninfo(MS2DATA) WHERE MS2PREC={}".format(first_precmz),
+                        "QUERY scaninfo(MS2DATA) WHERE MS2PREC=({} OR {})".format(first_precmz, second_precmz),
+                        "QUERY scaninfo(MS2DATA) WHERE MS2PREC={}:TOLERANCEPPM=10".format(second_precmz),
+                        "QUERY scaninfo(MS2DATA) WHERE MS2PREC={}:EXCLUDED".format(first_precmz),
+                        "QUERY scaninfo(MS2DATA) WHERE MS2PREC=ANY:MASSDEFECT=massdefect(min=0.1, max=0.2)",
+                        "QUERY scaninfo(MS2DATA) WHERE MS2PREC={} AND MS2PROD=226.18".format(first_precmz),
+                        "QUERY scaninfo(MS2DATA) WHERE MS2PREC=226.18:EXCLUDED"])
+
+    results_df = msql_engine.process_query("QUERY scaninfo(MS2DATA) WHERE MS2PREC={}".format(first_precmz), "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+    assert(len(results_df) > 0)
+
+    # The peak data is not modified
+    assert(list(ms2_df.columns) == ms2_columns)
+
+def test_ms2nl_index():
+    _check_index_parity(["QUERY scaninfo(MS2DATA) WHERE MS2NL=176.0321",
+                        "QUERY scaninfo(MS2DATA) WHERE MS2NL=(176.0321 OR 18.0106):TOLERANCEMZ=0.01",
+                        "QUERY scaninfo(MS2DATA) WHERE MS2NL=176.0321:TOLERANCEPPM=10",
+                        "QUERY scaninfo(MS2DATA) WHERE MS2NL=18.0106:EXCLUDED",
+                        "QUERY scaninfo(MS2DATA) WHERE MS2NL=ANY:MASSDEFECT=massdefect(min=0.1, max=0.2)",
+                        "QUERY scaninfo(MS2DATA) WHERE MS2NL=176.0321 AND MS2PROD=85.02915"])
+
+    # 10 ppm is on the product ion, 226.18, not on the loss. Right on the edge of the window
+    ms1_df, ms2_df = _synthetic_data()
+
+    def _scans(query):
+        results_df = msql_engine.process_query(query, "synthetic.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+        return sorted(set(results_df["scan"])) if len(results_df) > 0 else []
+
+    assert(_scans("QUERY scaninfo(MS2DATA) WHERE MS2NL=273.9215:TOLERANCEPPM=10") == [2])
+    assert(_scans("QUERY scaninfo(MS2DATA) WHERE MS2NL=273.9225:TOLERANCEPPM=10") == [])
+
+def test_or_windows():
+    _check_index_parity(["QUERY scaninfo(MS2DATA) WHERE MS2PROD=(226.18 OR 226.2 OR 85.02915):TOLERANCEMZ=0.1",
+                        "QUERY scaninfo(MS2DATA) WHERE MS2PROD=(226.18 OR 309.2):TOLERANCEPPM=5",
+                        "QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18:EXCLUDED",
+                        "QUERY scaninfo(MS1DATA) WHERE MS1MZ=(226.18 OR 601.358):TOLERANCEMZ=0.1",
+                        "QUERY scaninfo(MS1DATA) WHERE MS1MZ=226.18:EXCLUDED:INTENSITYPERCENT=30"])
+
+    # Overlapping windows, and a window that ends exactly on a peak
+    ms1_df, ms2_df = _synthetic_data()
+
+    query = "QUERY scaninfo(MS2DATA) WHERE MS2PROD=(226.18 OR 226.2 OR 150.1):TOLERANCEMZ=0.1"
+    results_df = msql_engine.process_query(query, "synthetic.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+    assert(sorted(results_df["scan"]) == [2, 5])
+
+    condition = msql_parser.parse_msql(query)["conditions"][0]
+    _, index_ms2_df = msql_engine_filters.ms2prod_condition(condition, ms1_df, ms2_df, {}, ms2_index=msql_engine_index.PeakIndex(ms2_df))
+    _, mask_ms2_df = msql_engine_filters.ms2prod_condition(condition, ms1_df, ms2_df, {})
+    pd.testing.assert_frame_equal(index_ms2_df, mask_ms2_df)
+    assert(list(mask_ms2_df.index) == [0, 1, 4, 5])
+
+    # Overlapping FILTER windows keep every peak once
+    filter_df = msql_engine_filters.ms1_filter(msql_parser.parse_msql("QUERY MS1DATA FILTER MS1MZ=(500.1 OR 500.15 OR 400.3):TOLERANCEMZ=0.1")["conditions"][0], ms1_df)
+    assert(list(filter_df.index) == [0, 2, 3])
+
+    single_df = msql_engine.process_query("QUERY MS1DATA WHERE MS1MZ=425.2898:TOLERANCEMZ=0.01 FILTER MS1MZ=425.2898:TOLERANCEMZ=0.01", "tests/data/GNPS00002_A3_p.mzML")
+    overlapping_df = msql_engine.process_query("QUERY MS1DATA WHERE MS1MZ=425.2898:TOLERANCEMZ=0.01 FILTER MS1MZ=(425.2898 OR 425.2899):TOLERANCEMZ=0.01", "tests/data/GNPS00002_A3_p.mzML")
+    assert(len(single_df) > 0)
+    pd.testing.assert_frame_equal(overlapping_df, single_df)
+
+def test_result_cache(tmp_path):
+    input_filename = _copy_test_file(tmp_path, "GNPS00002_A3_p.mzML")
+
+    result_cache = msql_engine_cache.ResultCache(str(tmp_path / "cache"))
+
+    query = "QUERY scaninfo(MS2DATA) WHERE MS2PREC=X AND MS2PROD=226.18"
+    results_df = msql_engine.process_query(query, input_filename, result_cache=result_cache)
+
+    # Same query, with different whitespace, comments and order of the conditions
+    reordered_query = "QUERY scaninfo(MS2DATA)   # same query\nWHERE MS2PROD=226.18 AND MS2PREC=X"
+    cached_df = msql_engine.process_query(reordered_query, input_filename, result_cache=result_cache)
+
+    assert(len(results_df) > 0)
+    pd.testing.assert_frame_equal(results_df, cached_df)
+    pd.testing.assert_frame_equal(results_df, msql_engine.process_query(query, input_filename))
+    assert(result_cache.stats()["hits"] == 1)
+    assert(result_cache.stats()["misses"] == 1)
+
+    # Changing the file means the results are not valid anymore
+    with open(input_filename, "a") as input_file:
+        input_file.write("\n")
+    msql_engine.process_query(query, input_filename, result_cache=result_cache)
+    assert(result_cache.stats()["misses"] == 2)
+
+    # Nothing fits anymore, everything is evicted oldest first
+    result_cache.max_bytes = 1
+    result_cache._evict()
+    assert(result_cache.stats()["entries"] == 0)
+    assert(result_cache.stats()["evictions"] == 2)
+
+def test_result_cache_backend(tmp_path):
+    pytest.importorskip("duckdb")
+
+    input_filename = _copy_test_file(tmp_path, "GNPS00002_A3_p.mzML")
+
+    result_cache = msql_engine_cache.ResultCache(str(tmp_path / "cache"))
+
+    # The backends order scanmz and scannum differently, the results of one are not handed out for the other
+    query = "QUERY scanmz(MS2DATA) WHERE MS2PROD=226.18"
+    pandas_df = msql_engine.process_query(query, input_filename, result_cache=result_cache)
+    results_df = msql_engine.process_query(query, input_filename, result_cache=result_cache, backend="duckdb")
+    assert(result_cache.stats()["hits"] == 0)
+
+    cached_df = msql_engine.process_query(query, input_filename, result_cache=result_cache, backend="duckdb")
+    assert(result_cache.stats()["hits"] == 1)
+    pd.testing.assert_frame_equal(results_df.reset_index(drop=True), cached_df)
+    assert(sorted(pandas_df["precmz"]) == sorted(cached_df["precmz"]))
+
+def test_summary_pruning(tmp_path):
+    from massql import msql_engine_summary
+
+    input_filename = _copy_test_file(tmp_path, "GNPS00002_A3_p.mzML")
+
+    # The summary is written when the file is loaded with the cache
+    assert(msql_engine_summary.load_summary(input_filename) is None)
+    ms1_df, ms2_df = msql_fileloading.load_data(input_filename, cache=True)
+    summary = msql_engine_summary.load_summary(input_filename)
+    assert(summary["ms2"]["scans"] == ms2_df["scan"].nunique())
+    assert(summary["ms2"]["charge"] == {str(charge) : count for charge, count in ms2_df.drop_duplicates("scan")["charge"].value_counts().items()})
+
+    def _prune(query):
+        return msql_engine_summary.prune_file([msql_parser.parse_msql(query)], input_filename)
+
+    # Past the end of the ranges in the file
+    assert(_prune("QUERY scaninfo(MS1DATA) WHERE RTMIN={}".format(ms1_df["rt"].max() + 1)) is not None)
+    assert(_prune("QUERY scaninfo(MS2DATA) WHERE MS2PREC={}".format(ms2_df["precmz"].max() + 100)) is not None)
+    assert(_prune("QUERY scaninfo(MS1DATA) WHERE MS1MZ={}".format(ms1_df["mz"].max() + 100)) is not None)
+    assert(_prune("QUERY scaninfo(MS2DATA) WHERE CHARGE={}".format(ms2_df["charge"].max() + 1)) is not None)
+    assert((_prune("QUERY scaninfo(MS2DATA) WHERE POLARITY=Negative") is not None) == (not (ms2_df["polarity"] == 2).any()))
+
+    # Every query that has results in the file is kept
+    for query in ["QUERY scaninfo(MS2DATA) WHERE MS2PREC={}".format(ms2_df["precmz"].iloc[0]),
+                    "QUERY scaninfo(MS2DATA) WHERE MS2PREC=X AND MS2PROD=226.18",
+                    "QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18:TOLERANCEPPM=5",
+                    "QUERY scaninfo(MS2DATA) WHERE MS2NL=176.0321 AND MS2PROD=85.02915",
+                    "QUERY scaninfo(MS1DATA) WHERE MS1MZ=226.18:INTENSITYPERCENT=1"]:
+        if len(msql_engine.process_query(query, input_filename)) > 0:
+            assert(_prune(query) is None)
+
+    # MS2 conditions do not prune MS1 data, without MS2 scans they leave the MS1 data as is
+    assert(_prune("QUERY scaninfo(MS1DATA) WHERE MS2PREC={}".format(ms2_df["precmz"].max() + 100)) is None)
+
+    pruned_query = "QUERY scaninfo(MS2DATA) WHERE RTMIN={}".format(ms2_df["rt"].max() + 1)
+    results_df, query_profile = msql_engine.process_query(pruned_query, input_filename, profile=True)
+    assert(len(results_df) == 0)
+    summary_node = [node for node in query_profile.to_dict()["children"] if node["operator"] == "summary"][0]
+    assert(summary_node["pruned"] == 1)
+
+    # Changing the file means the summary is not valid anymore
+    with open(input_filename, "a") as input_file:
+        input_file.write("\n")
+    assert(msql_engine_summary.load_summary(input_filename) is None)
+
+def test_summary_without_cache(tmp_path):
+    from massql import msql_fragment_index
+
+    input_filename = str(tmp_path / "top_down.mgf")
+    shutil.copyfile("tests/test_data/top_down.mgf", input_filename)
+
+    # Without the cache nothing is written next to the file
+    msql_fileloading.load_data(input_filename, cache=False)
+    msql_engine.process_query("QUERY scaninfo(MS2DATA)", input_filename, cache=False)
+    msql_fragment_index.build_index(str(tmp_path / "fragment_index"), [input_filename], cache=False)
+    assert(sorted(os.listdir(tmp_path)) == ["fragment_index", "top_down.mgf"])
+
+    msql_fileloading.load_data(input_filename, cache=True)
+    assert(os.path.exists(input_filename + "_summary.msql.json"))
+
+def test_bloom_pruning(tmp_path):
+    # Values next to the edges of the bins of the bloom filters
+    from massql import msql_engine_summary
+
+    ms1_df, ms2_df = _synthetic_data()
+
+    input_filename = str(tmp_path / "synthetic.mzML")
+    with open(input_filename, "w") as input_file:
+        input_file.write("synthetic")
+    msql_engine_summary.save_summary(input_filename, ms1_df, ms2_df, false_positive_rate=0.001)
+
+    def _prune(query):
+        return msql_engine_summary.prune_file([msql_parser.parse_msql(query)], input_filename)
+
+    # Inside the m/z range, but no peak there
+    assert(_prune("QUERY scaninfo(MS2DATA) WHERE MS2PROD=200.0") is not None)
+    assert(_prune("QUERY scaninfo(MS2DATA) WHERE MS2NL=100.0") is not None)
+    assert(_prune("QUERY scaninfo(MS2DATA) WHERE MS2PROD=(200.0 OR 210.0)") is not None)
+
+    # Peaks next to the edge of a bin are found with the neighbouring bins
+    assert(_prune("QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18") is None)
+    assert(_prune("QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.175:TOLERANCEMZ=0.006") is None)
+    assert(_prune("QUERY scaninfo(MS2DATA) WHERE MS2PROD=(200.0 OR 150.0)") is None)
+    assert(_prune("QUERY scaninfo(MS2DATA) WHERE MS2NL=273.92") is None)
+    assert(_prune("QUERY scaninfo(MS2DATA) WHERE MS2NL=273.92:TOLERANCEPPM=10") is None)
+
+    # Exclusion and variables do not need the peak
+    assert(_prune("QUERY scaninfo(MS2DATA) WHERE MS2PROD=200.0:EXCLUDED") is None)
+    assert(_prune("QUERY scaninfo(MS2DATA) WHERE MS2PREC=X AND MS2NL=X-100") is None)
+
+def test_fragment_index(tmp_path):
+    from massql import msql_fragment_index
+
+    # The second file does not have the 226.18 fragment
+    ms1_df, ms2_df = msql_fileloading.load_data("tests/data/GNPS00002_A3_p.mzML", cache=True)
+    other_ms2_df = ms2_df.copy()
+    other_ms2_df.loc[(other_ms2_df["mz"] - 226.18).abs() < 0.2, "mz"] += 1.0
+
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    a_filename = _copy_test_file(data_dir, "a.mzML")
+    b_filename = _copy_test_file(data_dir, "b.mzML", ms2_df=other_ms2_df)
+    index_dir = str(tmp_path / "index")
+
+    # Files are added to the index incrementally
+    assert(msql_fragment_index.build_index(index_dir, [a_filename]) == 1)
+    assert(msql_fragment_index.build_index(index_dir, [str(data_dir)]) == 1)
+    assert(msql_fragment_index.build_index(index_dir, [str(data_dir)]) == 0)
+
+    # Every scan the engine finds is a candidate
+    for query in ["QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18", "QUERY scaninfo(MS2DATA) WHERE MS2NL=176.0321 AND MS2PROD=85.02915"]:
+        expected_scans = set(str(scan) for scan in msql_engine.process_query(query, a_filename).get("scan", []))
+        candidates = msql_fragment_index.plan_query(index_dir, query)
+
+        assert(expected_scans <= candidates.get(a_filename, set()))
+
+    assert(len(msql_engine.process_query("QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18", b_filename)) == 0)
+    assert(msql_fragment_index.plan_query(index_dir, "QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18:INTENSITYVALUE={}".format(ms2_df["i"].max() * 10)) == {})
+    assert(msql_fragment_index.plan_query(index_dir, "QUERY scaninfo(MS2DATA) WHERE MS2PREC=500.1") == {a_filename : None, b_filename : None})
+
+    # Candidates are checked with the engine
+    query = "QUERY scaninfo(MS2DATA) WHERE MS2PREC=X AND MS2PROD=226.18"
+    results_df = msql_fragment_index.query_index(index_dir, query)
+    expected_df = msql_engine.process_query(query, a_filename)
+
+    assert(len(expected_df) > 0)
+    assert(set(results_df["filename"]) == {a_filename})
+    pd.testing.assert_frame_equal(results_df.drop(columns=["filename"]), expected_df)
+
+def test_query_server(tmp_path):
+    import socket
+    import threading
+    from massql import msql_server
+
+    input_filename = _copy_test_file(tmp_path, "GNPS00002_A3_p.mzML")
+    query = "QUERY scaninfo(MS2DATA) WHERE MS2PREC=X AND MS2PROD=226.18"
+    expected_df = msql_engine.process_query(query, input_filename)
+
+    server = msql_server.QueryServer(str(tmp_path / "massql.sock"), num_workers=1)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+
+    try:
+        jobs = []
+        jobs.append({"filename" : input_filename, "query" : query, "output_file" : str(tmp_path / "results.tsv")})
+        jobs.append({"filename" : str(tmp_path / "missing.mzML"), "query" : "QUERY scaninfo(MS2DATA)"})
+
+        job_results = sorted(msql_server.submit_jobs(server.socket_path, jobs), key=lambda job_result: job_result["job_index"])
+
+        # A malformed line in between jobs
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
+            client_socket.connect(server.socket_path)
+            client_socket.sendall((json.dumps(jobs[0]) + "\n{not json\n" + json.dumps(jobs[1]) + "\n").encode("utf-8"))
+            client_socket.shutdown(socket.SHUT_WR)
+
+            with client_socket.makefile("r", encoding="utf-8") as response_file:
+                malformed_results = sorted([json.loads(line) for line in response_file], key=lambda job_result: job_result["job_index"])
+    finally:
+        server.shutdown()
+        server.server_close()
+        server_thread.join()
+
+    assert(len(expected_df) > 0)
+    assert(job_results[0]["status"] == "ok")
+    assert(job_results[0]["results"] == len(expected_df))
+    assert(list(pd.read_csv(tmp_path / "results.tsv", sep="\t")["scan"]) == list(expected_df["scan"]))
+    assert(job_results[1]["status"] == "error")
+    assert(job_results[1]["filename"] == jobs[1]["filename"])
+
+    assert([job_result["job_index"] for job_result in malformed_results] == [0, 1, 2])
+    assert([job_result["status"] for job_result in malformed_results] == ["ok", "error", "error"])
+    assert(malformed_results[1]["filename"] is None)
+    assert(malformed_results[2]["filename"] == jobs[1]["filename"])
+    assert(not os.path.exists(server.socket_path))
+
+def test_query_files(tmp_path):
+    for name in ["a.mzML", "b.mzML"]:
+        _copy_test_file(tmp_path, name)
+
+    query = "QUERY scaninfo(MS2DATA) WHERE MS2PREC=X AND MS2PROD=226.18"
+    input_filenames = msql_engine_files.find_files(str(tmp_path / "*.mzML")) + [str(tmp_path / "missing.mzML")]
+    expected_df = msql_engine.process_query(query, input_filenames[0])
+
+    # The pool and the files one at a time in this process, with the X values on processes as well
+    for workers, parallel in [(2, False), (1, False), (1, True)]:
+        file_results = sorted(msql_engine.process_query_files(query, input_filenames, parallel=parallel, workers=workers), key=lambda file_result: file_result[0])
+
+        assert([input_filename for input_filename, _, _ in file_results] == sorted(input_filenames))
+        for input_filename, results_df, error in file_results:
+            if "missing" in input_filename:
+                assert(error is not None)
+                assert(len(results_df) == 0)
+            else:
+                assert(error is None)
+                assert(set(results_df["filename"]) == set([input_filename]))
+                pd.testing.assert_frame_equal(results_df.drop(columns=["filename"]), expected_df)
+
+    # Stopping early drops the files that have not started
+    file_results = msql_engine.process_query_files(query, input_filenames * 4, workers=2)
+    next(file_results)
+    file_results.close()
+
+def test_parallel_ray(monkeypatch):
+    ray = pytest.importorskip("ray")
+    from massql import msql_engine_ray
+
+    ms1_df, ms2_df = msql_fileloading.load_data("tests/data/GNPS00002_A3_p.mzML", cache=True)
+    # One query per chunk, so the results come back in several pieces
+    monkeypatch.setattr(msql_engine_ray, "PROBE_CHUNK_SIZE", 1)
+
+    query = "QUERY scaninfo(MS2DATA) WHERE MS2PREC=X AND MS2PROD=226.18"
+    serial_df = msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+
+    msql_engine.init_ray(num_cpus=1)
+    try:
+        parallel_df = msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df, parallel=True)
+    finally:
+        ray.shutdown()
+
+    assert(len(serial_df) > 0)
+    pd.testing.assert_frame_equal(serial_df, parallel_df)
+
+def _check_backend_parity(backend):
+    ms1_df, ms2_df = msql_fileloading.load_data("tests/data/GNPS00002_A3_p.mzML", cache=True)
+    precmz = ms2_df["precmz"].iloc[0]
+
+    queries = [
+        "QUERY scaninfo(MS2DATA) WHERE MS2PROD=(226.18 OR 85.02915):TOLERANCEMZ=0.1",
+        "QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18:EXCLUDED",
+        "QUERY scaninfo(MS2DATA) WHERE MS2PREC={}:TOLERANCEPPM=10".format(precmz),
+        "QUERY scaninfo(MS2DATA) WHERE MS2NL=176.0321 AND MS2PROD=85.02915",
+        "QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18:TOLERANCEPPM=5:INTENSITYPERCENT=5 AND RTMIN=1 AND POLARITY=Positive",
+        "QUERY scaninfo(MS1DATA) WHERE POLARITY=Positive",
+        "QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18 AND POLARITY=Negative",
+        "QUERY scansum(MS2DATA) WHERE MS2PROD=226.18",
+        "QUERY scansum(MS1DATA) WHERE MS1MZ=226.18:INTENSITYPERCENT=1",
+        "QUERY MS2DATA WHERE MS2PROD=226.18 FILTER MS2PROD=226.18",
+        "QUERY exists(MS2DATA) WHERE MS2PROD=999.0",
+        "QUERY scaninfo(MS2DATA) WHERE MS2PREC=(QUERY scanmaxint(MS2DATA) WHERE MS2PROD=226.18):TOLERANCEMZ=0.1",
+    ]
+
+    for query in queries:
+        pandas_df = msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+        backend_df = msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df, backend=backend)
+
+        pd.testing.assert_frame_equal(pandas_df.reset_index(drop=True), backend_df.reset_index(drop=True), check_dtype=False)
+
+    # Variables are not supported, these run with pandas
+    query = "QUERY scaninfo(MS2DATA) WHERE MS2PREC=X AND MS2PROD=226.18"
+    pandas_df = msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+    backend_df = msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df, backend=backend)
+    assert(len(pandas_df) > 0)
+    pd.testing.assert_frame_equal(pandas_df, backend_df)
+
+def test_duckdb_backend():
+    pytest.importorskip("duckdb")
+
+    _check_backend_parity("duckdb")
+
+    # Polarity names are not variables
+    assert(msql_engine_duckdb.unsupported_reason(msql_parser.parse_msql("QUERY scaninfo(MS1DATA) WHERE POLARITY=Positive")) is None)
+    assert(msql_engine_duckdb.unsupported_reason(msql_parser.parse_msql("QUERY scaninfo(MS2DATA) WHERE MS2PROD=X+2")) == "variables")
+
+    query = "QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18"
+    with pytest.raises(Exception, match="BACKEND NOT SUPPORTED"):
+        msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", backend="sqlite")
+
+def test_polars_backend():
+    pytest.importorskip("polars")
+
+    _check_backend_parity("polars")
+
+    # Polarity runs with Polars, not with the pandas engine
+    assert(msql_engine_polars.unsupported_reason(msql_parser.parse_msql("QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18 AND POLARITY=Negative")) is None)
+
+def test_numba_kernels(monkeypatch):
+    pytest.importorskip("numba")
+    from massql import msql_engine_kernels
+
+    random_generator = np.random.default_rng(0)
+    scans = np.repeat(np.arange(50), random_generator.integers(1, 20, 50))
+    ms_df = pd.DataFrame({"scan" : scans, "i" : random_generator.exponential(1000, len(scans)), "i_norm" : random_generator.uniform(0, 1, len(scans)),
+                            "i_tic_norm" : random_generator.uniform(0, 0.05, len(scans)), "mz" : random_generator.uniform(50, 1000, len(scans))})
+    offsets = msql_engine_kernels.run_offsets(scans)
+    defects = (ms_df["mz"] - ms_df["mz"].astype(int)).to_numpy()
+    min_values, max_values = msql_engine_index.merge_windows(np.array([100.0, 105.0, 500.0]), np.array([110.0, 120.0, 900.0]))
+
+    # Enough windows that they are searched instead of compared with one by one
+    many_min_values, many_max_values = msql_engine_index.merge_windows(np.arange(50.0, 1000.0, 3.0), np.arange(50.0, 1000.0, 3.0) + 1)
+    assert(len(many_min_values) > msql_engine_kernels.WINDOWS_COMPARE_MAX_NUMBA)
+
+    def _run_kernels(use_numba):
+        monkeypatch.setattr(msql_engine_kernels, "USE_NUMBA", use_numba)
+        return [msql_engine_kernels.run_sums(ms_df["i"].to_numpy(), offsets),
+                msql_engine_kernels.windows_mask(ms_df["mz"].to_numpy(), min_values, max_values),
+                msql_engine_kernels.windows_mask(ms_df["mz"].to_numpy(), many_min_values, many_max_values),
+                msql_engine_kernels.peaks_mask(ms_df, 100, 0.1, 0.01),
+                msql_engine_kernels.peaks_mask(ms_df, 100, 0.1, 0.01, defects=defects, massdefect_min=0.1, massdefect_max=0.6)]
+
+    # Every size goes to the kernels
+    monkeypatch.setattr(msql_engine_kernels, "NUMBA_MIN_ROWS", 0)
+
+    assert(len(offsets) == 51)
+    for numpy_values, numba_values in zip(_run_kernels(False), _run_kernels(True)):
+        assert(np.array_equal(numpy_values, numba_values))
+
+    ms1_df, ms2_df = msql_fileloading.load_data("tests/data/GNPS00002_A3_p.mzML", cache=True)
+    queries = ["QUERY scaninfo(MS2DATA) WHERE MS2PROD=226.18:EXCLUDED AND MS2PROD=ANY:MASSDEFECT=massdefect(min=0.1, max=0.2)",
+                "QUERY scaninfo(MS2DATA) WHERE MS2PROD=(226.18 OR 85.02915 OR 309.2):TOLERANCEMZ=0.1:INTENSITYPERCENT=5",
+                "QUERY scaninfo(MS1DATA) WHERE MS1MZ=ANY:MASSDEFECT=massdefect(min=0.1, max=0.2)",
+                "QUERY scaninfo(MS2DATA) WHERE MS1MZ=X:INTENSITYMATCH=Y:INTENSITYMATCHREFERENCE AND MS2PREC=X AND MS2PROD=226.18"]
+
+    for query in queries:
+        monkeypatch.setattr(msql_engine_kernels, "USE_NUMBA", False)
+        numpy_df = msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+        monkeypatch.setattr(msql_engine_kernels, "USE_NUMBA", True)
+        numba_df = msql_engine.process_query(query, "tests/data/GNPS00002_A3_p.mzML", ms1_df=ms1_df, ms2_df=ms2_df)
+
+        pd.testing.assert_frame_equal(numpy_df, numba_df)
+
+def test_result_accumulator():
+    results_accumulator = msql_engine_results.ResultAccumulator()
+
+    results_accumulator.append(pd.DataFrame({"scan" : [1, 2], "comment" : [100.1, 100.1], "i" : [1.0, 2.0]}))
+    results_accumulator.append(pd.DataFrame())
+    # Same scan and truncated X as the first row
+    results_accumulator.append(pd.DataFrame({"scan" : [1, 3], "comment" : [100.4, 100.4], "i" : [3.0, 4.0], "mobility" : [0.5, 0.6]}))
+
+    results_df = results_accumulator.to_dataframe()
+
+    assert(list(results_df["scan"]) == [1, 2, 3])
+    assert(list(results_df["i"]) == [1.0, 2.0, 4.0])
+    assert(list(results_df["comment"]) == [100.1, 100.1, 100.4])
+    assert(np.isnan(results_df["mobility"][0]))
+    assert(results_df["mobility"][2] == 0.6)
+
 def main():
     #msql_engine.init_ray()
     